@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-Stats benchmarks.
+
+The benchmarks run offline and compare their results with the baselines
+recorded in ``benchmarks/baselines.json``. The baselines are not committed:
+they are recorded with ``--update`` on the machine running the benchmarks,
+e.g. by the CI before the changes under test:
+
+.. code-block:: console
+
+   $ python -m benchmarks.bench_import           # compare with the baselines
+   $ python -m benchmarks.bench_import --update  # record new baselines
+
+Available benchmarks:
+
+- ``bench_import``: startup cost of the extension.
+- ``bench_ingest``: throughput of the events preprocessors and indexer.
+- ``bench_aggregate``: scaling of the events aggregation.
+- ``bench_rest``: latency and throughput of the statistics REST API.
+
+The events are generated by :mod:`benchmarks.generator`. The machine and the
+parameters of the benchmarks are recorded with the baselines, under the
+``_environment`` and ``_parameters`` keys: results obtained on another machine
+or with other parameters should be compared with baselines recorded there.
+"""
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Recording and comparison of benchmark baselines."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+
+def load_baselines(benchmark):
+    """Load the baselines of a benchmark."""
+    if not os.path.exists(BASELINES_FILE):
+        return {}
+    with open(BASELINES_FILE) as f:
+        return json.load(f).get(benchmark, {})
+
+
+def get_environment():
+    """Describe the machine running the benchmarks."""
+    return dict(
+        platform=platform.platform(),
+        processor=platform.processor() or platform.machine(),
+        cpus=multiprocessing.cpu_count(),
+        python='{0} {1}'.format(platform.python_implementation(),
+                                platform.python_version()),
+    )
+
+
+def save_baselines(benchmark, results, parameters=None):
+    """Record the results of a benchmark as its new baselines.
+
+    The machine and the parameters of the benchmark are recorded with them,
+    under the ``_environment`` and ``_parameters`` keys.
+    """
+    baselines = {}
+    if os.path.exists(BASELINES_FILE):
+        with open(BASELINES_FILE) as f:
+            baselines = json.load(f)
+    baselines[benchmark] = results
+    baselines.setdefault('_environment', {})[benchmark] = get_environment()
+    baselines.setdefault('_parameters', {})[benchmark] = parameters or {}
+    with open(BASELINES_FILE, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(benchmark, results, higher_is_better=(), tolerance=0.2):
+    """Print the results of a benchmark next to its baselines.
+
+    :param results: dictionary of measure name -> value.
+    :param higher_is_better: names, or name suffixes, of the measures which
+        regress when they decrease, e.g. throughputs. Other measures regress
+        when they increase.
+    :param tolerance: relative difference tolerated before a regression is
+        reported.
+    :returns: the names of the regressed measures.
+    """
+    baselines = load_baselines(benchmark)
+    regressions = []
+    for name, value in sorted(results.items()):
+        baseline = baselines.get(name)
+        status = ''
+        if baseline:
+            change = (value - baseline) / float(baseline)
+            status = '{0:+.1%}'.format(change)
+            if name.endswith(tuple(higher_is_better)):
+                change = -change
+            if change > tolerance:
+                regressions.append(name)
+                status += ' REGRESSION'
+        print('{0:<40} {1:>14.4f} {2:>14} {3}'.format(
+            name, value, '{0:.4f}'.format(baseline) if baseline else '-',
+            status))
+    return regressions
+
+
+def main(benchmark, run, higher_is_better=(), tolerance=0.2,
+         add_arguments=None):
+    """Run a benchmark from the command line.
+
+    :param add_arguments: function adding the options of the benchmark to
+        the ``argparse`` parser. The parsed arguments are then given to
+        ``run``.
+    """
+    parser = argparse.ArgumentParser(description=benchmark)
+    parser.add_argument('--update', action='store_true',
+                        help='record the results as the new baselines')
+    parser.add_argument('--tolerance', type=float, default=tolerance,
+                        help='relative regression tolerance')
+    if add_arguments:
+        add_arguments(parser)
+    args = parser.parse_args()
+    results = run(args) if add_arguments else run()
+    print('{0:<40} {1:>14} {2:>14}'.format('measure', 'result', 'baseline'))
+    regressions = compare(benchmark, results, higher_is_better,
+                          args.tolerance)
+    if args.update:
+        parameters = dict((k, v) for k, v in vars(args).items()
+                          if k not in ('update', 'tolerance'))
+        save_baselines(benchmark, results, parameters)
+    elif regressions:
+        sys.exit(1)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Scaling of the events aggregation.
+
+:meth:`~invenio_stats.aggregations.StatAggregator.run` aggregates synthetic
+``file-download`` events stored in a
+:class:`~invenio_stats.memsearch.MemorySearchClient`. Three curves are
+measured, each one varying a parameter while the others keep their default
+value: the number of distinct records, the number of events per day and the
+``batch_size`` of the aggregator. On the records curve, the number of events
+per day is the number of records, so that the number of keys to aggregate
+grows with the records instead of being bounded by the events. Each point of
+a curve reports:
+
+- ``wall_s``: duration of the run,
+- ``keys``: number of distinct aggregation keys, i.e. of downloaded files,
+  actually aggregated,
+- ``searches``: number of ``search``, ``scroll`` and ``msearch`` requests,
+- ``kb_moved``: size of the JSON requests and responses,
+- ``peak_kb``: peak Python memory allocated during the run,
+- ``docs_per_s``: aggregation documents written per second.
+
+The sizes of the curves can be changed from the command line, e.g. to
+measure larger numbers of records:
+
+.. code-block:: console
+
+   $ python -m benchmarks.bench_aggregate --records 1000,100000,1000000
+"""
+
+from __future__ import absolute_import, print_function
+
+import datetime
+import gc
+import json
+import sys
+import time
+
+from invenio_stats.aggregations import StatAggregator
+from invenio_stats.memsearch import MemorySearchClient, put_contrib_templates
+
+from .baselines import main
+from .bench_ingest import create_app
+from .generator import ROBOT_USER_AGENTS, EventGenerator
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+START_DATE = datetime.datetime(2018, 1, 1)
+
+DEFAULTS = dict(records=10000, events_per_day=10000, batch_size=7, days=3)
+"""Parameters of the datasets when they are not the measured variable."""
+
+CURVES = dict(
+    records=[1000, 10000, 100000],
+    events_per_day=[1000, 10000, 50000],
+    batch_size=[1, 3, 7],
+)
+"""Default points of each curve."""
+
+SEARCH_REQUESTS = ('search', 'scroll', 'msearch')
+"""Requests counted as searches."""
+
+
+class CountingClient(object):
+    """Search client counting the requests and the data they move."""
+
+    counted = ('search', 'msearch', 'scroll', 'bulk', 'mget', 'count')
+
+    def __init__(self, client):
+        """Constructor."""
+        self.client = client
+        self.bytes_moved = 0
+
+    def __getattr__(self, name):
+        """Get the attributes of the wrapped client."""
+        attr = getattr(self.client, name)
+        if name not in self.counted:
+            return attr
+
+        def call(*args, **kwargs):
+            body = kwargs.get('body', args[0] if args else None)
+            response = attr(*args, **kwargs)
+            if body is not None:
+                self.bytes_moved += len(
+                    body if isinstance(body, str) else json.dumps(body))
+            self.bytes_moved += len(json.dumps(response))
+            return response
+        return call
+
+
+def create_dataset(records, events_per_day, days):
+    """Store synthetic indexed events in an in-memory client."""
+    client = MemorySearchClient()
+    put_contrib_templates(client)
+    generator = EventGenerator(seed=42, records=records,
+                               events_per_day=events_per_day,
+                               start_date=START_DATE)
+    indices = {}
+    for i in range(events_per_day * days):
+        event = generator.file_download()
+        index_name = 'events-stats-file-download-{}'.format(
+            event['timestamp'][:10])
+        if index_name not in indices:
+            indices[index_name] = client.create_index(index_name)
+        # Fields of the events once they went through the preprocessors
+        event.update(
+            timestamp=event['timestamp'][:19],
+            unique_id='{0}_{1}'.format(event['bucket_id'], event['file_id']),
+            is_robot=event['user_agent'] in ROBOT_USER_AGENTS,
+            unique_session_id='{0}|{1}|{2}'.format(
+                event['ip_address'], event['user_agent'],
+                event['timestamp'][:13]),
+        )
+        indices[index_name].put('stats-file-download', str(i), event)
+    return client
+
+
+def create_aggregator(client, batch_size):
+    """Create the aggregator of the contrib ``file-download-agg``."""
+    return StatAggregator(
+        'file-download-agg', 'file-download', client=client,
+        aggregation_field='unique_id', aggregation_interval='day',
+        batch_size=batch_size,
+        copy_fields=dict(file_key='file_key', bucket_id='bucket_id',
+                         file_id='file_id'),
+        metric_aggregation_fields={
+            'unique_count': ('cardinality', 'unique_session_id',
+                             {'precision_threshold': 1000}),
+            'volume': ('sum', 'size', {}),
+        })
+
+
+def measure(records, events_per_day, batch_size, days):
+    """Measure the aggregation of a dataset."""
+    client = create_dataset(records, events_per_day, days)
+    end_date = START_DATE + datetime.timedelta(days=days - 1)
+    counting_client = CountingClient(client)
+    aggregator = create_aggregator(counting_client, batch_size)
+    searches = sum(client.requests[r] for r in SEARCH_REQUESTS)
+    gc.collect()
+    start = time.time()
+    aggregator.run(START_DATE, end_date, update_bookmark=False)
+    wall_time = time.time() - start
+    searches = sum(client.requests[r] for r in SEARCH_REQUESTS) - searches
+    bytes_moved = counting_client.bytes_moved
+    aggregations = [index for name, index in client.indices_data.items()
+                    if name.startswith('stats-file-download-')]
+    docs = sum(len(index) for index in aggregations)
+    keys = set(index.column('unique_id')[row]
+               for index in aggregations for row in index.rows())
+
+    peak = None
+    if tracemalloc is not None:
+        aggregator = create_aggregator(client, batch_size)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            aggregator.run(START_DATE, end_date, update_bookmark=False)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    result = dict(
+        wall_s=wall_time,
+        keys=float(len(keys)),
+        searches=float(searches),
+        kb_moved=bytes_moved / 1024.0,
+        docs_per_s=docs / wall_time,
+    )
+    if peak is not None:
+        result['peak_kb'] = peak / 1024.0
+    return result
+
+
+def add_arguments(parser):
+    """Add the options changing the points of the curves."""
+    def integers(value):
+        return [int(v) for v in value.split(',')]
+    for curve, points in sorted(CURVES.items()):
+        parser.add_argument(
+            '--{}'.format(curve.replace('_', '-')), type=integers,
+            default=points, help='points of the {} curve, e.g. {}'.format(
+                curve, ','.join(str(p) for p in points)))
+    parser.add_argument('--days', type=int, default=DEFAULTS['days'],
+                        help='number of days of events')
+
+
+def run(args):
+    """Run the benchmark."""
+    results = {}
+    with create_app().app_context():
+        for curve in sorted(CURVES):
+            print(curve, file=sys.stderr)
+            for point in getattr(args, curve):
+                params = dict(DEFAULTS, days=args.days)
+                params[curve] = point
+                if curve == 'records':
+                    params['events_per_day'] = point
+                measures = measure(**params)
+                print('  {0:>10} {1}'.format(point, ' '.join(
+                    '{0}={1:.2f}'.format(k, v)
+                    for k, v in sorted(measures.items()))),
+                    file=sys.stderr)
+                for name, value in measures.items():
+                    results['{0}={1}.{2}'.format(curve, point, name)] = value
+    return results
+
+
+if __name__ == '__main__':
+    main('aggregate', run, higher_is_better=['.docs_per_s'],
+         add_arguments=add_arguments)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Startup cost of the extension in a web worker.
+
+Each measure is taken in a fresh Python process, after the dependencies which
+are needed anyway by an Invenio application (Flask, Invenio-Queues, ...) have
+been imported, so that only the cost of Invenio-Stats is measured.
+"""
+
+from __future__ import absolute_import, print_function
+
+import json
+import subprocess
+import sys
+
+from .baselines import main
+
+RUNS = 10
+
+MEASURE_SCRIPT = '''
+import json, resource, sys, time
+import flask, invenio_cache, invenio_queues, invenio_rest, kombu
+modules = set(sys.modules)
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.time()
+import invenio_stats
+imported = time.time()
+app = flask.Flask('bench')
+invenio_stats.InvenioStats(app)
+initialized = time.time()
+print(json.dumps(dict(
+    import_time=imported - start,
+    init_time=initialized - imported,
+    rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+    modules=sorted(set(sys.modules) - modules),
+)))
+'''
+
+
+def measure():
+    """Measure the startup cost in a fresh process."""
+    output = subprocess.check_output([sys.executable, '-c', MEASURE_SCRIPT])
+    return json.loads(output.decode('utf-8'))
+
+
+def run():
+    """Run the benchmark."""
+    results = [measure() for _ in range(RUNS)]
+    return dict(
+        import_ms=min(r['import_time'] for r in results) * 1000,
+        init_ms=min(r['init_time'] for r in results) * 1000,
+        rss_kb=float(min(r['rss_kb'] for r in results)),
+        imported_modules=float(len(results[0]['modules'])),
+    )
+
+
+if __name__ == '__main__':
+    main('import', run)
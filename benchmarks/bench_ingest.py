@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Throughput of the events ingestion pipeline.
+
+Each preprocessor of the contrib events, and the whole
+:meth:`~invenio_stats.processors.EventsIndexer.actionsiter` of each event type,
+process the same synthetic events consumed from an in-memory queue. The
+benchmark reports the number of events processed per second and the peak of
+the Python memory allocated during a separate pass, measured with
+``tracemalloc``, divided by the number of events.
+"""
+
+from __future__ import absolute_import, print_function
+
+import copy
+import gc
+import sys
+import time
+
+from flask import Flask
+from invenio_cache import InvenioCache
+
+from invenio_stats.contrib.event_builders import build_file_unique_id, \
+    build_record_unique_id
+from invenio_stats.processors import EventsIndexer, anonymize_user, \
+    flag_robots, hash_id
+
+from .baselines import main
+from .generator import EventGenerator
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+EVENTS = 20000
+RUNS = 3
+
+PREPROCESSORS = {
+    'file-download': [flag_robots, anonymize_user, build_file_unique_id],
+    'record-view': [flag_robots, anonymize_user, build_record_unique_id],
+}
+
+
+class MemoryQueue(object):
+    """Queue returning a list of events."""
+
+    def __init__(self, routing_key, events):
+        """Constructor."""
+        self.routing_key = routing_key
+        self.events = events
+
+    def consume(self, payload=True):
+        """Consume the events."""
+        return iter(self.events)
+
+
+def _hash_id(doc):
+    """Call :func:`hash_id` like the indexer does."""
+    hash_id(doc['timestamp'], doc)
+    return doc
+
+
+def create_app():
+    """Create the application in which the pipeline runs."""
+    app = Flask('bench')
+    app.config.update(CACHE_TYPE='simple')
+    InvenioCache(app)
+    return app
+
+
+def _steps(event_type, events):
+    """Get the steps to measure and the events they process."""
+    prepared = copy.deepcopy(events)
+    steps = []
+    for preprocessor in PREPROCESSORS[event_type]:
+        steps.append((preprocessor.__name__, preprocessor,
+                      copy.deepcopy(prepared)))
+        prepared = [preprocessor(e) for e in prepared]
+    steps.append(('hash_id', _hash_id, prepared))
+    return steps
+
+
+def _indexer(event_type, events):
+    """Create an indexer consuming events from memory."""
+    return EventsIndexer(MemoryQueue(event_type, events), client=object(),
+                         preprocessors=PREPROCESSORS[event_type])
+
+
+def measure_throughput(func, events):
+    """Measure the number of events processed per second."""
+    best = None
+    for _ in range(RUNS):
+        batch = copy.deepcopy(events)
+        gc.collect()
+        start = time.time()
+        func(batch)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(events) / best
+
+
+def measure_peak_memory(func, events):
+    """Measure the peak of allocated memory divided by the number of events."""
+    if tracemalloc is None:
+        return None
+    batch = copy.deepcopy(events)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(batch)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / float(len(events))
+
+
+def run():
+    """Run the benchmark."""
+    generator = EventGenerator(seed=42)
+    results = {}
+    with create_app().app_context():
+        for event_type in sorted(PREPROCESSORS):
+            events = generator.events(event_type, EVENTS)
+            # Load the anonymization salts outside of the measures
+            anonymize_user(copy.deepcopy(events[0]))
+            anonymize_user(copy.deepcopy(events[-1]))
+            measures = [
+                ('{0}.{1}'.format(event_type, name),
+                 lambda batch, step=step: [step(e) for e in batch],
+                 step_events)
+                for name, step, step_events in _steps(event_type, events)
+            ]
+            measures.append((
+                '{}.actionsiter'.format(event_type),
+                lambda batch, event_type=event_type: list(
+                    _indexer(event_type, batch).actionsiter()),
+                events))
+            for name, func, step_events in measures:
+                results['{}.events_per_s'.format(name)] = \
+                    measure_throughput(func, step_events)
+                peak = measure_peak_memory(func, step_events)
+                if peak is not None:
+                    results['{}.peak_bytes_per_event'.format(name)] = peak
+                print('.', end='', file=sys.stderr)
+    print(file=sys.stderr)
+    return results
+
+
+if __name__ == '__main__':
+    main('ingest', run, higher_is_better=['.events_per_s'])
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Load test of the statistics REST API.
+
+A mix of ``bucket-file-download-histogram`` and ``bucket-file-download-total``
+requests is sent to :class:`~invenio_stats.views.StatsQueryResource` by
+concurrent clients of the Flask test application. The statistics are
+aggregated beforehand from synthetic events stored in a
+:class:`~invenio_stats.memsearch.MemorySearchClient`. For each concurrency
+the benchmark reports:
+
+- ``p50_ms``, ``p90_ms`` and ``p99_ms``: percentiles of the requests latency,
+- ``requests_per_s``: throughput,
+- ``<stage>_ms``: mean duration of each processing stage of the server, as
+  reported by its ``Server-Timing`` header (see
+  :data:`~invenio_stats.config.STATS_SERVER_TIMING`).
+
+Requests recorded in production can be replayed instead of the synthetic
+mix, from a file containing one JSON request body per line:
+
+.. code-block:: console
+
+   $ python -m benchmarks.bench_rest --replay requests.jsonl
+"""
+
+from __future__ import absolute_import, print_function
+
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+
+from flask import Flask
+from invenio_cache import InvenioCache
+
+from invenio_stats import InvenioStats
+from invenio_stats.views import blueprint
+
+from .baselines import main
+from .bench_aggregate import START_DATE, create_aggregator, create_dataset
+from .generator import EventGenerator, ZipfSampler
+
+RECORDS = 1000
+EVENTS_PER_DAY = 5000
+DAYS = 7
+REQUESTS = 2000
+
+HEADERS = [('Content-Type', 'application/json'),
+           ('Accept', 'application/json')]
+
+
+def create_app(client):
+    """Create the application serving the statistics of a search client."""
+    app = Flask('bench')
+    app.config.update(
+        CACHE_TYPE='simple',
+        STATS_REGISTER_RECEIVERS=False,
+        STATS_EVENTS={},
+        STATS_AGGREGATIONS={},
+        STATS_QUERIES={'bucket-file-download-histogram': {},
+                       'bucket-file-download-total': {}},
+        STATS_SEARCH_CLIENT=client,
+        STATS_SERVER_TIMING=True,
+    )
+    InvenioCache(app)
+    InvenioStats(app)
+    app.register_blueprint(blueprint)
+    return app
+
+
+def create_client():
+    """Create a search client holding aggregated downloads."""
+    client = create_dataset(RECORDS, EVENTS_PER_DAY, DAYS)
+    create_aggregator(client, batch_size=DAYS).run(
+        START_DATE, START_DATE + datetime.timedelta(days=DAYS - 1),
+        update_bookmark=False)
+    return client
+
+
+def synthetic_requests(count, histogram_ratio=0.5, seed=0):
+    """Generate the bodies of requests for popular buckets."""
+    rng = random.Random(seed)
+    # The same seed as the dataset gives the same records
+    records = EventGenerator(seed=42, records=RECORDS).records
+    pick_record = ZipfSampler(rng, len(records))
+    requests = []
+    for _ in range(count):
+        record = records[pick_record()]
+        bucket_id = record['bucket_id']
+        if rng.random() < histogram_ratio:
+            start = START_DATE + datetime.timedelta(
+                days=rng.randrange(DAYS))
+            end = start + datetime.timedelta(days=rng.randrange(DAYS))
+            body = dict(histogram=dict(
+                stat='bucket-file-download-histogram',
+                params=dict(bucket_id=bucket_id,
+                            file_key=rng.choice(record['files'])[1],
+                            interval='day', start_date=start.isoformat(),
+                            end_date=end.isoformat())))
+        else:
+            body = dict(total=dict(stat='bucket-file-download-total',
+                                   params=dict(bucket_id=bucket_id)))
+        requests.append(json.dumps(body))
+    return requests
+
+
+def recorded_requests(path):
+    """Read the recorded bodies of requests."""
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def parse_server_timing(header):
+    """Parse a ``Server-Timing`` header into a dict of durations."""
+    timings = {}
+    for timing in header.split(','):
+        name, _, duration = timing.strip().partition(';dur=')
+        timings[name] = float(duration)
+    return timings
+
+
+def percentile(values, fraction):
+    """Get the nearest-rank percentile of sorted values."""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def load(app, requests, concurrency):
+    """Send requests from concurrent clients.
+
+    :returns: the latencies of the requests, their server timings and the
+        total duration.
+    """
+    pending = iter(requests)
+    lock = threading.Lock()
+    latencies = []
+    timings = []
+    errors = []
+
+    def worker():
+        with app.test_client() as client:
+            while True:
+                with lock:
+                    body = next(pending, None)
+                if body is None:
+                    return
+                start = time.time()
+                response = client.post('/stats', headers=HEADERS, data=body)
+                latency = time.time() - start
+                with lock:
+                    if response.status_code != 200:
+                        errors.append(response.status_code)
+                        continue
+                    latencies.append(latency)
+                    timings.append(parse_server_timing(
+                        response.headers.get('Server-Timing', '')))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+    if errors:
+        raise RuntimeError('{0} requests failed, e.g. with status {1}'.format(
+            len(errors), errors[0]))
+    return latencies, timings, duration
+
+
+def add_arguments(parser):
+    """Add the options of the load test."""
+    parser.add_argument('--concurrency', default=[1, 4, 16],
+                        type=lambda v: [int(c) for c in v.split(',')],
+                        help='numbers of concurrent clients, e.g. 1,4,16')
+    parser.add_argument('--requests', type=int, default=REQUESTS,
+                        help='number of synthetic requests')
+    parser.add_argument('--histogram-ratio', type=float, default=0.5,
+                        help='ratio of the synthetic histogram requests')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='replay the recorded request bodies of a file')
+
+
+def run(args):
+    """Run the benchmark."""
+    if args.replay:
+        requests = recorded_requests(args.replay)
+    else:
+        requests = synthetic_requests(args.requests, args.histogram_ratio)
+    app = create_app(create_client())
+    # Load the configurations and warm the caches outside of the measures
+    load(app, requests[:10], 1)
+    results = {}
+    for concurrency in args.concurrency:
+        latencies, timings, duration = load(app, requests, concurrency)
+        latencies.sort()
+        prefix = 'concurrency={}.'.format(concurrency)
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            results[prefix + name + '_ms'] = \
+                percentile(latencies, fraction) * 1000
+        results[prefix + 'requests_per_s'] = len(latencies) / duration
+        stages = set(stage for timing in timings for stage in timing)
+        for stage in stages:
+            results['{0}{1}_ms'.format(prefix, stage)] = sum(
+                timing.get(stage, 0) for timing in timings) / len(timings)
+        print('.', end='', file=sys.stderr)
+    print(file=sys.stderr)
+    return results
+
+
+if __name__ == '__main__':
+    main('rest', run, higher_is_better=['.requests_per_s'],
+         add_arguments=add_arguments)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Seeded generator of synthetic statistics events.
+
+The generated events have the fields of the events emitted by the
+``file-download`` and ``record-view`` event builders. Records are picked with
+a Zipf distribution, so that a few records receive most of the events, and
+the events are emitted by a fixed population of visitors, a part of which are
+robots and machines. The same seed always generates the same events.
+"""
+
+from __future__ import absolute_import, print_function
+
+import bisect
+import datetime
+import random
+import uuid
+
+BROWSER_USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/69.0.3497.100 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_6) AppleWebKit/605.1.15 '
+    '(KHTML, like Gecko) Version/12.0 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101 '
+    'Firefox/62.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 12_0 like Mac OS X) '
+    'AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.0 Mobile/15E148 '
+    'Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 8.0.0; SM-G960F) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/69.0.3497.100 Mobile Safari/537.36',
+]
+"""User agents of human visitors."""
+
+ROBOT_USER_AGENTS = [
+    'Mozilla/5.0 (compatible; Googlebot/2.1; '
+    '+http://www.google.com/bot.html)',
+    'Mozilla/5.0 (compatible; bingbot/2.0; '
+    '+http://www.bing.com/bingbot.htm)',
+    'Mozilla/5.0 (compatible; YandexBot/3.0; '
+    '+http://yandex.com/bots)',
+]
+"""User agents of robots."""
+
+MACHINE_USER_AGENTS = [
+    'python-requests/2.19.1',
+    'curl/7.58.0',
+    'Wget/1.19.4 (linux-gnu)',
+]
+"""User agents of machines, e.g. scripts."""
+
+REFERRERS = [
+    None,
+    'https://www.google.com/',
+    'https://scholar.google.com/',
+    'https://twitter.com/',
+]
+"""Referrers of the events."""
+
+
+class ZipfSampler(object):
+    """Pick integers in ``[0, n)`` following a Zipf distribution."""
+
+    def __init__(self, rng, n, exponent=1.1):
+        """Constructor.
+
+        :param rng: random number generator.
+        :param n: number of values.
+        :param exponent: exponent of the distribution. Higher exponents
+            concentrate the picks on fewer values.
+        """
+        self.rng = rng
+        self.cumulative_weights = []
+        total = 0.0
+        for rank in range(1, n + 1):
+            total += 1.0 / rank ** exponent
+            self.cumulative_weights.append(total)
+
+    def __call__(self):
+        """Pick a value."""
+        return bisect.bisect_left(
+            self.cumulative_weights,
+            self.rng.random() * self.cumulative_weights[-1])
+
+
+class EventGenerator(object):
+    """Generate synthetic ``file-download`` and ``record-view`` events."""
+
+    def __init__(self, seed=0, records=10000, files_per_record=3,
+                 visitors=5000, authenticated_ratio=0.2, robots_ratio=0.1,
+                 machines_ratio=0.05, zipf_exponent=1.1,
+                 start_date=datetime.datetime(2018, 1, 1),
+                 events_per_day=100000):
+        """Constructor.
+
+        :param seed: seed of the random number generator.
+        :param records: number of distinct records.
+        :param files_per_record: number of files of each record.
+        :param visitors: number of distinct visitors.
+        :param authenticated_ratio: ratio of the human visitors who are
+            logged in.
+        :param robots_ratio: ratio of the visitors which are robots.
+        :param machines_ratio: ratio of the visitors which are machines.
+        :param zipf_exponent: exponent of the records popularity distribution.
+        :param start_date: timestamp of the first event.
+        :param events_per_day: average number of events per day.
+        """
+        self.rng = random.Random(seed)
+        self.records = [
+            dict(record_id=str(uuid.UUID(int=self.rng.getrandbits(128))),
+                 pid_value=str(i + 1),
+                 bucket_id=str(uuid.UUID(int=self.rng.getrandbits(128))),
+                 files=[(str(uuid.UUID(int=self.rng.getrandbits(128))),
+                         'file-{}.pdf'.format(j),
+                         self.rng.randint(1024, 100 * 1024 * 1024))
+                        for j in range(files_per_record)])
+            for i in range(records)
+        ]
+        self.pick_record = ZipfSampler(self.rng, records, zipf_exponent)
+        self.visitors = [
+            self._make_visitor(authenticated_ratio, robots_ratio,
+                               machines_ratio)
+            for _ in range(visitors)
+        ]
+        self.pick_visitor = ZipfSampler(self.rng, visitors, 0.8)
+        self.timestamp = start_date
+        self.mean_interval = 24 * 60 * 60.0 / events_per_day
+
+    def _make_visitor(self, authenticated_ratio, robots_ratio,
+                      machines_ratio):
+        """Make a visitor with its IP address and user agent."""
+        kind = self.rng.random()
+        if kind < robots_ratio:
+            user_agent = self.rng.choice(ROBOT_USER_AGENTS)
+        elif kind < robots_ratio + machines_ratio:
+            user_agent = self.rng.choice(MACHINE_USER_AGENTS)
+        else:
+            user_agent = self.rng.choice(BROWSER_USER_AGENTS)
+        human = kind >= robots_ratio + machines_ratio
+        return dict(
+            ip_address='{0}.{1}.{2}.{3}'.format(
+                self.rng.randint(1, 223), self.rng.randint(0, 255),
+                self.rng.randint(0, 255), self.rng.randint(1, 254)),
+            user_agent=user_agent,
+            user_id=str(self.rng.randint(1, 10 ** 6))
+            if human and self.rng.random() < authenticated_ratio else None,
+            session_id=uuid.UUID(int=self.rng.getrandbits(128)).hex
+            if human else None,
+        )
+
+    def _next_timestamp(self):
+        """Get the timestamp of the next event."""
+        self.timestamp += datetime.timedelta(
+            seconds=self.rng.expovariate(1 / self.mean_interval))
+        return self.timestamp.isoformat()
+
+    def _base_event(self):
+        """Make the fields shared by all the events."""
+        event = dict(timestamp=self._next_timestamp(),
+                     referrer=self.rng.choice(REFERRERS))
+        event.update(self.visitors[self.pick_visitor()])
+        return event
+
+    def file_download(self):
+        """Generate a ``file-download`` event."""
+        record = self.records[self.pick_record()]
+        file_id, file_key, size = self.rng.choice(record['files'])
+        event = self._base_event()
+        event.update(bucket_id=record['bucket_id'], file_id=file_id,
+                     file_key=file_key, size=size)
+        return event
+
+    def record_view(self):
+        """Generate a ``record-view`` event."""
+        record = self.records[self.pick_record()]
+        event = self._base_event()
+        event.update(record_id=record['record_id'], pid_type='recid',
+                     pid_value=record['pid_value'])
+        return event
+
+    def events(self, event_type, count):
+        """Generate a list of events of an event type."""
+        make_event = getattr(self, event_type.replace('-', '_'))
+        return [make_event() for _ in range(count)]
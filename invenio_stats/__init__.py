@@ -214,6 +214,13 @@ It is possible to pass as a parameter a time window in seconds (10s by
 default) within which, multiple events from the same user to the resource will
 count as 1, allowing for more accurate statistics.
 
+Robot and machine events, i.e. events flagged by the ``flag_robots`` and
+``flag_machines`` preprocessors, are indexed like the other events and filtered
+out by the aggregations. With the ``drop_robots=True`` option they are instead
+discarded before indexing and only their number is kept, in one counter
+document per day, which can be read with
+:py:meth:`~invenio_stats.processors.EventsIndexer.get_robot_counts`.
+
 After the processing has taken place the event is indexed in Elasticsearch,
 according to the template provided in the event registration. The index is
 under the alias **events-stats-file-download**. It is also possible to index
@@ -412,6 +419,27 @@ see Elasticsearch documentation). The ``key-type`` field is used as a helper
 for UI widgets so that they know how they can display the statistic
 automatically.
 
+The :py:class:`~invenio_stats.queries.ESBulkTermsQuery` query class computes
+a statistic for a list of identifiers (e.g. the records of a search result
+page) in a single aggregation. It takes an ``ids`` parameter and returns a
+compact map of identifier to metrics:
+
+.. code-block:: json
+
+    {
+        "<CUSTOM-QUERY-NAME>": {
+            "field": "record_id",
+            "key_type": "terms",
+            "results": {
+                "<ID1>": {"value": 42},
+                "<ID2>": {"value": 0}
+            }
+        }
+    }
+
+The same result can be obtained from Python, e.g. in a record serializer, with
+:py:func:`~invenio_stats.queries.get_bulk_statistics`.
+
 Not every statistic of interest has to be derived from Elasticsearch. It is
 possible to return statistics by just running an SQL query on the database.
 
@@ -11,13 +11,20 @@
 from __future__ import absolute_import, print_function
 
 import datetime
-from collections import OrderedDict
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import islice
 
 import six
-from dateutil import parser
-from elasticsearch.helpers import bulk
-from elasticsearch_dsl import Index, Search
-from invenio_search import current_search_client
+
+from .cache import bump_aggregation_stamp
+from .counters import counter_store_path, get_counter_store_dir, \
+    patch_counter_store, write_counter_store
+from .status import set_aggregated_until, set_aggregation_run
+from .tracing import trace_client
+from .utils import get_event_indices, get_search_client, \
+    get_time_based_indices
 
 
 def filter_robots(query):
@@ -54,6 +61,12 @@ class StatAggregator(object):
 
     This aggregator saves a bookmark document after each run. This bookmark
     is used to aggregate new events without having to redo the old ones.
+
+    The aggregators are built once per process and shared, see
+    :meth:`invenio_stats.ext._InvenioStatsState.get_aggregator`. The state of
+    a run is kept in the attributes of the aggregator, thus it is reset at the
+    start of :meth:`run` and concurrent runs are serialized. The other methods
+    changing this state, like :meth:`agg_iter`, are not thread-safe.
     """
 
     def __init__(self, name, event, client=None,
@@ -62,7 +75,10 @@ class StatAggregator(object):
                  copy_fields=None,
                  query_modifiers=None,
                  aggregation_interval='month',
-                 index_interval='month', batch_size=7):
+                 index_interval='month', batch_size=7,
+                 event_index_suffix='%Y-%m-%d', routing_field=None,
+                 weight_field='weight', totals_fields=None,
+                 totals_parent_fields=None):
         """Construct aggregator instance.
 
         :param event: aggregated event.
@@ -82,9 +98,37 @@ class StatAggregator(object):
         :param batch_size: max number of days for which raw events are being
             fetched in one query. This number has to be coherent with the
             aggregation_interval.
+        :param event_index_suffix: suffix of the raw events indices' name. It
+            has to be the same as the ``suffix`` of the events indexer.
+        :param routing_field: field of the aggregation documents used as
+            routing value, e.g. ``bucket_id``. It has to be the
+            ``aggregation_field`` or a destination of the ``copy_fields``.
+            Queries filtering on this field then only hit one shard, the
+            documents without it not being routed. Changing it on existing
+            indices would duplicate the aggregation documents in different
+            shards.
+        :param weight_field: field of the events containing their sampling
+            weight. The ``count`` of an aggregation is the sum of the weights
+            of its events, an event without weight counting as one. It is
+            not rounded, so that the queries summing the counts do not add
+            up rounding errors. The ``sum`` metric aggregations are scaled by
+            the average weight of the events of the aggregation, which is
+            exact when the summed field has the same value in all of them,
+            e.g. the size of a file. The other metric aggregations are not
+            weighted. Set to ``None`` to count events.
+        :param totals_fields: fields of the aggregation documents summed over
+            all time in the ``stats-totals-<event>`` index, e.g.
+            ``['count', 'volume']``. The totals are updated with the changes
+            of each run and read by
+            :class:`~invenio_stats.queries.ESTotalsQuery`. Disabled when
+            ``None``.
+        :param totals_parent_fields: fields of the aggregation documents for
+            which totals are kept as well, e.g. ``['bucket_id']``.
         """
         self.name = name
-        self.client = client or current_search_client
+        self.client = trace_client(
+            client if client is not None else get_search_client(),
+            'aggregator', name)
         self.event = event
         self.aggregation_alias = 'stats-{}'.format(self.event)
         self.aggregation_field = aggregation_field
@@ -117,6 +161,25 @@ class StatAggregator(object):
         self.doc_id_suffix = self.supported_intervals[aggregation_interval]
         self.batch_size = batch_size
         self.event_index = 'events-stats-{}'.format(self.event)
+        self.event_index_suffix = event_index_suffix
+        if routing_field and routing_field != aggregation_field and \
+                routing_field not in self.copy_fields:
+            raise ValueError('Routing field should be the aggregation field '
+                             'or one of the copied fields')
+        self.routing_field = routing_field
+        self.weight_field = weight_field
+        self.totals_fields = totals_fields or []
+        self.totals_parent_fields = totals_parent_fields or []
+        self._run_lock = threading.Lock()
+        self._reset_run_state()
+
+    def _reset_run_state(self):
+        """Forget the state of the previous run."""
+        self.indices = set()
+        self.new_bookmark = None
+        self.last_index_written = None
+        self.agg_query = None
+        self.aggregated_until = None
 
     @property
     def bookmark_doc_type(self):
@@ -129,25 +192,44 @@ class StatAggregator(object):
         return '{0}-{1}-aggregation'.format(
             self.event, self.aggregation_interval)
 
+    @property
+    def totals_index(self):
+        """Get the index of the aggregation's totals."""
+        return 'stats-totals-{0}'.format(self.event)
+
+    @property
+    def totals_doc_type(self):
+        """Get document type for the aggregation's totals."""
+        return '{0}-total'.format(self.event)
+
+    def _get_event_indices(self):
+        """Get the names of the existing raw events indices."""
+        return get_event_indices(self.client, self.event_index)
+
     def _get_oldest_event_timestamp(self):
         """Search for the oldest event timestamp."""
+        from dateutil import parser
+        from elasticsearch_dsl import Search
         # Retrieve the oldest event in order to start aggregation
-        # from there
-        query_events = Search(
-            using=self.client,
-            index=self.event_index
-        )[0:1].sort(
-            {'timestamp': {'order': 'asc'}}
-        )
-        result = query_events.execute()
+        # from there. Events indices are named after their date, thus the
+        # oldest event is in the first non-empty index.
+        for index in self._get_event_indices():
+            query_events = Search(
+                using=self.client,
+                index=index
+            )[0:1].sort(
+                {'timestamp': {'order': 'asc'}}
+            )
+            result = query_events.execute()
+            if len(result) > 0:
+                return parser.parse(result[0]['timestamp'])
         # There might not be any events yet if the first event have been
         # indexed but the indices have not been refreshed yet.
-        if len(result) == 0:
-            return None
-        return parser.parse(result[0]['timestamp'])
+        return None
 
     def get_bookmark(self):
         """Get last aggregation date."""
+        from elasticsearch_dsl import Index, Search
         if not Index(self.aggregation_alias,
                      using=self.client).exists():
             if not Index(self.event_index,
@@ -176,6 +258,8 @@ class StatAggregator(object):
 
     def set_bookmark(self):
         """Set bookmark for starting next aggregation."""
+        from elasticsearch.helpers import bulk
+
         def _success_date():
             bookmark = {
                 'date': self.new_bookmark or datetime.datetime.utcnow().
@@ -189,6 +273,17 @@ class StatAggregator(object):
             bulk(self.client,
                  _success_date(),
                  stats_only=True)
+            bump_aggregation_stamp(self.name)
+            if self.new_bookmark:
+                # The aggregation interval of the bookmark is aggregated up
+                # to the time of the aggregation query, the following ones
+                # not at all.
+                bookmark = datetime.datetime.strptime(self.new_bookmark,
+                                                      self.doc_id_suffix)
+                until = self._next_interval_dt(self._truncate_dt(bookmark))
+                if self.aggregated_until is not None:
+                    until = min(until, self.aggregated_until)
+                set_aggregated_until(self.name, until)
 
     def _format_range_dt(self, d):
         """Format range filter datetime to the closest aggregation interval."""
@@ -197,15 +292,64 @@ class StatAggregator(object):
         return '{0}||/{1}'.format(
             d, self.dt_rounding_map[self.aggregation_interval])
 
+    def _get_window_event_indices(self, lower_limit, upper_limit):
+        """Get the existing raw events indices of an aggregation window."""
+        from dateutil import parser
+        lower, upper = [
+            parser.parse(d) if isinstance(d, six.string_types) else d
+            for d in (lower_limit, upper_limit)
+        ]
+        # The range filter rounds the limits to the aggregation interval.
+        lower = self._truncate_dt(lower)
+        upper = self._next_interval_dt(self._truncate_dt(upper)) - \
+            datetime.timedelta(microseconds=1)
+        existing = set(self._get_event_indices())
+        return [i for i in get_time_based_indices(
+            self.event_index, self.event_index_suffix, lower, upper)
+            if i in existing]
+
+    def _truncate_dt(self, d):
+        """Truncate a datetime to the start of its aggregation interval."""
+        d = datetime.datetime(d.year, d.month, d.day,
+                              getattr(d, 'hour', 0))
+        if self.aggregation_interval == 'hour':
+            return d
+        d = d.replace(hour=0)
+        if self.aggregation_interval == 'day':
+            return d
+        d = d.replace(day=1)
+        if self.aggregation_interval == 'month':
+            return d
+        return d.replace(month=1)
+
+    def _next_interval_dt(self, d):
+        """Get the start of the aggregation interval following a datetime."""
+        if self.aggregation_interval == 'hour':
+            return d + datetime.timedelta(hours=1)
+        elif self.aggregation_interval == 'day':
+            return d + datetime.timedelta(days=1)
+        elif self.aggregation_interval == 'month':
+            return d.replace(year=d.year + d.month // 12,
+                             month=d.month % 12 + 1)
+        return d.replace(year=d.year + 1)
+
     def agg_iter(self, lower_limit=None, upper_limit=None):
         """Aggregate and return dictionary to be indexed in ES."""
+        from elasticsearch_dsl import Search
         lower_limit = lower_limit or self.get_bookmark().isoformat()
         upper_limit = upper_limit or (
             datetime.datetime.utcnow().replace(microsecond=0).isoformat())
-        aggregation_data = {}
+
+        # Only search the daily events indices of the aggregation window
+        event_indices = self._get_window_event_indices(lower_limit,
+                                                       upper_limit)
+        if not event_indices:
+            self.last_index_written = None
+            return
 
         self.agg_query = Search(using=self.client,
-                                index=self.event_index).\
+                                index=event_indices).\
+            params(ignore_unavailable=True).\
             filter('range', timestamp={
                 'gte': self._format_range_dt(lower_limit),
                 'lte': self._format_range_dt(upper_limit)})
@@ -228,6 +372,9 @@ class StatAggregator(object):
         )
         for dst, (metric, src, opts) in self.metric_aggregation_fields.items():
             terms.metric(dst, metric, field=src, **opts)
+        if self.weight_field:
+            terms.metric('weighted_count', 'sum', field=self.weight_field,
+                         missing=1)
 
         results = self.agg_query.execute()
         index_name = None
@@ -235,13 +382,25 @@ class StatAggregator(object):
             interval_date = datetime.datetime.strptime(
                 interval['key_as_string'], '%Y-%m-%dT%H:%M:%S')
             for aggregation in interval['terms'].buckets:
+                aggregation_data = {}
                 aggregation_data['timestamp'] = interval_date.isoformat()
                 aggregation_data[self.aggregation_field] = aggregation['key']
-                aggregation_data['count'] = aggregation['doc_count']
+                scale = 1
+                if self.weight_field:
+                    weighted_count = aggregation['weighted_count']['value']
+                    aggregation_data['count'] = weighted_count
+                    if aggregation['doc_count']:
+                        scale = weighted_count / aggregation['doc_count']
+                else:
+                    aggregation_data['count'] = aggregation['doc_count']
 
                 if self.metric_aggregation_fields:
-                    for f in self.metric_aggregation_fields:
-                        aggregation_data[f] = aggregation[f]['value']
+                    for f, (metric, _, _) in \
+                            self.metric_aggregation_fields.items():
+                        value = aggregation[f]['value']
+                        if metric == 'sum' and value is not None:
+                            value *= scale
+                        aggregation_data[f] = value
 
                 doc = aggregation.top_hit.hits.hits[0]['_source']
                 for destination, source in self.copy_fields.items():
@@ -258,17 +417,159 @@ class StatAggregator(object):
                                     interval_date.strftime(
                                         self.index_name_suffix))
                 self.indices.add(index_name)
-                yield dict(_id='{0}-{1}'.
-                           format(aggregation['key'],
-                                  interval_date.strftime(
-                                      self.doc_id_suffix)),
-                           _index=index_name,
-                           _type=self.aggregation_doc_type,
-                           _source=aggregation_data)
+                action = dict(_id='{0}-{1}'.
+                              format(aggregation['key'],
+                                     interval_date.strftime(
+                                         self.doc_id_suffix)),
+                              _index=index_name,
+                              _type=self.aggregation_doc_type,
+                              _source=aggregation_data)
+                if self.routing_field and \
+                        aggregation_data.get(self.routing_field):
+                    action['_routing'] = aggregation_data[self.routing_field]
+                yield action
         self.last_index_written = index_name
 
+    def _add_to_totals(self, totals, doc, sign=1):
+        """Add the fields of an aggregation document to totals.
+
+        :param totals: dict of (key field, key) -> total document.
+        :param sign: ``-1`` to subtract the document.
+        """
+        keys = [(self.aggregation_field, doc[self.aggregation_field])] + [
+            (field, doc[field]) for field in self.totals_parent_fields
+            if doc.get(field) is not None
+        ]
+        for key_field, key in keys:
+            total = totals.get((key_field, key))
+            if total is None:
+                total = totals[(key_field, key)] = dict(
+                    key_field=key_field, key=key)
+                if key_field == self.aggregation_field:
+                    for field in self.totals_parent_fields:
+                        total[field] = doc.get(field)
+            for field in self.totals_fields:
+                total[field] = total.get(field, 0) + \
+                    sign * (doc.get(field) or 0)
+
+    def _track_totals(self, actions, pending, chunk_size=50):
+        """Fetch the previous aggregation documents while yielding the actions.
+
+        The previous version of each aggregation document is fetched before
+        it is overwritten, so that only the difference is added to the
+        totals. The new and previous sources of the documents are appended to
+        ``pending`` in the order of the actions, to be added to the totals
+        once the documents are written.
+        """
+        actions = iter(actions)
+        while True:
+            chunk = list(islice(actions, chunk_size))
+            if not chunk:
+                return
+            docs = []
+            for action in chunk:
+                doc = dict(_index=action['_index'], _type=action['_type'],
+                           _id=action['_id'])
+                if '_routing' in action:
+                    doc['_routing'] = action['_routing']
+                docs.append(doc)
+            previous = self.client.mget(body={'docs': docs})['docs']
+            for action, doc in zip(chunk, previous):
+                pending.append((action['_source'], doc['_source']
+                                if doc.get('found') else None))
+                yield action
+
+    def update_totals(self, deltas, chunk_size=500, patch_counters=True):
+        """Add changes to the totals documents.
+
+        :param deltas: dict of (key field, key) -> changes of the total.
+        :param patch_counters: update the local counter stores with the new
+            totals, if they are enabled.
+        """
+        from elasticsearch.helpers import bulk
+        changed = [(key, delta) for key, delta in sorted(deltas.items())
+                   if any(delta[f] for f in self.totals_fields)]
+        updated = {}
+        for start in range(0, len(changed), chunk_size):
+            chunk = changed[start:start + chunk_size]
+            ids = ['{0}:{1}'.format(*key) for key, _ in chunk]
+            current = self.client.mget(
+                index=self.totals_index, doc_type=self.totals_doc_type,
+                body={'ids': ids})['docs']
+            actions = []
+            for (key, delta), doc_id, doc in zip(chunk, ids, current):
+                total = doc['_source'] if doc.get('found') else {}
+                for field, value in delta.items():
+                    if field in self.totals_fields:
+                        total[field] = total.get(field, 0) + value
+                    else:
+                        total[field] = value
+                updated.setdefault(key[0], {})[key[1]] = total
+                actions.append(dict(_index=self.totals_index,
+                                    _type=self.totals_doc_type,
+                                    _id=doc_id, _source=total))
+            bulk(self.client, actions, stats_only=True)
+        directory = get_counter_store_dir()
+        if patch_counters and directory:
+            for key_field, totals in updated.items():
+                patch_counter_store(
+                    counter_store_path(directory, self.totals_index,
+                                       key_field),
+                    self.totals_fields, totals)
+
+    def rebuild_totals(self):
+        """Compute again the totals from all the aggregation documents."""
+        from elasticsearch.exceptions import NotFoundError
+        from elasticsearch_dsl import Search
+        totals = {}
+        try:
+            for doc in Search(using=self.client,
+                              index=self.aggregation_alias,
+                              doc_type=self.aggregation_doc_type).scan():
+                self._add_to_totals(totals, doc.to_dict())
+        except NotFoundError:
+            pass
+        self.client.indices.delete(index=self.totals_index, ignore=404)
+        self.update_totals(totals, patch_counters=False)
+        self.rebuild_counter_stores()
+
+    def rebuild_counter_stores(self):
+        """Write again the local counter stores from the totals index.
+
+        The counter stores are local to a host: the stores of the hosts
+        which do not run the aggregations are refreshed by calling this
+        method, e.g. with ``invenio stats aggregations rebuild-counters``.
+        """
+        from elasticsearch.exceptions import NotFoundError
+        from elasticsearch_dsl import Search
+        directory = get_counter_store_dir()
+        if not directory:
+            return
+        key_fields = [self.aggregation_field] + self.totals_parent_fields
+        totals = dict((key_field, {}) for key_field in key_fields)
+        try:
+            for doc in Search(using=self.client, index=self.totals_index,
+                              doc_type=self.totals_doc_type).scan():
+                doc = doc.to_dict()
+                if doc.get('key_field') in totals:
+                    totals[doc['key_field']][doc['key']] = doc
+        except NotFoundError:
+            pass
+        for key_field, key_totals in totals.items():
+            write_counter_store(
+                counter_store_path(directory, self.totals_index, key_field),
+                self.totals_fields, key_totals)
+
     def run(self, start_date=None, end_date=None, update_bookmark=True):
         """Calculate statistics aggregations."""
+        with self._run_lock:
+            self._reset_run_state()
+            return self._run(start_date, end_date, update_bookmark)
+
+    def _run(self, start_date, end_date, update_bookmark):
+        """Calculate statistics aggregations, holding the run lock."""
+        from elasticsearch.helpers import BulkIndexError, streaming_bulk
+        from elasticsearch_dsl import Index
         # If no events have been indexed there is nothing to aggregate
         if not Index(self.event_index, using=self.client).exists():
             return
@@ -283,20 +584,52 @@ class StatAggregator(object):
                 lower_limit + datetime.timedelta(self.batch_size),
                 datetime.datetime.min.time())
         )
+        started_at = time.time()
+        documents = 0
         while upper_limit <= datetime.datetime.utcnow():
             self.indices = set()
             self.new_bookmark = upper_limit.strftime(self.doc_id_suffix)
-            bulk(self.client,
-                 self.agg_iter(lower_limit, upper_limit),
-                 stats_only=True,
-                 chunk_size=50)
+            # Events indexed after the query starts are not aggregated.
+            self.aggregated_until = \
+                datetime.datetime.utcnow().replace(microsecond=0)
+            actions = self.agg_iter(lower_limit, upper_limit)
+            deltas = {}
+            pending = deque()
+            if self.totals_fields:
+                actions = self._track_totals(actions, pending)
+            errors = []
+            try:
+                for ok, item in streaming_bulk(self.client,
+                                               actions,
+                                               chunk_size=50,
+                                               raise_on_error=False):
+                    changes = pending.popleft() if pending else None
+                    if not ok:
+                        errors.append(item)
+                        continue
+                    documents += 1
+                    # Only the written documents change the totals
+                    if changes:
+                        source, previous = changes
+                        self._add_to_totals(deltas, source)
+                        if previous is not None:
+                            self._add_to_totals(deltas, previous, sign=-1)
+            finally:
+                if deltas:
+                    self.update_totals(deltas)
+            if errors:
+                raise BulkIndexError(
+                    '{} document(s) failed to index.'.format(len(errors)),
+                    errors)
             # Flush all indices which have been modified
-            current_search_client.indices.flush(
+            self.client.indices.flush(
                 index=','.join(self.indices),
                 wait_if_ongoing=True
             )
             if update_bookmark:
                 self.set_bookmark()
+            elif self.indices:
+                bump_aggregation_stamp(self.name)
             self.indices = set()
             lower_limit = lower_limit + datetime.timedelta(self.batch_size)
             upper_limit = min(
@@ -306,9 +639,11 @@ class StatAggregator(object):
             )
             if lower_limit > upper_limit:
                 break
+        set_aggregation_run(self.name, time.time() - started_at, documents)
 
     def list_bookmarks(self, start_date=None, end_date=None, limit=None):
         """List the aggregation's bookmarks."""
+        from elasticsearch_dsl import Search
         query = Search(
             using=self.client,
             index=self.aggregation_alias,
@@ -329,6 +664,8 @@ class StatAggregator(object):
 
     def delete(self, start_date=None, end_date=None):
         """Delete aggregation documents."""
+        from elasticsearch.helpers import bulk
+        from elasticsearch_dsl import Search
         aggs_query = Search(
             using=self.client,
             index=self.aggregation_alias,
@@ -359,10 +696,16 @@ class StatAggregator(object):
                 affected_indices = set()
                 for doc in query.scan():
                     affected_indices.add(doc.meta.index)
-                    yield dict(_index=doc.meta.index,
-                               _op_type='delete',
-                               _id=doc.meta.id,
-                               _type=doc.meta.doc_type)
-                current_search_client.indices.flush(
+                    action = dict(_index=doc.meta.index,
+                                  _op_type='delete',
+                                  _id=doc.meta.id,
+                                  _type=doc.meta.doc_type)
+                    if 'routing' in doc.meta:
+                        action['_routing'] = doc.meta.routing
+                    yield action
+                self.client.indices.flush(
                     index=','.join(affected_indices), wait_if_ongoing=True)
         bulk(self.client, _delete_actions(), refresh=True)
+        if self.totals_fields:
+            self.rebuild_totals()
+        bump_aggregation_stamp(self.name)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Buffers publishing events in batches."""
+
+from __future__ import absolute_import, print_function
+
+import atexit
+import threading
+from collections import OrderedDict
+
+from flask import after_this_request, current_app, g, has_request_context
+
+from .proxies import current_stats
+
+
+def _publish_batches(app, batches):
+    """Publish batches of events, grouped by event type."""
+    with app.app_context():
+        for event_type, events in batches.items():
+            try:
+                current_stats.publish(event_type, events)
+            except Exception:
+                app.logger.exception(u'Error while publishing events')
+
+
+class EventBuffer(object):
+    """Process-level buffer of events.
+
+    Events are published in batches once the buffer contains ``max_size``
+    events or its oldest event is ``timeout`` seconds old. The remaining
+    events are published when the process exits.
+    """
+
+    def __init__(self, app, max_size=100, timeout=5):
+        """Constructor.
+
+        :param app: Flask application used to publish the events.
+        :param max_size: number of events triggering a flush.
+        :param timeout: maximum time in seconds an event stays buffered.
+        """
+        self.app = app
+        self.max_size = max_size
+        self.timeout = timeout
+        self._events = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        atexit.register(self.flush)
+
+    def add(self, event_type, event):
+        """Buffer an event."""
+        batches = None
+        with self._lock:
+            self._events.setdefault(event_type, []).append(event)
+            self._size += 1
+            if self._size >= self.max_size:
+                batches = self._take()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.timeout, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if batches:
+            _publish_batches(self.app, batches)
+
+    def _take(self):
+        """Empty the buffer and return its content."""
+        batches, self._events, self._size = self._events, OrderedDict(), 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batches
+
+    def flush(self):
+        """Publish all the buffered events."""
+        with self._lock:
+            batches = self._take()
+        if batches:
+            _publish_batches(self.app, batches)
+
+    def __len__(self):
+        """Number of buffered events."""
+        return self._size
+
+
+def _request_events():
+    """Get the events buffered during the current request."""
+    if not hasattr(g, 'stats_events'):
+        g.stats_events = OrderedDict()
+        app = current_app._get_current_object()
+
+        @after_this_request
+        def _publish_after_response(response):
+            # Publish the events once the response has been sent so that
+            # the broker round-trip is not part of the request latency.
+            batches, g.stats_events = g.stats_events, OrderedDict()
+            if batches:
+                response.call_on_close(
+                    lambda: _publish_batches(app, batches))
+            return response
+    return g.stats_events
+
+
+def buffer_event(event_type, event):
+    """Buffer an event until it is published with other events.
+
+    In a request context, the events are published in one batch after the
+    response is sent. Otherwise they are added to the process-level buffer.
+    """
+    if has_request_context():
+        _request_events().setdefault(event_type, []).append(event)
+    else:
+        current_stats.event_buffer.add(event_type, event)
+
+
+def flush_request_events(exception=None):
+    """Publish the events of a request which were not published yet."""
+    batches = g.pop('stats_events', None)
+    if batches:
+        _publish_batches(current_app._get_current_object(), batches)
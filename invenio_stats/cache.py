@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Cache of statistics query results."""
+
+from __future__ import absolute_import, print_function
+
+import hashlib
+import json
+import uuid
+
+from invenio_cache import current_cache
+
+from .proxies import current_stats
+
+
+def _stamp_key(aggregation):
+    """Get the cache key of an aggregation invalidation stamp."""
+    return 'stats:agg_stamp:{}'.format(aggregation)
+
+
+def get_aggregation_stamp(aggregation):
+    """Get the current invalidation stamp of an aggregation."""
+    return current_cache.get(_stamp_key(aggregation)) or ''
+
+
+def bump_aggregation_stamp(aggregation):
+    """Advance the invalidation stamp of an aggregation.
+
+    Every cached query result computed from the aggregation becomes
+    unreachable and will be recomputed on the next request.
+    """
+    current_cache.set(_stamp_key(aggregation), uuid.uuid4().hex, timeout=0)
+
+
+class QueryResultCache(object):
+    """Cache of the results returned by the statistics REST API.
+
+    Results are stored in Invenio-Cache and keyed by the query name, the
+    normalized query parameters and the invalidation stamps of the
+    aggregations the query reads from. A stamp advances each time the
+    aggregation bookmark moves, so that results are never served once the
+    underlying aggregated documents have been rewritten.
+    """
+
+    def __init__(self, timeout=None, prefix='stats:query'):
+        """Constructor.
+
+        :param timeout: time to live of the cached results, in seconds.
+        :param prefix: prefix of the cache keys.
+        """
+        self.timeout = timeout
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._query_aggregations = {}
+
+    def query_aggregations(self, query_name):
+        """Get the names of the aggregations a query depends on.
+
+        They can be set explicitly with the ``aggregations`` key of the query
+        registration. Otherwise they are the aggregations writing into the
+        index read by the query.
+        """
+        if query_name not in self._query_aggregations:
+            query_cfg = current_stats.queries[query_name]
+            names = query_cfg.config.get('aggregations')
+            if names is None:
+                index = query_cfg.query_config.get('index')
+                names = [
+                    agg.name for agg in current_stats.aggregations.values()
+                    if index == 'stats-{}'.format(
+                        agg.aggregator_config.get('event'))
+                ]
+            self._query_aggregations[query_name] = sorted(names)
+        return self._query_aggregations[query_name]
+
+    def make_key(self, query_name, params):
+        """Build the cache key of a query result."""
+        stamps = [get_aggregation_stamp(a)
+                  for a in self.query_aggregations(query_name)]
+        normalized = json.dumps([params, stamps], sort_keys=True, default=str)
+        return '{0}:{1}:{2}'.format(
+            self.prefix, query_name,
+            hashlib.sha1(normalized.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """Get a cached query result.
+
+        :returns: the cached result or ``None`` if it is not cached.
+        """
+        result = current_cache.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def set(self, key, result):
+        """Cache a query result."""
+        current_cache.set(key, result, timeout=self.timeout)
+
+    @property
+    def metrics(self):
+        """Hit and miss counters of the current process."""
+        return dict(hits=self.hits, misses=self.misses)
@@ -10,15 +10,22 @@
 
 from __future__ import absolute_import, print_function
 
+import datetime
+import os
+import time
 from functools import wraps
 
 import click
 from dateutil.parser import parse as dateutil_parse
+from flask import current_app
 from flask.cli import with_appcontext
 from werkzeug.local import LocalProxy
 
+from .logs import LogImporter
 from .proxies import current_stats
-from .tasks import aggregate_events, process_events
+from .status import collect_status, get_status
+from .tasks import aggregate_events, process_events, \
+    rebuild_counter_stores
 
 
 def lazy_result(f):
@@ -91,6 +98,56 @@ def _events_process(event_types=None, eager=False):
         click.secho('Events processing task sent...', fg='yellow')
 
 
+@events.command('drain-spool')
+@click.option('--rate', '-r', type=int,
+              help='Maximum number of events published per second.')
+@click.option('--max-events', '-n', type=int)
+@with_appcontext
+def _events_drain_spool(rate=None, max_events=None):
+    """Publish the events of the spool of this host."""
+    if current_stats.spool is None:
+        raise click.UsageError('The events spool is not enabled.')
+    if rate is None:
+        rate = current_app.config['STATS_SPOOL_DRAIN_RATE']
+    count = current_stats.drain_spool(rate=rate, max_events=max_events)
+    click.secho('{} spooled events published.'.format(count), fg='green')
+
+
+@events.command('import-logs')
+@click.argument('log-files', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--processes', '-p', type=int,
+              help='Number of parsing processes.')
+@click.option('--chunk-size', default=10000,
+              help='Number of lines parsed at once.')
+@click.option('--state-file', type=click.Path(dir_okay=False),
+              help='File storing the import offsets.')
+@click.option('--restart', is_flag=True,
+              help='Import the files from their beginning.')
+@click.option('--salt', envvar='STATS_IMPORT_SALT',
+              help='Secret from which the anonymization salts are derived, '
+                   'to get the same visitor ids when importing again.')
+@with_appcontext
+def _events_import_logs(log_files, processes=None, chunk_size=None,
+                        state_file=None, restart=False, salt=None):
+    """Import events from web server access logs."""
+    state_file = state_file or \
+        current_app.config['STATS_LOG_IMPORT_STATE_FILE'] or \
+        os.path.join(current_app.instance_path, 'stats-log-import.json')
+    importer = LogImporter(
+        rules=[r for r in current_app.config['STATS_LOG_IMPORT_RULES']
+               if r['event_type'] in current_stats.events],
+        parsers=current_app.config['STATS_LOG_IMPORT_PARSERS'],
+        state_file=state_file,
+        processes=processes,
+        chunk_size=chunk_size,
+        salt=salt)
+    for log_file in log_files:
+        count = importer.import_file(log_file, restart=restart)
+        click.secho('{0}: {1} events imported.'.format(log_file, count),
+                    fg='green')
+
+
 @stats.group()
 def aggregations():
     """Aggregation management commands."""
@@ -135,10 +192,28 @@ def _aggregations_delete(aggregation_types=None,
     aggregation_types = (aggregation_types or
                          list(current_stats.enabled_aggregations))
     for a in aggregation_types:
-        aggr_cfg = current_stats.aggregations[a]
-        aggregator = aggr_cfg.aggregator_class(
-            name=aggr_cfg.name, **aggr_cfg.aggregator_config)
-        aggregator.delete(start_date, end_date)
+        current_stats.get_aggregator(a).delete(start_date, end_date)
+
+
+@aggregations.command('rebuild-totals')
+@aggr_arg
+@with_appcontext
+def _aggregations_rebuild_totals(aggregation_types=None):
+    """Compute again the all-time totals of aggregations."""
+    aggregation_types = (aggregation_types or
+                         list(current_stats.enabled_aggregations))
+    for a in aggregation_types:
+        aggregator = current_stats.get_aggregator(a)
+        if aggregator.totals_fields:
+            aggregator.rebuild_totals()
+
+
+@aggregations.command('rebuild-counters')
+@aggr_arg
+@with_appcontext
+def _aggregations_rebuild_counters(aggregation_types=None):
+    """Write again the local counter stores of aggregations."""
+    rebuild_counter_stores(aggregation_types or None)
 
 
 @aggregations.command('list-bookmarks')
@@ -153,10 +228,47 @@ def _aggregations_list_bookmarks(aggregation_types=None,
     aggregation_types = (aggregation_types or
                          list(current_stats.enabled_aggregations))
     for a in aggregation_types:
-        aggr_cfg = current_stats.aggregations[a]
-        aggregator = aggr_cfg.aggregator_class(
-            name=aggr_cfg.name, **aggr_cfg.aggregator_config)
-        bookmarks = aggregator.list_bookmarks(start_date, end_date, limit)
+        bookmarks = current_stats.get_aggregator(a).list_bookmarks(
+            start_date, end_date, limit)
         click.echo('{}:'.format(a))
         for b in bookmarks:
             click.echo(' - {}'.format(b.date))
+
+
+def _format_timestamp(timestamp, now):
+    """Format a timestamp and the time elapsed since then."""
+    if timestamp is None:
+        return 'unknown'
+    return '{0} ({1} ago)'.format(
+        datetime.datetime.utcfromtimestamp(int(timestamp)).isoformat(),
+        datetime.timedelta(seconds=int(now - timestamp)))
+
+
+@stats.command('status')
+@click.option('--no-cache', is_flag=True,
+              help='Collect the status instead of reading the cached one.')
+@with_appcontext
+def _status(no_cache=False):
+    """Show how far behind the statistics are."""
+    status = collect_status() if no_cache else get_status()
+    now = time.time()
+    click.echo('Events:')
+    for event_type, values in sorted(status['events'].items()):
+        click.echo(' - {}:'.format(event_type))
+        click.echo('   queued messages: {}'.format(
+            'unknown' if values['queue_messages'] is None
+            else values['queue_messages']))
+        click.echo('   newest event: {}'.format(
+            _format_timestamp(values['newest_event'], now)))
+    click.echo('Aggregations:')
+    for name, values in sorted(status['aggregations'].items()):
+        click.echo(' - {}:'.format(name))
+        click.echo('   bookmark: {}'.format(
+            _format_timestamp(values['bookmark'], now)))
+        click.echo('   last run: {}'.format(
+            _format_timestamp(values['last_run'], now)))
+        if values['last_run'] is not None:
+            click.echo('   last run duration: {:.1f}s'.format(
+                values['last_run_duration']))
+            click.echo('   last run documents: {}'.format(
+                values['last_run_documents']))
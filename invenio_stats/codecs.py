@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Compact encoding of the events sent through the statistics queues.
+
+A message encodes a batch of events. The keys of the events are stored once
+per message in a table and every event is a flat list of key indices and
+values. The message is serialized with MessagePack and optionally compressed
+with zlib, which removes most of the cost of repeated values such as user
+agents. The first byte of a message identifies its format.
+
+Plain JSON messages, i.e. one event per message, are still accepted by
+:func:`iter_events` so that queues can be migrated without being emptied.
+"""
+
+from __future__ import absolute_import, print_function
+
+import zlib
+
+from flask import current_app
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+CODECS = {
+    'msgpack': b'M',
+    'msgpack-zlib': b'Z',
+}
+"""Message format marker of each codec."""
+
+
+def _pack_events(events):
+    """Pack a batch of events with a shared keys table."""
+    keys = {}
+    rows = []
+    for event in events:
+        row = []
+        for key, value in event.items():
+            if key not in keys:
+                keys[key] = len(keys)
+            row.append(keys[key])
+            row.append(value)
+        rows.append(row)
+    table = [None] * len(keys)
+    for key, index in keys.items():
+        table[index] = key
+    return msgpack.packb([table, rows], use_bin_type=True)
+
+
+def _unpack_events(data):
+    """Unpack a batch of events packed by :func:`_pack_events`."""
+    table, rows = msgpack.unpackb(data, raw=False)
+    return [
+        dict((table[row[i]], row[i + 1]) for i in range(0, len(row), 2))
+        for row in rows
+    ]
+
+
+def encode_events(events, codec='msgpack', batch_size=100):
+    """Encode events into compact messages.
+
+    :param events: list of events.
+    :param codec: ``msgpack`` or ``msgpack-zlib``.
+    :param batch_size: maximum number of events per message.
+    :returns: list of messages.
+    """
+    if msgpack is None:
+        raise RuntimeError(
+            'The "msgpack" package is required by the {} codec.'.format(
+                codec))
+    marker = CODECS[codec]
+    messages = []
+    for i in range(0, len(events), batch_size):
+        data = _pack_events(events[i:i + batch_size])
+        if marker == CODECS['msgpack-zlib']:
+            data = zlib.compress(data)
+        messages.append(marker + data)
+    return messages
+
+
+def decode_events(message):
+    """Decode a message encoded by :func:`encode_events`.
+
+    :returns: list of events.
+    """
+    marker, data = message[:1], message[1:]
+    if marker == CODECS['msgpack-zlib']:
+        data = zlib.decompress(data)
+    elif marker != CODECS['msgpack']:
+        raise ValueError('Unknown events message format.')
+    return _unpack_events(data)
+
+
+def iter_events(messages):
+    """Iterate over the events of encoded or plain JSON messages."""
+    for message in messages:
+        if isinstance(message, bytes):
+            try:
+                events = decode_events(message)
+            except Exception:
+                current_app.logger.exception(u'Error while decoding events')
+                continue
+            for event in events:
+                yield event
+        else:
+            yield message
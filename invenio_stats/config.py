@@ -12,7 +12,8 @@ from __future__ import absolute_import, print_function
 
 from kombu import Exchange
 
-from .utils import default_permission_factory
+from .utils import default_events_permission_factory, \
+    default_metrics_permission_factory, default_permission_factory
 
 STATS_REGISTER_RECEIVERS = True
 """Enable the registration of signal receivers.
@@ -50,6 +51,89 @@ is the name of the emitted event.
 """
 
 
+STATS_PUBLISH_BUFFERED = False
+"""Publish the events emitted by the signal receivers in batches.
+
+Events emitted during a request are published in a single batch once the
+response has been sent, so that the message broker is not contacted while the
+user waits. Events emitted outside of a request (e.g. in Celery tasks) are
+buffered by the process and published every ``STATS_PUBLISH_BUFFER_SIZE``
+events or ``STATS_PUBLISH_BUFFER_TIMEOUT`` seconds.
+"""
+
+STATS_PUBLISH_BUFFER_SIZE = 100
+"""Number of events buffered by a process before they are published."""
+
+STATS_PUBLISH_BUFFER_TIMEOUT = 5
+"""Maximum time in seconds an event stays in the process-level buffer."""
+
+STATS_SAMPLING_RATES = {}
+"""Sampling rate of the emitted events, per event type.
+
+For example ``{'file-download': 0.5}`` emits one file download event out of
+two. Sampled events carry a ``weight`` field which the aggregations use to
+compute the counts.
+"""
+
+STATS_SAMPLING_ROBOTS_RATE = None
+"""Sampling rate of the events whose user agent is obviously a robot's.
+
+The check is a single regular expression, ``STATS_SAMPLING_ROBOTS_PATTERN``,
+so that it is cheap enough to run when the event is emitted. ``None``
+disables the robots sampling.
+"""
+
+STATS_SAMPLING_ROBOTS_PATTERN = (
+    r'bot|crawl|spider|slurp|archiver|curl|wget|python-requests|httpclient|'
+    r'scrapy|headless'
+)
+"""Regular expression matching the user agents of obvious robots."""
+
+STATS_SAMPLING_QUEUE_THRESHOLDS = []
+"""Sampling rates applied depending on the depth of the events queues.
+
+List of ``(queue size, sampling rate)`` tuples, where the queue size is a
+number of messages. For example ``[(100000, 0.5), (1000000, 0.1)]`` keeps half
+of the events once 100000 messages are pending in their queue, and one event
+out of ten from 1000000. Each message holds up to ``STATS_QUEUE_BATCH_SIZE``
+events when ``STATS_QUEUE_CODEC`` is set, thus the thresholds should then be
+divided by the size of the batches.
+"""
+
+STATS_SAMPLING_QUEUE_CHECK_INTERVAL = 10
+"""Time in seconds during which the size of a queue is not fetched again."""
+
+STATS_SPOOL_DIR = None
+"""Directory of the local spool of events which could not be published.
+
+When set, events are published with a timeout of
+``STATS_SPOOL_PUBLISH_TIMEOUT`` seconds and written to this directory if the
+message broker is unreachable or too slow. The directory is local to each
+host, and its spooled events are replayed on the same host with
+``invenio stats events drain-spool`` or the
+:func:`invenio_stats.tasks.drain_spooled_events` task routed to a queue of the
+host. The spool is disabled when set to ``None``.
+"""
+
+STATS_SPOOL_PUBLISH_TIMEOUT = 1
+"""Timeout in seconds of the broker operations before events are spooled."""
+
+STATS_SPOOL_RETRY_INTERVAL = 30
+"""Time in seconds during which events are spooled after a publish failure."""
+
+STATS_SPOOL_SEGMENT_SIZE = 1024 * 1024
+"""Size in bytes after which a spool segment is closed."""
+
+STATS_SPOOL_SEGMENT_AGE = 60
+"""Age in seconds after which a spool segment is closed and can be drained."""
+
+STATS_SPOOL_FSYNC_INTERVAL = 1
+"""Maximum time in seconds between two syncs of a spool segment to disk."""
+
+STATS_SPOOL_DRAIN_RATE = 1000
+"""Maximum number of spooled events replayed per second."""
+
+
 STATS_AGGREGATIONS = {
     'file-download-agg': {},
 }
@@ -58,9 +142,19 @@ STATS_AGGREGATIONS = {
 STATS_QUERIES = {
     'bucket-file-download-histogram': {},
     'bucket-file-download-total': {},
+    'bucket-file-download-bulk-total': {},
+    'file-download-all-time-total': {},
+    'bucket-file-download-all-time-total': {},
 }
 
 
+STATS_BULK_QUERY_MAX_IDS = 100
+"""Maximum number of identifiers accepted by a bulk statistic query.
+
+See :class:`invenio_stats.queries.ESBulkTermsQuery`.
+"""
+
+
 STATS_PERMISSION_FACTORY = default_permission_factory
 """Permission factory used by the statistics REST API.
 
@@ -75,9 +169,163 @@ access control mechanisms.
 """
 
 
+STATS_EVENTS_PERMISSION_FACTORY = default_events_permission_factory
+"""Permission factory used by the events ingestion REST API.
+
+It is of the form ``permission_factory(event_type)``. By default no one is
+allowed to send events.
+"""
+
+STATS_METRICS_PERMISSION_FACTORY = default_metrics_permission_factory
+"""Permission factory of the ``/stats/metrics`` endpoint.
+
+It is of the form ``permission_factory()``. By default nobody can read the
+metrics, which must be allowed e.g. for the monitoring system only.
+"""
+
+STATS_STATUS_CACHE_TIMEOUT = 30
+"""Time in seconds during which the collected status is reused.
+
+The status of the events and aggregations exported by the ``/stats/metrics``
+endpoint and the ``stats status`` command is cached, so that frequent scrapes
+do not load the cluster.
+"""
+
+STATS_EVENTS_MAX_CONTENT_LENGTH = 10 * 1024 * 1024
+"""Maximum size in bytes of a batch of events sent to the REST API."""
+
+STATS_EVENTS_MAX_BATCH_SIZE = 10000
+"""Maximum number of events in a batch sent to the REST API."""
+
+STATS_EVENTS_MAX_ERRORS = 100
+"""Maximum number of rejected events reported by the REST API."""
+
+STATS_LOG_IMPORT_RULES = [
+    dict(
+        event_type='file-download',
+        pattern=r'^/api/files/(?P<bucket_id>[0-9a-f-]{36})/'
+                r'(?P<file_key>[^?#]+)',
+        resolver='invenio_stats.contrib.event_builders:'
+                 'file_download_log_resolver',
+    ),
+    dict(
+        event_type='record-view',
+        pattern=r'^/records/(?P<pid_value>[^/?#]+)/?(?:[?#]|$)',
+        resolver='invenio_stats.contrib.event_builders:'
+                 'record_view_log_resolver',
+    ),
+]
+"""Rules converting the requests of access logs into events.
+
+The path of each successful ``GET`` request is matched against the
+``pattern`` of the rules, in order. The ``resolver`` of the first matching
+rule is called with the named groups of the pattern and returns the fields of
+the event, e.g. the ``file_id`` of a download, or ``None`` to skip it.
+"""
+
+STATS_LOG_IMPORT_PARSERS = [
+    'invenio_stats.logs:parse_combined_log',
+]
+"""Functions parsing the lines of access logs, tried in order."""
+
+STATS_LOG_IMPORT_STATE_FILE = None
+"""File storing the offsets of the imported access logs.
+
+Defaults to ``stats-log-import.json`` in the application instance folder.
+"""
+
+STATS_COUNTER_STORE_DIR = None
+"""Directory of the local counter stores of the all-time totals.
+
+When set, the aggregations keeping totals write them to memory-mapped files
+of this directory as well, which are read by
+:class:`invenio_stats.queries.LocalTotalsQuery` without requests to the
+search cluster. The stores of the hosts which do not run the aggregations are
+refreshed with ``invenio stats aggregations rebuild-counters`` or the
+:func:`invenio_stats.tasks.rebuild_counter_stores` task. The aggregations
+patch the stores by rewriting them, which costs O(number of keys in the
+store) per run. Disabled when set to ``None``.
+"""
+
+STATS_COUNTER_STORE_CHECK_INTERVAL = 1
+"""Time in seconds during which a counter store file is not checked again."""
+
+STATS_COUNTER_STORE_MAX_AGE = 2 * 60 * 60
+"""Age in seconds after which a counter store is not read anymore.
+
+The totals of a store which was not rebuilt or patched for this time are read
+from the search cluster instead, until the store is written again. It should
+be longer than the interval between two rebuilds of the stores. The stores are
+always read when set to ``None``.
+"""
+
+STATS_SEARCH_CLIENT = None
+"""Search client used by default by the indexers, aggregators and queries.
+
+It can be a client instance or its import path. Defaults to the client of
+Invenio-Search. :class:`invenio_stats.memsearch.MemorySearchClient` can be
+used to run the statistics without an Elasticsearch cluster, e.g. in tests
+and benchmarks.
+"""
+
+STATS_TRACING_SINK = None
+"""Function receiving the spans of the requests sent to the search cluster.
+
+The requests of the events indexers, the aggregators and the queries are
+traced when it is set, e.g. to ``'invenio_stats.tracing:log_span'``. See
+:mod:`invenio_stats.tracing` for the content of the spans. It can be a
+function or its import path.
+"""
+
+STATS_TRACING_SAMPLE_RATE = 1.0
+"""Ratio of the requests which are traced when the tracing is enabled."""
+
+STATS_SERVER_TIMING = False
+"""Report the duration of the statistics REST API processing stages.
+
+When ``True``, the responses of the statistics REST API carry a
+``Server-Timing`` header giving the milliseconds spent checking the
+permissions (``permission``), looking up the cached results (``cache``),
+building the queries (``build``), executing them (``search``) and processing
+their results (``process``).
+"""
+
+STATS_QUERY_CACHE = False
+"""Enable the caching of the statistics REST API results.
+
+Results are stored with Invenio-Cache and are invalidated as soon as the
+bookmark of one of the aggregations they are computed from moves.
+"""
+
+STATS_QUERY_CACHE_TIMEOUT = 60 * 60
+"""Time to live of the cached statistics results, in seconds."""
+
+
 STATS_MQ_EXCHANGE = Exchange(
     'events',
     type='direct',
     delivery_mode='transient',  # in-memory queue
 )
 """Default exchange used for the message queues."""
+
+STATS_QUEUE_CODEC = None
+"""Codec of the messages sent through the statistics queues.
+
+Set to ``'msgpack'`` or ``'msgpack-zlib'`` to send batches of events as
+compact MessagePack messages, optionally compressed with zlib, instead of one
+JSON message per event. It requires the ``msgpack`` package. JSON messages
+are still accepted by the events processors.
+"""
+
+STATS_QUEUE_BATCH_SIZE = 100
+"""Maximum number of events per message when a queue codec is set."""
+
+STATS_WORKER_WARM_UP = True
+"""Prepare the events and aggregations processing when a worker starts.
+
+When ``True``, every Celery worker process resolves the events, aggregations
+and queries configurations, builds the events indexers and aggregators reused
+by the tasks, opens the GeoIP database, compiles the robots detection regular
+expressions and loads the anonymization salt of the day as soon as it starts,
+instead of doing it while processing its first tasks.
+"""
@@ -13,6 +13,7 @@ from __future__ import absolute_import, print_function
 import datetime
 
 from flask import request
+from six.moves.urllib.parse import unquote
 
 from ..utils import get_user
 
@@ -61,3 +62,34 @@ def record_view_event_builder(event, sender_app, pid=None, record=None,
         **get_user()
     ))
     return event
+
+
+def file_download_log_resolver(bucket_id, file_key):
+    """Resolve the file of a download URL found in an access log."""
+    from invenio_files_rest.models import ObjectVersion
+    obj = ObjectVersion.get(bucket_id, unquote(file_key))
+    if obj is None or obj.file is None:
+        return None
+    return dict(
+        bucket_id=str(obj.bucket_id),
+        file_id=str(obj.file_id),
+        file_key=obj.key,
+        size=obj.file.size,
+    )
+
+
+def record_view_log_resolver(pid_value, pid_type='recid'):
+    """Resolve the record of a landing page URL found in an access log."""
+    from invenio_pidstore.errors import PIDDoesNotExistError
+    from invenio_pidstore.models import PersistentIdentifier
+    try:
+        pid = PersistentIdentifier.get(pid_type, pid_value)
+    except PIDDoesNotExistError:
+        return None
+    if not pid.is_registered() or pid.object_uuid is None:
+        return None
+    return dict(
+        record_id=str(pid.object_uuid),
+        pid_type=pid.pid_type,
+        pid_value=str(pid.pid_value),
+    )
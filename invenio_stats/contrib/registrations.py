@@ -7,13 +7,13 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 
 """Registration of contrib events."""
-from invenio_search import current_search_client
 
 from invenio_stats.aggregations import StatAggregator
 from invenio_stats.contrib.event_builders import build_file_unique_id, \
     build_record_unique_id
 from invenio_stats.processors import EventsIndexer, anonymize_user, flag_robots
-from invenio_stats.queries import ESDateHistogramQuery, ESTermsQuery
+from invenio_stats.queries import ESBulkTermsQuery, ESDateHistogramQuery, \
+    ESTermsQuery, LocalTotalsQuery
 
 
 def register_events():
@@ -22,6 +22,7 @@ def register_events():
         dict(
             event_type='file-download',
             templates='invenio_stats.contrib.file_download',
+            required_fields=['timestamp', 'bucket_id', 'file_id'],
             processor_class=EventsIndexer,
             processor_config=dict(
                 preprocessors=[
@@ -32,6 +33,8 @@ def register_events():
         dict(
             event_type='record-view',
             templates='invenio_stats.contrib.record_view',
+            required_fields=['timestamp', 'record_id', 'pid_type',
+                             'pid_value'],
             processor_class=EventsIndexer,
             processor_config=dict(
                 preprocessors=[
@@ -49,7 +52,6 @@ def register_aggregations():
         templates='invenio_stats.contrib.aggregations.aggr_file_download',
         aggregator_class=StatAggregator,
         aggregator_config=dict(
-            client=current_search_client,
             event='file-download',
             aggregation_field='unique_id',
             aggregation_interval='day',
@@ -63,12 +65,13 @@ def register_aggregations():
                                  {'precision_threshold': 1000}),
                 'volume': ('sum', 'size', {}),
             },
+            totals_fields=['count', 'volume'],
+            totals_parent_fields=['bucket_id'],
         )), dict(
         aggregation_name='record-view-agg',
         templates='invenio_stats.contrib.aggregations.aggr_record_view',
         aggregator_class=StatAggregator,
         aggregator_config=dict(
-            client=current_search_client,
             event='record-view',
             aggregation_field='unique_id',
             aggregation_interval='day',
@@ -93,6 +96,7 @@ def register_queries():
             query_config=dict(
                 index='stats-file-download',
                 doc_type='file-download-day-aggregation',
+                index_interval='month',
                 copy_fields=dict(
                     bucket_id='bucket_id',
                     file_key='file_key',
@@ -109,6 +113,7 @@ def register_queries():
             query_config=dict(
                 index='stats-file-download',
                 doc_type='file-download-day-aggregation',
+                index_interval='month',
                 copy_fields=dict(
                     # bucket_id='bucket_id',
                 ),
@@ -118,4 +123,46 @@ def register_queries():
                 aggregated_fields=['file_key']
             )
         ),
+        dict(
+            query_name='bucket-file-download-bulk-total',
+            query_class=ESBulkTermsQuery,
+            query_config=dict(
+                index='stats-file-download',
+                doc_type='file-download-day-aggregation',
+                index_interval='month',
+                id_field='bucket_id',
+            )
+        ),
+        dict(
+            query_name='record-view-bulk-total',
+            query_class=ESBulkTermsQuery,
+            query_config=dict(
+                index='stats-record-view',
+                doc_type='record-view-day-aggregation',
+                index_interval='month',
+                id_field='record_id',
+            )
+        ),
+        dict(
+            query_name='file-download-all-time-total',
+            query_class=LocalTotalsQuery,
+            query_config=dict(
+                index='stats-totals-file-download',
+                doc_type='file-download-total',
+                key_field='unique_id',
+                metric_fields=dict(value='count', volume='volume'),
+            ),
+            aggregations=['file-download-agg'],
+        ),
+        dict(
+            query_name='bucket-file-download-all-time-total',
+            query_class=LocalTotalsQuery,
+            query_config=dict(
+                index='stats-totals-file-download',
+                doc_type='file-download-total',
+                key_field='bucket_id',
+                metric_fields=dict(value='count', volume='volume'),
+            ),
+            aggregations=['file-download-agg'],
+        ),
     ]
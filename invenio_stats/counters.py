@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Memory-mapped local copies of the all-time totals.
+
+A counter store is a file containing the totals of one key field (e.g. the
+``unique_id`` of the files) of a totals index, written by
+:func:`write_counter_store`. The file is made of a small JSON header followed
+by fixed-size records, sorted by the 64-bit hash of their key:
+
+.. code-block:: text
+
+    MAGIC | header length (uint32) | header (JSON) | padding
+    hash (uint64) | total of field 1 (float64) | total of field 2 | ...
+    ...
+
+The file is read through :mod:`mmap` by :class:`CounterStore`, so that the
+processes of a host share the same pages of the operating system's cache
+without copying them, and a lookup is a binary search on the hashes. Stores
+are replaced atomically when they are rebuilt or patched, under a lock file
+serializing the writers, and the readers reopen them when the file changes.
+
+Keys whose hashes collide are left out of the stores, so that their totals
+are read from the search cluster instead.
+"""
+
+from __future__ import absolute_import, print_function
+
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import six
+from flask import current_app, has_app_context
+
+MAGIC = b'ISTCNT1\n'
+"""Magic string starting the counter store files."""
+
+_HEADER_LENGTH = struct.Struct('<I')
+_HASH = struct.Struct('<Q')
+
+
+def key_hash(key):
+    """Get the 64-bit hash of a key."""
+    if not isinstance(key, six.binary_type):
+        key = six.text_type(key).encode('utf-8')
+    return _HASH.unpack(hashlib.md5(key).digest()[:_HASH.size])[0]
+
+
+def _record_struct(fields):
+    """Get the structure of the records of some fields."""
+    return struct.Struct('<Q' + 'd' * len(fields))
+
+
+def _number(value):
+    """Convert a stored total to an integer when it is one."""
+    return int(value) if value.is_integer() else value
+
+
+@contextmanager
+def _locked(path):
+    """Hold an exclusive lock on a counter store while it is written."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def _write_records(path, fields, records):
+    """Atomically write a counter store from a dict of hash -> totals."""
+    record = _record_struct(fields)
+    header = json.dumps(dict(fields=list(fields), count=len(records),
+                             created=time.time())).encode('utf-8')
+    offset = len(MAGIC) + _HEADER_LENGTH.size + len(header)
+    padding = b' ' * (-offset % 8)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_HEADER_LENGTH.pack(len(header) + len(padding)))
+        f.write(header + padding)
+        for key in sorted(records):
+            f.write(record.pack(key, *records[key]))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def write_counter_store(path, fields, totals):
+    """Write a counter store.
+
+    :param path: path of the store file.
+    :param fields: names of the stored totals, e.g. ``['count', 'volume']``.
+    :param totals: dict of key -> dict of field -> total.
+    """
+    records = {}
+    collisions = set()
+    for key, total in totals.items():
+        hashed = key_hash(key)
+        if hashed in records:
+            collisions.add(hashed)
+        records[hashed] = [float(total.get(f) or 0) for f in fields]
+    for hashed in collisions:
+        del records[hashed]
+    with _locked(path):
+        _write_records(path, fields, records)
+
+
+def patch_counter_store(path, fields, totals):
+    """Replace some totals of a counter store.
+
+    The store is rewritten with the new totals, keeping the other keys, and
+    created if it does not exist. Its writers are serialized by a lock file,
+    so that concurrent patches do not lose each other's totals. Rewriting the
+    store costs O(number of keys in the store), whatever the number of
+    patched keys. Unlike :func:`write_counter_store`, collisions with the
+    hashes of the keys already in the store are not detected.
+
+    :param path: path of the store file.
+    :param fields: names of the stored totals.
+    :param totals: dict of key -> dict of field -> total.
+    """
+    with _locked(path):
+        # The store is read from the file as it is after the lock is taken.
+        store = CounterStore(path, check_interval=0)
+        records = {}
+        if store.fields is not None:
+            positions = [store.fields.index(f) + 1 if f in store.fields
+                         else None for f in fields]
+            for values in store.records():
+                records[values[0]] = [
+                    values[i] if i is not None else 0.0 for i in positions]
+        store.close()
+        for key, total in totals.items():
+            records[key_hash(key)] = [
+                float(total.get(f) or 0) for f in fields]
+        _write_records(path, fields, records)
+
+
+_MappedStore = namedtuple('_MappedStore', [
+    'mmap', 'stat', 'fields', 'count', 'created', 'record', 'offset'])
+"""Immutable state of a mapped counter store file."""
+
+
+class CounterStore(object):
+    """Reader of a memory-mapped counter store.
+
+    The file is checked for changes at most every ``check_interval`` seconds
+    and mapped again once it has been replaced. The new mapping replaces the
+    previous one atomically, and the previous one is unmapped once it is not
+    used anymore, so that a store can be shared by several threads.
+    """
+
+    def __init__(self, path, check_interval=1):
+        """Constructor.
+
+        :param path: path of the store file.
+        :param check_interval: time in seconds during which the file is not
+            checked for changes.
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._mapped = None
+        self._checked = None
+        self._open()
+
+    @property
+    def fields(self):
+        """Names of the stored totals, or ``None`` if there is no store."""
+        mapped = self._mapped
+        return mapped.fields if mapped is not None else None
+
+    @property
+    def count(self):
+        """Number of keys in the store."""
+        mapped = self._mapped
+        return mapped.count if mapped is not None else 0
+
+    @property
+    def created(self):
+        """Time at which the store was written, or ``None``."""
+        mapped = self._mapped
+        return mapped.created if mapped is not None else None
+
+    def _open(self):
+        """Map the file again if it changed."""
+        self._checked = time.time()
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self._mapped = None
+            return
+        stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+        mapped = self._mapped
+        if mapped is not None and stat == mapped.stat:
+            return
+        with open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(MAGIC)] != MAGIC:
+            data.close()
+            raise ValueError(
+                'Invalid counter store file {0}'.format(self.path))
+        start = len(MAGIC) + _HEADER_LENGTH.size
+        length = _HEADER_LENGTH.unpack_from(data, len(MAGIC))[0]
+        header = json.loads(data[start:start + length].decode('utf-8'))
+        # The readers holding the previous mapping keep using it until they
+        # return, it is unmapped once it is garbage collected.
+        self._mapped = _MappedStore(
+            data, stat, header['fields'], header['count'],
+            header.get('created'), _record_struct(header['fields']),
+            start + length)
+
+    def close(self):
+        """Forget the mapped file, which is unmapped once it is not used."""
+        self._mapped = None
+
+    def age(self):
+        """Get the time in seconds since the store was written.
+
+        :returns: the age of the store, or ``None`` if there is no store.
+        """
+        if time.time() - self._checked >= self.check_interval:
+            self._open()
+        created = self.created
+        return time.time() - created if created is not None else None
+
+    def records(self):
+        """Iterate over the ``(hash, total...)`` records."""
+        mapped = self._mapped
+        if mapped is None:
+            return
+        for i in range(mapped.count):
+            yield mapped.record.unpack_from(
+                mapped.mmap, mapped.offset + i * mapped.record.size)
+
+    def get(self, key):
+        """Get the totals of a key.
+
+        :returns: dict of field -> total, or ``None`` if the key is not in
+            the store.
+        """
+        if time.time() - self._checked >= self.check_interval:
+            self._open()
+        mapped = self._mapped
+        if mapped is None:
+            return None
+        hashed = key_hash(key)
+        size = mapped.record.size
+        low, high = 0, mapped.count
+        while low < high:
+            middle = (low + high) // 2
+            value = _HASH.unpack_from(
+                mapped.mmap, mapped.offset + middle * size)[0]
+            if value < hashed:
+                low = middle + 1
+            elif value > hashed:
+                high = middle
+            else:
+                values = mapped.record.unpack_from(
+                    mapped.mmap, mapped.offset + middle * size)[1:]
+                return dict(
+                    (field, _number(value))
+                    for field, value in zip(mapped.fields, values))
+        return None
+
+
+def counter_store_path(directory, index, key_field):
+    """Get the path of the counter store of a key field of a totals index."""
+    return os.path.join(directory, '{0}-{1}.counters'.format(index, key_field))
+
+
+def get_counter_store_dir():
+    """Get the directory of the counter stores, if they are enabled."""
+    if not has_app_context():
+        return None
+    return current_app.config.get('STATS_COUNTER_STORE_DIR') or None
@@ -10,6 +10,7 @@
 
 from __future__ import absolute_import, print_function
 
+import time
 from collections import namedtuple
 
 from invenio_queues.proxies import current_queues
@@ -17,10 +18,16 @@ from pkg_resources import iter_entry_points
 from werkzeug.utils import cached_property
 
 from . import config
+from .buffers import EventBuffer, flush_request_events
+from .cache import QueryResultCache
+from .codecs import encode_events, iter_events
+from .counters import CounterStore, counter_store_path
 from .errors import DuplicateAggregationError, DuplicateEventError, \
     DuplicateQueryError, UnknownAggregationError, UnknownEventError, \
     UnknownQueryError
 from .receivers import register_receivers
+from .sampling import EventSampler
+from .spool import EventSpool, publish_events
 from .utils import load_or_import_from_config
 
 
@@ -39,6 +46,10 @@ class _InvenioStatsState(object):
         self.entry_point_group_events = entry_point_group_events
         self.entry_point_group_aggs = entry_point_group_aggs
         self.entry_point_group_queries = entry_point_group_queries
+        self._broker_failed_at = None
+        self._processors = {}
+        self._aggregators = {}
+        self._counter_stores = {}
 
     @cached_property
     def _events_config(self):
@@ -179,6 +190,71 @@ class _InvenioStatsState(object):
             )
         return result
 
+    def get_processor(self, event_type):
+        """Get the events indexer of an event type.
+
+        The indexer is built once and reused by the following calls, its
+        runs being serialized.
+        """
+        if event_type not in self._processors:
+            event_cfg = self.events[event_type]
+            self._processors[event_type] = event_cfg.processor_class(
+                **event_cfg.processor_config)
+        return self._processors[event_type]
+
+    def get_aggregator(self, name):
+        """Get the aggregator of an aggregation.
+
+        The aggregator is built once and reused by the following calls. Its
+        runs are serialized and reset its run state, see
+        :class:`~invenio_stats.aggregations.StatAggregator`.
+        """
+        if name not in self._aggregators:
+            aggr_cfg = self.aggregations[name]
+            self._aggregators[name] = aggr_cfg.aggregator_class(
+                name=aggr_cfg.name, **aggr_cfg.aggregator_config)
+        return self._aggregators[name]
+
+    def get_counter_store(self, index, key_field):
+        """Get the local counter store of a key field of a totals index.
+
+        The store is opened once and reused by the following calls.
+
+        :returns: a :class:`~invenio_stats.counters.CounterStore`, or
+            ``None`` if the counter stores are disabled.
+        """
+        directory = self.app.config['STATS_COUNTER_STORE_DIR']
+        if not directory:
+            return None
+        path = counter_store_path(directory, index, key_field)
+        if path not in self._counter_stores:
+            self._counter_stores[path] = CounterStore(
+                path, check_interval=self.app.config[
+                    'STATS_COUNTER_STORE_CHECK_INTERVAL'])
+        return self._counter_stores[path]
+
+    def warm_up(self):
+        """Prepare the processing of events and aggregations.
+
+        Resolve the configurations, build the events indexers and aggregators,
+        open the GeoIP database, compile the robots detection regular
+        expressions and load the current anonymization salt.
+        """
+        import datetime
+
+        from counter_robots import is_machine, is_robot
+
+        from .utils import get_anonymization_salt, get_geoip
+        for event_type in self.events:
+            self.get_processor(event_type)
+        for name in self.aggregations:
+            self.get_aggregator(name)
+        self.queries
+        is_robot('')
+        is_machine('')
+        get_geoip('127.0.0.1')
+        get_anonymization_salt(datetime.datetime.utcnow())
+
     @cached_property
     def permission_factory(self):
         """Load default permission factory for Buckets collections."""
@@ -186,16 +262,130 @@ class _InvenioStatsState(object):
             'STATS_PERMISSION_FACTORY', app=self.app
         )
 
+    @cached_property
+    def events_permission_factory(self):
+        """Load the permission factory of the events ingestion REST API."""
+        return load_or_import_from_config(
+            'STATS_EVENTS_PERMISSION_FACTORY', app=self.app
+        )
+
+    @cached_property
+    def metrics_permission_factory(self):
+        """Load the permission factory of the metrics endpoint."""
+        return load_or_import_from_config(
+            'STATS_METRICS_PERMISSION_FACTORY', app=self.app
+        )
+
+    @cached_property
+    def query_cache(self):
+        """Load the query results cache, if enabled."""
+        if not self.app.config['STATS_QUERY_CACHE']:
+            return None
+        return QueryResultCache(
+            timeout=self.app.config['STATS_QUERY_CACHE_TIMEOUT'])
+
+    @cached_property
+    def event_buffer(self):
+        """Process-level buffer of the events emitted outside requests."""
+        return EventBuffer(
+            self.app,
+            max_size=self.app.config['STATS_PUBLISH_BUFFER_SIZE'],
+            timeout=self.app.config['STATS_PUBLISH_BUFFER_TIMEOUT'])
+
+    @cached_property
+    def sampler(self):
+        """Load the events sampler, if sampling is configured."""
+        config = self.app.config
+        if not (config['STATS_SAMPLING_RATES'] or
+                config['STATS_SAMPLING_ROBOTS_RATE'] is not None or
+                config['STATS_SAMPLING_QUEUE_THRESHOLDS']):
+            return None
+        return EventSampler(
+            rates=config['STATS_SAMPLING_RATES'],
+            robots_rate=config['STATS_SAMPLING_ROBOTS_RATE'],
+            robots_pattern=config['STATS_SAMPLING_ROBOTS_PATTERN'],
+            queue_thresholds=config['STATS_SAMPLING_QUEUE_THRESHOLDS'],
+            queue_check_interval=config[
+                'STATS_SAMPLING_QUEUE_CHECK_INTERVAL'])
+
+    @cached_property
+    def spool(self):
+        """Load the local events spool, if enabled."""
+        directory = self.app.config['STATS_SPOOL_DIR']
+        if not directory:
+            return None
+        return EventSpool(
+            directory,
+            segment_size=self.app.config['STATS_SPOOL_SEGMENT_SIZE'],
+            segment_age=self.app.config['STATS_SPOOL_SEGMENT_AGE'],
+            fsync_interval=self.app.config['STATS_SPOOL_FSYNC_INTERVAL'])
+
+    def _encode(self, events):
+        """Encode events into queue messages.
+
+        :returns: the messages and the number of events per message.
+        """
+        codec = self.app.config['STATS_QUEUE_CODEC']
+        if not codec:
+            return events, 1
+        batch_size = self.app.config['STATS_QUEUE_BATCH_SIZE']
+        return encode_events(events, codec=codec,
+                             batch_size=batch_size), batch_size
+
     def publish(self, event_type, events):
-        """Publish events."""
+        """Publish events.
+
+        If the spool is enabled, the events which cannot be published within
+        ``STATS_SPOOL_PUBLISH_TIMEOUT`` seconds are written to the spool.
+        After a failure, events are spooled directly during
+        ``STATS_SPOOL_RETRY_INTERVAL`` seconds. The segment of the spool is
+        closed once the broker recovers, so that it can be drained.
+        """
         assert event_type in self.events
-        current_queues.queues['stats-{}'.format(event_type)].publish(events)
+        queue = current_queues.queues['stats-{}'.format(event_type)]
+        if self.spool is None:
+            queue.publish(self._encode(events)[0])
+            return
+        if self._broker_failed_at is not None and \
+                time.time() - self._broker_failed_at < \
+                self.app.config['STATS_SPOOL_RETRY_INTERVAL']:
+            self.spool.append(event_type, events)
+            return
+        messages, batch_size = self._encode(events)
+        try:
+            publish_events(
+                queue, messages,
+                self.app.config['STATS_SPOOL_PUBLISH_TIMEOUT'])
+            if self._broker_failed_at is not None:
+                self._broker_failed_at = None
+                self.spool.close()
+        except Exception as e:
+            self.app.logger.warning(
+                u'Spooling events which could not be published: %s', e)
+            self._broker_failed_at = time.time()
+            self.spool.append(
+                event_type,
+                events[getattr(e, 'published', 0) * batch_size:])
+
+    def drain_spool(self, rate=None, max_events=None):
+        """Publish the spooled events of this host.
+
+        :returns: number of published events.
+        """
+        if self.spool is None:
+            return 0
+        return self.spool.drain(
+            lambda event_type, events: current_queues.queues[
+                'stats-{}'.format(event_type)].publish(
+                    self._encode(events)[0]),
+            rate=rate, max_events=max_events)
 
     def consume(self, event_type, no_ack=True, payload=True):
         """Comsume all pending events."""
         assert event_type in self.events
-        return current_queues.queues['stats-{}'.format(event_type)].consume(
-            payload=payload)
+        messages = current_queues.queues[
+            'stats-{}'.format(event_type)].consume(payload=payload)
+        return iter_events(messages) if payload else messages
 
 
 class InvenioStats(object):
@@ -226,6 +416,7 @@ class InvenioStats(object):
                                 app.config.get('STATS_EVENTS', {}).items()
                                 if 'signal' in value}
             register_receivers(app, signal_receivers)
+        app.teardown_request(flush_request_events)
 
         return state
 
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Import of events from web server access logs."""
+
+from __future__ import absolute_import, print_function
+
+import datetime
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import re
+from collections import deque
+
+from flask import current_app
+
+from .proxies import current_stats
+from .utils import import_salt, obj_or_import_string
+
+COMBINED_LOG_REGEX = re.compile(
+    r'(?P<ip_address>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] '
+    r'"(?P<method>[A-Z]+) (?P<path>\S+)[^"]*" (?P<status>\d{3}) '
+    r'(?P<size>\S+)(?: "(?P<referrer>[^"]*)" "(?P<user_agent>[^"]*)")?'
+)
+
+MONTHS = dict((m, i + 1) for i, m in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+
+def parse_log_time(value):
+    """Parse a ``10/Oct/2018:13:55:36 +0200`` time into a UTC ISO string."""
+    day, month, year = value[:11].split('/')
+    dt = datetime.datetime(
+        int(year), MONTHS[month], int(day),
+        int(value[12:14]), int(value[15:17]), int(value[18:20]))
+    offset = value[21:]
+    if offset:
+        minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+        if offset[0] == '+':
+            minutes = -minutes
+        dt += datetime.timedelta(minutes=minutes)
+    return dt.isoformat()
+
+
+def parse_combined_log(line):
+    """Parse a line of the Nginx/Apache "combined" and "common" log formats.
+
+    :returns: dictionary of the request attributes or ``None`` if the line
+        does not match the format.
+    """
+    match = COMBINED_LOG_REGEX.match(line)
+    if not match:
+        return None
+    entry = match.groupdict()
+    entry['timestamp'] = parse_log_time(entry.pop('time'))
+    entry['status'] = int(entry['status'])
+    entry['referrer'] = entry['referrer'] \
+        if entry['referrer'] not in (None, '-') else None
+    return entry
+
+
+_parsers = None
+_rules = None
+
+
+def _init_parsing(parsers, patterns):
+    """Load the parsers and compile the URL patterns of a parsing process."""
+    global _parsers, _rules
+    _parsers = [obj_or_import_string(p) for p in parsers]
+    _rules = [re.compile(p) for p in patterns]
+
+
+def _parse_lines(lines):
+    """Parse log lines and match their URL with the import rules.
+
+    :returns: list of (rule index, URL groups, log entry) tuples.
+    """
+    result = []
+    for line in lines:
+        line = line.decode('utf-8', 'replace')
+        for parser in _parsers:
+            entry = parser(line)
+            if entry is not None:
+                break
+        else:
+            continue
+        if entry['method'] != 'GET' or not 200 <= entry['status'] < 300:
+            continue
+        for index, rule in enumerate(_rules):
+            match = rule.match(entry['path'])
+            if match:
+                result.append((index, match.groupdict(), entry))
+                break
+    return result
+
+
+class _ListQueue(object):
+    """Queue-like object returning events given by the log importer."""
+
+    def __init__(self, routing_key):
+        """Constructor."""
+        self.routing_key = routing_key
+        self.events = []
+
+    def consume(self, payload=True):
+        """Consume the events."""
+        events, self.events = self.events, []
+        return iter(events)
+
+
+class LogImporter(object):
+    """Import events from web server access logs.
+
+    Log files, optionally gzip-compressed, are read by chunks of lines which
+    are parsed by a pool of processes. Only a bounded number of chunks is
+    processed at the same time so that memory stays constant whatever the size
+    of the logs. The log entries whose URL matches one of the import rules are
+    converted into events and indexed by the processor of their event type,
+    i.e. they go through the same preprocessors as the queued events.
+
+    The offset of the last imported chunk of each file is saved in a state
+    file, so that an interrupted import continues where it stopped.
+    """
+
+    def __init__(self, rules, parsers, state_file, processes=None,
+                 chunk_size=10000, resolver_cache_size=10000, salt=None):
+        """Constructor.
+
+        :param rules: list of import rules, i.e. dictionaries with the
+            ``event_type``, the regular expression ``pattern`` matching the
+            URL path and the ``resolver`` function, called with the named
+            groups of the pattern, which returns the event fields or ``None``
+            to skip the entry.
+        :param parsers: list of functions parsing a log line.
+        :param state_file: path of the file storing the import offsets.
+        :param processes: number of parsing processes. Lines are parsed in
+            the current process if it is 1.
+        :param chunk_size: number of lines parsed at once.
+        :param resolver_cache_size: number of resolved URLs kept in memory.
+        :param salt: secret from which the anonymization salts of the
+            imported events are derived, so that importing the same logs
+            again with the same salt gives the same visitor ids. Defaults to
+            the random salts of the days, which expire after 24 hours.
+        """
+        self.rules = [dict(rule, resolver=obj_or_import_string(
+            rule['resolver'])) for rule in rules]
+        self.parsers = parsers
+        self.state_file = state_file
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.resolver_cache_size = resolver_cache_size
+        self.salt = salt
+        self._resolved = {}
+        self._indexers = {}
+
+    def load_state(self):
+        """Load the offsets of the imported files."""
+        if not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        """Atomically save the offsets of the imported files."""
+        directory = os.path.dirname(self.state_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_file, self.state_file)
+
+    def _chunks(self, fileobj):
+        """Read chunks of lines with the offset following them."""
+        lines = []
+        offset = fileobj.tell()
+        for line in fileobj:
+            lines.append(line)
+            offset += len(line)
+            if len(lines) >= self.chunk_size:
+                yield lines, offset
+                lines = []
+        if lines:
+            yield lines, offset
+
+    def _parsed_chunks(self, fileobj):
+        """Parse chunks of lines, keeping at most two per process pending."""
+        patterns = [rule['pattern'] for rule in self.rules]
+        if self.processes == 1:
+            _init_parsing(self.parsers, patterns)
+            for lines, offset in self._chunks(fileobj):
+                yield _parse_lines(lines), offset
+            return
+        pool = multiprocessing.Pool(self.processes, _init_parsing,
+                                    (self.parsers, patterns))
+        try:
+            pending = deque()
+            for lines, offset in self._chunks(fileobj):
+                pending.append(
+                    (pool.apply_async(_parse_lines, (lines,)), offset))
+                if len(pending) >= self.processes * 2:
+                    result, offset = pending.popleft()
+                    yield result.get(), offset
+            while pending:
+                result, offset = pending.popleft()
+                yield result.get(), offset
+        finally:
+            pool.terminate()
+
+    def _resolve(self, rule_index, groups):
+        """Get the event fields of a matched URL."""
+        key = (rule_index, tuple(sorted(groups.items())))
+        if key not in self._resolved:
+            if len(self._resolved) >= self.resolver_cache_size:
+                self._resolved.clear()
+            self._resolved[key] = self.rules[rule_index]['resolver'](**groups)
+        return self._resolved[key]
+
+    def _get_indexer(self, event_type):
+        """Get the processor indexing the events of an event type."""
+        if event_type not in self._indexers:
+            event_cfg = current_stats.events[event_type]
+            queue = _ListQueue(event_cfg.processor_config['queue'].routing_key)
+            self._indexers[event_type] = event_cfg.processor_class(
+                **dict(event_cfg.processor_config, queue=queue))
+        return self._indexers[event_type]
+
+    def _index(self, parsed):
+        """Convert parsed log entries into events and index them."""
+        count = 0
+        for rule_index, groups, entry in parsed:
+            fields = self._resolve(rule_index, groups)
+            if fields is None:
+                continue
+            event = dict(
+                timestamp=entry['timestamp'],
+                referrer=entry.get('referrer'),
+                ip_address=entry['ip_address'],
+                user_agent=entry.get('user_agent') or '',
+                user_id=None,
+                session_id=None,
+            )
+            event.update(fields)
+            indexer = self._get_indexer(self.rules[rule_index]['event_type'])
+            indexer.queue.events.append(event)
+            count += 1
+        for indexer in self._indexers.values():
+            if indexer.queue.events:
+                indexer.run()
+        return count
+
+    def import_file(self, path, restart=False):
+        """Import the events of a log file.
+
+        :param path: path of the log file. Files ending with ``.gz`` are
+            decompressed.
+        :param restart: ignore the saved offset and import the whole file.
+        :returns: number of imported events.
+        """
+        key = os.path.abspath(path)
+        state = self.load_state()
+        offset = 0 if restart else state.get(key, {}).get('offset', 0)
+        count = 0
+        opener = gzip.open if path.endswith('.gz') else io.open
+        with opener(path, 'rb') as fileobj, import_salt(self.salt):
+            # Seeking a compressed file decompresses it up to the offset.
+            fileobj.seek(offset)
+            for parsed, offset in self._parsed_chunks(fileobj):
+                count += self._index(parsed)
+                state[key] = dict(offset=offset)
+                self.save_state(state)
+        current_app.logger.info(
+            u'Imported %s events from %s', count, path)
+        return count
@@ -0,0 +1,1243 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""In-memory stand-in of the Elasticsearch client.
+
+:class:`MemorySearchClient` implements the subset of the Elasticsearch API
+used by the events indexers, the aggregators and the queries, so that they
+can be tested and benchmarked without a cluster:
+
+- documents: ``bulk``, ``index``, ``get``, ``mget``, ``delete``,
+- searches: ``search``, ``msearch``, ``count``, ``scroll`` and
+  ``clear_scroll``, with the ``match_all``, ``bool``, ``term``, ``terms``,
+  ``range``, ``exists`` and ``ids`` queries and the ``date_histogram``,
+  ``terms``, ``top_hits``, ``cardinality``, ``sum``, ``min``, ``max``,
+  ``avg``, ``value_count`` and ``stats`` aggregations,
+- indices: ``exists``, ``create``, ``delete``, ``flush``, ``refresh``,
+  ``put_template``, ``get_alias`` and ``put_alias``.
+
+Documents are stored by rows, with column caches of their fields built lazily
+on first use, which makes searches and aggregations over large synthetic
+datasets fast. Each write updates the cached columns, thus costs O(number of
+cached columns). Counts are exact, i.e. cardinalities are not
+approximated. Use it by setting
+:data:`invenio_stats.config.STATS_SEARCH_CLIENT` or by passing it as
+``client`` to the indexers, aggregators and queries:
+
+.. code-block:: python
+
+    from invenio_stats.memsearch import MemorySearchClient
+
+    app.config['STATS_SEARCH_CLIENT'] = MemorySearchClient()
+
+The index templates of :mod:`invenio_stats.contrib` are put in the client
+with :func:`put_contrib_templates`.
+"""
+
+from __future__ import absolute_import, print_function
+
+import calendar
+import datetime
+import fnmatch
+import json
+import os
+import re
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+import six
+from elasticsearch.exceptions import NotFoundError, RequestError, \
+    TransportError
+from elasticsearch.serializer import JSONSerializer
+
+SECOND = 1000
+MINUTE = 60 * SECOND
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
+FILE_DOWNLOAD_TEMPLATES = (
+    'file_download/v2/file-download-v1.json',
+    'aggregations/aggr_file_download/v2/aggr-file-download-v1.json',
+)
+"""Templates of the file-download events and aggregations."""
+
+DATE_REGEX = re.compile(
+    r'(\d{4})(?:-(\d{2})(?:-(\d{2})(?:[T ](\d{2})(?::(\d{2})'
+    r'(?::(\d{2})(?:[.,](\d+))?)?)?)?)?)?(Z|[+-]\d{2}:?\d{2})?$')
+
+DATE_MATH_REGEX = re.compile(r'([+-])(\d+)([yMwdhHms])|/([yMwdhHms])')
+
+UNITS = {
+    'y': 'year', 'M': 'month', 'w': 'week', 'd': 'day', 'h': 'hour',
+    'H': 'hour', 'm': 'minute', 's': 'second',
+}
+
+CALENDAR_INTERVALS = {
+    'year': 'year', '1y': 'year', 'quarter': 'quarter', '1q': 'quarter',
+    'month': 'month', '1M': 'month', 'week': 'week', '1w': 'week',
+    'day': 'day', '1d': 'day', 'hour': 'hour', '1h': 'hour',
+    'minute': 'minute', '1m': 'minute', 'second': 'second', '1s': 'second',
+}
+
+FIXED_UNITS = {'d': DAY, 'h': HOUR, 'm': MINUTE, 's': SECOND, 'ms': 1}
+
+DATE_FORMATS = {
+    'strict_date_hour_minute_second': '%Y-%m-%dT%H:%M:%S',
+    'date_hour_minute_second': '%Y-%m-%dT%H:%M:%S',
+    'strict_date': '%Y-%m-%d',
+    'date': '%Y-%m-%d',
+    'year_month': '%Y-%m',
+    'year': '%Y',
+}
+"""``strftime`` format of the Elasticsearch date formats."""
+
+DEFAULT_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+
+
+def parse_date(value):
+    """Convert a date or a number into milliseconds since the epoch.
+
+    :returns: the milliseconds or ``None`` if the value is not a date.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (six.integer_types, float)):
+        return value
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    elif isinstance(value, datetime.date):
+        value = value.isoformat()
+    match = DATE_REGEX.match(value)
+    if not match:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    year, month, day, hour, minute, second, fraction, tz = match.groups()
+    millis = calendar.timegm((
+        int(year), int(month or 1), int(day or 1), int(hour or 0),
+        int(minute or 0), int(second or 0))) * SECOND
+    if fraction:
+        millis += int(fraction[:3].ljust(3, '0'))
+    if tz and tz != 'Z':
+        offset = (int(tz[1:3]) * 60 + int(tz[-2:])) * MINUTE
+        millis += -offset if tz[0] == '+' else offset
+    return millis
+
+
+def _to_datetime(millis):
+    """Convert milliseconds since the epoch into a naive UTC datetime."""
+    return datetime.datetime(1970, 1, 1) + \
+        datetime.timedelta(milliseconds=millis)
+
+
+def _from_datetime(dt):
+    """Convert a naive UTC datetime into milliseconds since the epoch."""
+    return calendar.timegm(dt.utctimetuple()) * SECOND + \
+        dt.microsecond // 1000
+
+
+def floor_date(millis, unit):
+    """Round milliseconds since the epoch down to a calendar unit."""
+    if unit == 'second':
+        return millis - millis % SECOND
+    elif unit == 'minute':
+        return millis - millis % MINUTE
+    elif unit == 'hour':
+        return millis - millis % HOUR
+    elif unit == 'day':
+        return millis - millis % DAY
+    elif unit == 'week':
+        days = millis // DAY
+        # The epoch is a Thursday and weeks start on Monday.
+        return (days - (days + 3) % 7) * DAY
+    dt = _to_datetime(millis)
+    if unit == 'month':
+        dt = datetime.datetime(dt.year, dt.month, 1)
+    elif unit == 'quarter':
+        dt = datetime.datetime(dt.year, (dt.month - 1) // 3 * 3 + 1, 1)
+    else:
+        dt = datetime.datetime(dt.year, 1, 1)
+    return _from_datetime(dt)
+
+
+def add_date(millis, unit, count=1):
+    """Add a number of calendar units to milliseconds since the epoch."""
+    fixed = dict(second=SECOND, minute=MINUTE, hour=HOUR, day=DAY,
+                 week=WEEK).get(unit)
+    if fixed:
+        return millis + count * fixed
+    if unit == 'quarter':
+        unit, count = 'month', count * 3
+    dt = _to_datetime(millis)
+    months = dt.month - 1 + (count if unit == 'month' else count * 12)
+    year, month = dt.year + months // 12, months % 12 + 1
+    day = min(dt.day, calendar.monthrange(year, month)[1])
+    return _from_datetime(dt.replace(year=year, month=month, day=day))
+
+
+def parse_date_math(value, round_up=False, now=None):
+    """Evaluate a date math expression, e.g. ``2018-01-01||+1M/d``.
+
+    :param round_up: round to the last millisecond of the unit instead of
+        the first one, as done for the ``gt`` and ``lte`` range bounds.
+    :returns: the milliseconds since the epoch.
+    """
+    if isinstance(value, six.string_types):
+        if value.startswith('now'):
+            anchor = now if now is not None else int(time.time() * SECOND)
+            expression = value[3:]
+        elif '||' in value:
+            anchor, expression = value.split('||', 1)
+            anchor = parse_date(anchor)
+        else:
+            anchor, expression = parse_date(value), ''
+        if anchor is None:
+            raise RequestError(400, 'parse_exception',
+                               'Invalid date {}'.format(value))
+        for sign, count, unit, rounding in \
+                DATE_MATH_REGEX.findall(expression):
+            if rounding:
+                anchor = floor_date(anchor, UNITS[rounding])
+                if round_up:
+                    anchor = add_date(anchor, UNITS[rounding]) - 1
+            else:
+                anchor = add_date(
+                    anchor, UNITS[unit],
+                    int(count) if sign == '+' else -int(count))
+        return anchor
+    return parse_date(value)
+
+
+def _is_number(value):
+    """Check if a value is a number or a string representing a number."""
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def _get_field(source, field):
+    """Get the value of a field, possibly in an inner object."""
+    if field in source:
+        return source[field]
+    value = source
+    for part in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _term_sort_key(key):
+    """Get a sort key ordering the terms of any type without comparing types.
+
+    Numbers are sorted by value before the strings, and the other values by
+    their string representation.
+    """
+    if isinstance(key, six.integer_types + (float, )):
+        return (0, key, '')
+    if isinstance(key, six.string_types):
+        return (1, 0, key)
+    return (2, 0, str(key))
+
+
+def _matches(names, patterns):
+    """Get the names matching index patterns."""
+    return [n for n in names if any(fnmatch.fnmatchcase(n, p)
+                                    for p in patterns)]
+
+
+def _split_names(value):
+    """Split index or type names given as a list or comma separated string."""
+    if value is None:
+        return []
+    if isinstance(value, six.string_types):
+        value = value.split(',')
+    return [v.strip() for v in value if v and v.strip()]
+
+
+def _ignorable(func):
+    """Return the error information if its status is in ``ignore``."""
+    def wrapper(*args, **kwargs):
+        ignore = kwargs.pop('ignore', ())
+        if isinstance(ignore, int):
+            ignore = (ignore, )
+        try:
+            return func(*args, **kwargs)
+        except TransportError as e:
+            if e.status_code in ignore:
+                return e.info
+            raise
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+class MemoryIndex(object):
+    """Row store of documents with lazily built column caches."""
+
+    def __init__(self, name):
+        """Constructor."""
+        self.name = name
+        self.aliases = set()
+        self.mappings = {}
+        self.ids = []
+        self.types = []
+        self.routings = []
+        self.versions = []
+        self.sources = []
+        self.live = []
+        self.positions = {}
+        self.deleted = 0
+        self._columns = {}
+        self._date_columns = {}
+
+    def __len__(self):
+        """Get the number of documents."""
+        return len(self.positions)
+
+    def add_mappings(self, mappings):
+        """Add the field properties of type mappings."""
+        for doc_type, mapping in (mappings or {}).items():
+            if doc_type == '_default_':
+                continue
+            for field, props in (mapping.get('properties') or {}).items():
+                self.mappings[field] = props
+
+    def is_date(self, field):
+        """Check if a field is mapped as a date."""
+        return self.mappings.get(field, {}).get('type') == 'date'
+
+    def date_format(self, field):
+        """Get the ``strftime`` format of a date field."""
+        fmt = self.mappings.get(field, {}).get('format', '').split('||')[0]
+        return DATE_FORMATS.get(fmt, DEFAULT_DATE_FORMAT)
+
+    def column(self, field):
+        """Get the values of a field, indexed by row.
+
+        The column is built from the rows on first use and then cached. The
+        cached columns are updated by each write, which thus costs O(number
+        of cached columns).
+        """
+        if field not in self._columns:
+            self._columns[field] = [
+                _get_field(s, field) if s is not None else None
+                for s in self.sources]
+        return self._columns[field]
+
+    def date_column(self, field):
+        """Get the values of a field as milliseconds since the epoch."""
+        if field not in self._date_columns:
+            self._date_columns[field] = [
+                parse_date(v) for v in self.column(field)]
+        return self._date_columns[field]
+
+    def rows(self):
+        """Get the rows of the live documents."""
+        if not self.deleted:
+            return list(range(len(self.live)))
+        return [r for r, live in enumerate(self.live) if live]
+
+    def get(self, doc_type, doc_id):
+        """Get the row of a document, or ``None``."""
+        if doc_type is None or doc_type == '_all':
+            for (t, i), row in self.positions.items():
+                if i == doc_id:
+                    return row
+            return None
+        return self.positions.get((doc_type, doc_id))
+
+    def put(self, doc_type, doc_id, source, routing=None):
+        """Create or replace a document.
+
+        :returns: the version of the document.
+        """
+        row = self.positions.get((doc_type, doc_id))
+        if row is not None:
+            version = self.versions[row] + 1
+            self._set_row(row, source)
+            self.versions[row] = version
+            self.routings[row] = routing
+            return version
+        row = len(self.ids)
+        self.positions[(doc_type, doc_id)] = row
+        self.ids.append(doc_id)
+        self.types.append(doc_type)
+        self.routings.append(routing)
+        self.versions.append(1)
+        self.sources.append(source)
+        self.live.append(True)
+        for field, values in self._columns.items():
+            values.append(_get_field(source, field))
+        for field, values in self._date_columns.items():
+            values.append(parse_date(self._columns[field][row]))
+        return 1
+
+    def _set_row(self, row, source):
+        """Replace the source of a row."""
+        self.sources[row] = source
+        for field, values in self._columns.items():
+            values[row] = _get_field(source, field) \
+                if source is not None else None
+        for field, values in self._date_columns.items():
+            values[row] = parse_date(self._columns[field][row])
+
+    def remove(self, doc_type, doc_id):
+        """Delete a document.
+
+        :returns: ``True`` if the document existed.
+        """
+        row = self.positions.pop((doc_type, doc_id), None)
+        if row is None:
+            return False
+        self.live[row] = False
+        self._set_row(row, None)
+        self.deleted += 1
+        if self.deleted > 1000 and self.deleted * 2 > len(self.live):
+            self._compact()
+        return True
+
+    def _compact(self):
+        """Remove the rows of the deleted documents."""
+        rows = self.rows()
+        for attr in ('ids', 'types', 'routings', 'versions', 'sources',
+                     'live'):
+            values = getattr(self, attr)
+            setattr(self, attr, [values[r] for r in rows])
+        self.positions = dict(
+            ((t, i), row) for row, (t, i) in
+            enumerate(zip(self.types, self.ids)))
+        self.deleted = 0
+        self._columns = {}
+        self._date_columns = {}
+
+
+class MemoryIndicesClient(object):
+    """Indices API of :class:`MemorySearchClient`."""
+
+    def __init__(self, client):
+        """Constructor."""
+        self.client = client
+
+    @_ignorable
+    def exists(self, index, **kwargs):
+        """Check if indices or aliases exist."""
+        self.client.requests['indices.exists'] += 1
+        names = _split_names(index)
+        return bool(names) and all(
+            self.client.resolve(name, ignore_unavailable=True)
+            for name in names)
+
+    @_ignorable
+    def create(self, index, body=None, **kwargs):
+        """Create an index."""
+        self.client.requests['indices.create'] += 1
+        if index in self.client.indices_data:
+            raise RequestError(400, 'index_already_exists_exception',
+                               dict(index=index))
+        created = self.client.create_index(index)
+        body = body or {}
+        created.add_mappings(body.get('mappings'))
+        created.aliases.update(body.get('aliases') or {})
+        return dict(acknowledged=True)
+
+    @_ignorable
+    def delete(self, index, **kwargs):
+        """Delete indices."""
+        self.client.requests['indices.delete'] += 1
+        names = self.client.resolve(index, aliases=False)
+        for name in names:
+            del self.client.indices_data[name]
+        return dict(acknowledged=True)
+
+    @_ignorable
+    def flush(self, index=None, **kwargs):
+        """Flush indices, which has no effect."""
+        self.client.requests['indices.flush'] += 1
+        if index:
+            self.client.resolve(index, ignore_unavailable=kwargs.get(
+                'ignore_unavailable', False))
+        return dict(_shards=dict(total=1, successful=1, failed=0))
+
+    @_ignorable
+    def refresh(self, index=None, **kwargs):
+        """Refresh indices, which has no effect."""
+        self.client.requests['indices.refresh'] += 1
+        if index:
+            self.client.resolve(index)
+        return dict(_shards=dict(total=1, successful=1, failed=0))
+
+    @_ignorable
+    def put_template(self, name, body, **kwargs):
+        """Create or replace an index template."""
+        self.client.requests['indices.put_template'] += 1
+        if isinstance(body, six.string_types):
+            body = json.loads(body)
+        self.client.templates[name] = body
+        return dict(acknowledged=True)
+
+    @_ignorable
+    def exists_template(self, name, **kwargs):
+        """Check if an index template exists."""
+        return name in self.client.templates
+
+    @_ignorable
+    def delete_template(self, name, **kwargs):
+        """Delete an index template."""
+        if self.client.templates.pop(name, None) is None:
+            raise NotFoundError(404, 'index_template_missing_exception',
+                                dict(name=name))
+        return dict(acknowledged=True)
+
+    @_ignorable
+    def put_alias(self, index, name, **kwargs):
+        """Add an alias to indices."""
+        for index_name in self.client.resolve(index, aliases=False):
+            self.client.indices_data[index_name].aliases.add(name)
+        return dict(acknowledged=True)
+
+    @_ignorable
+    def get_alias(self, index=None, name=None, **kwargs):
+        """Get the aliases of indices."""
+        self.client.requests['indices.get_alias'] += 1
+        names = self.client.resolve(index or '_all')
+        patterns = _split_names(name)
+        result = {}
+        for index_name in names:
+            aliases = self.client.indices_data[index_name].aliases
+            if patterns:
+                aliases = _matches(aliases, patterns)
+                if not aliases:
+                    continue
+            result[index_name] = dict(
+                aliases=dict((a, {}) for a in aliases))
+        if not result:
+            raise NotFoundError(404, 'aliases_not_found_exception',
+                                dict(index=index, name=name))
+        return result
+
+
+class MemorySearchClient(object):
+    """In-memory stand-in of ``elasticsearch.Elasticsearch``."""
+
+    def __init__(self, version=None):
+        """Constructor.
+
+        :param version: version number returned by :meth:`info`. Defaults to
+            the version of the installed ``elasticsearch`` package.
+        """
+        if version is None:
+            from elasticsearch import VERSION
+            version = '.'.join(str(v) for v in VERSION)
+        self.version = version
+        self.indices_data = OrderedDict()
+        self.templates = {}
+        self.indices = MemoryIndicesClient(self)
+        self.transport = type('Transport', (), dict(
+            serializer=JSONSerializer()))()
+        self.requests = Counter()
+        self._scrolls = {}
+
+    def info(self, **kwargs):
+        """Get the cluster information."""
+        return dict(name='memory', cluster_name='memory',
+                    version=dict(number=self.version))
+
+    def ping(self, **kwargs):
+        """Check that the cluster is up."""
+        return True
+
+    def create_index(self, name):
+        """Create an index, with the mappings and aliases of its templates."""
+        index = MemoryIndex(name)
+        templates = sorted(
+            (t for t in self.templates.values()
+             if _matches([name], t.get('index_patterns') or
+                         [t.get('template', '')])),
+            key=lambda t: t.get('order', 0))
+        for template in templates:
+            index.add_mappings(template.get('mappings'))
+            index.aliases.update(template.get('aliases') or {})
+        self.indices_data[name] = index
+        return index
+
+    def resolve(self, index, ignore_unavailable=False, aliases=True):
+        """Get the names of the indices matching names, aliases or patterns.
+
+        :raises elasticsearch.exceptions.NotFoundError: if a name which is
+            not a pattern matches no index.
+        """
+        names = _split_names(index) or ['_all']
+        result = []
+        for name in names:
+            if name in ('_all', '*'):
+                matched = list(self.indices_data)
+            elif name in self.indices_data:
+                matched = [name]
+            else:
+                patterns = [name]
+                matched = _matches(self.indices_data, patterns)
+                if aliases:
+                    matched += [
+                        n for n, i in self.indices_data.items()
+                        if _matches(i.aliases, patterns)]
+                if not matched and not ignore_unavailable and \
+                        '*' not in name:
+                    raise NotFoundError(
+                        404, 'index_not_found_exception',
+                        dict(error=dict(type='index_not_found_exception',
+                                        index=name)))
+            for match in matched:
+                if match not in result:
+                    result.append(match)
+        return result
+
+    #
+    # Documents
+    #
+    def _write(self, op_type, meta, source):
+        """Execute a bulk action.
+
+        :returns: the bulk item.
+        """
+        index_name = meta.get('_index')
+        doc_type = meta.get('_type')
+        doc_id = meta.get('_id')
+        item = dict(_index=index_name, _type=doc_type, _id=doc_id)
+        if index_name not in self.indices_data:
+            aliased = [n for n, i in self.indices_data.items()
+                       if index_name in i.aliases]
+            if len(aliased) == 1:
+                index_name = item['_index'] = aliased[0]
+            elif op_type == 'delete':
+                item.update(status=404, found=False)
+                return item
+            else:
+                self.create_index(index_name)
+        index = self.indices_data[index_name]
+        if doc_id is None:
+            doc_id = item['_id'] = uuid.uuid4().hex
+        row = index.positions.get((doc_type, doc_id))
+        version = meta.get('_version')
+        if version is not None and (row is None or
+                                    index.versions[row] != version):
+            item.update(status=409, error=dict(
+                type='version_conflict_engine_exception',
+                reason='[{0}][{1}]: version conflict'.format(
+                    doc_type, doc_id)))
+            return item
+        if op_type == 'delete':
+            found = index.remove(doc_type, doc_id)
+            item.update(status=200 if found else 404, found=found)
+            return item
+        if op_type == 'create' and row is not None:
+            item.update(status=409, error=dict(
+                type='document_already_exists_exception',
+                reason='[{0}][{1}]: document already exists'.format(
+                    doc_type, doc_id)))
+            return item
+        if op_type == 'update':
+            if row is None:
+                if not source.get('doc_as_upsert') and \
+                        'upsert' not in source:
+                    item.update(status=404, error=dict(
+                        type='document_missing_exception'))
+                    return item
+                new_source = source.get('upsert') or source.get('doc', {})
+            else:
+                new_source = dict(index.sources[row])
+                new_source.update(source.get('doc', {}))
+            source = new_source
+        item['_version'] = index.put(doc_type, doc_id, source,
+                                     meta.get('_routing'))
+        item['status'] = 201 if item['_version'] == 1 else 200
+        return item
+
+    def bulk(self, body, index=None, doc_type=None, **kwargs):
+        """Execute actions on documents."""
+        self.requests['bulk'] += 1
+        start = time.time()
+        if isinstance(body, six.binary_type):
+            body = body.decode('utf-8')
+        if isinstance(body, six.string_types):
+            lines = [json.loads(line) for line in body.splitlines()
+                     if line.strip()]
+        else:
+            lines = list(body)
+        items = []
+        i = 0
+        while i < len(lines):
+            op_type, meta = list(lines[i].items())[0]
+            meta = dict(meta)
+            meta.setdefault('_index', index)
+            meta.setdefault('_type', doc_type)
+            source = None
+            if op_type != 'delete':
+                i += 1
+                source = lines[i]
+            i += 1
+            items.append({op_type: self._write(op_type, meta, source)})
+        return dict(
+            took=int((time.time() - start) * 1000),
+            errors=any(not 200 <= list(item.values())[0]['status'] < 300
+                       for item in items),
+            items=items)
+
+    @_ignorable
+    def index(self, index, doc_type, body, id=None, **kwargs):
+        """Index a document."""
+        self.requests['index'] += 1
+        meta = dict(_index=index, _type=doc_type, _id=id,
+                    _version=kwargs.get('version'),
+                    _routing=kwargs.get('routing'))
+        item = self._write(kwargs.get('op_type', 'index'), meta, body)
+        if item['status'] == 409:
+            raise TransportError(409, item['error']['type'], item)
+        return dict(item, created=item['status'] == 201)
+
+    @_ignorable
+    def get(self, index, id, doc_type=None, **kwargs):
+        """Get a document."""
+        self.requests['get'] += 1
+        for name in self.resolve(index):
+            memory_index = self.indices_data[name]
+            row = memory_index.get(doc_type, id)
+            if row is not None:
+                return self._hit(memory_index, row, found=True)
+        raise NotFoundError(404, 'document_missing', dict(
+            _index=index, _type=doc_type, _id=id, found=False))
+
+    @_ignorable
+    def mget(self, body, index=None, doc_type=None, **kwargs):
+        """Get several documents."""
+        self.requests['mget'] += 1
+        docs = body.get('docs') or [dict(_id=i) for i in body['ids']]
+        result = []
+        for doc in docs:
+            doc_index = doc.get('_index', index)
+            doc_id = doc['_id']
+            doc_type_ = doc.get('_type', doc_type)
+            found = None
+            for name in self.resolve(doc_index, ignore_unavailable=True):
+                memory_index = self.indices_data[name]
+                row = memory_index.get(doc_type_, doc_id)
+                if row is not None:
+                    found = self._hit(memory_index, row, found=True)
+                    break
+            result.append(found or dict(_index=doc_index, _type=doc_type_,
+                                        _id=doc_id, found=False))
+        return dict(docs=result)
+
+    @_ignorable
+    def delete(self, index, doc_type, id, **kwargs):
+        """Delete a document."""
+        self.requests['delete'] += 1
+        item = self._write('delete', dict(
+            _index=index, _type=doc_type, _id=id), None)
+        if not item.get('found'):
+            raise NotFoundError(404, 'not_found', item)
+        return item
+
+    #
+    # Searches
+    #
+    def _hit(self, index, row, found=None, source=True):
+        """Build the hit of a document."""
+        hit = dict(_index=index.name, _type=index.types[row],
+                   _id=index.ids[row], _version=index.versions[row])
+        if found is not None:
+            hit['found'] = found
+        else:
+            hit['_score'] = 1.0
+        if index.routings[row] is not None:
+            hit['_routing'] = index.routings[row]
+        if source is not False:
+            doc = index.sources[row]
+            if source is not True:
+                includes = source if isinstance(source, list) else \
+                    _split_names(source) if \
+                    isinstance(source, six.string_types) else \
+                    source.get('includes') or source.get('include') or []
+                doc = dict((k, v) for k, v in doc.items()
+                           if not includes or k in includes)
+            hit['_source'] = dict(doc)
+        return hit
+
+    def _filter(self, index, rows, query):
+        """Filter the rows of an index matching a query."""
+        if not query:
+            return rows
+        (query_type, params), = query.items()
+        if query_type == 'match_all':
+            return rows
+        elif query_type == 'bool':
+            for clause in ('must', 'filter'):
+                clauses = params.get(clause) or []
+                for sub_query in (clauses if isinstance(clauses, list)
+                                  else [clauses]):
+                    rows = self._filter(index, rows, sub_query)
+            must_not = params.get('must_not') or []
+            for sub_query in (must_not if isinstance(must_not, list)
+                              else [must_not]):
+                excluded = set(self._filter(index, rows, sub_query))
+                rows = [r for r in rows if r not in excluded]
+            should = params.get('should') or []
+            if should:
+                should = should if isinstance(should, list) else [should]
+                # Should clauses are optional next to required clauses.
+                minimum = params.get('minimum_should_match', 0 if (
+                    params.get('must') or params.get('filter')) else 1)
+                matches = Counter()
+                for sub_query in should:
+                    matches.update(self._filter(index, rows, sub_query))
+                rows = [r for r in rows if matches[r] >= int(minimum)]
+            return rows
+        elif query_type == 'constant_score':
+            return self._filter(index, rows, params.get('filter'))
+        elif query_type == 'filtered':
+            rows = self._filter(index, rows, params.get('query'))
+            return self._filter(index, rows, params.get('filter'))
+        elif query_type in ('term', 'terms'):
+            (field, value), = [(k, v) for k, v in params.items()
+                               if k != 'boost']
+            if query_type == 'term':
+                if isinstance(value, dict):
+                    value = value['value']
+                values = {value}
+            else:
+                values = set(value)
+            column = index.column(field)
+            return [r for r in rows if column[r] in values or (
+                isinstance(column[r], list) and values.intersection(
+                    column[r]))]
+        elif query_type == 'ids':
+            ids = set(params['values'])
+            return [r for r in rows if index.ids[r] in ids]
+        elif query_type == 'exists':
+            column = index.column(params['field'])
+            return [r for r in rows if column[r] is not None]
+        elif query_type == 'range':
+            (field, bounds), = params.items()
+            return self._filter_range(index, rows, field, bounds)
+        raise RequestError(400, 'parsing_exception',
+                           'Unsupported query {}'.format(query_type))
+
+    def _filter_range(self, index, rows, field, bounds):
+        """Filter the rows of an index whose field is in a range."""
+        as_date = index.is_date(field) or any(
+            isinstance(v, (datetime.date, six.string_types)) and
+            not _is_number(v) for v in bounds.values())
+        column = index.date_column(field) if as_date else \
+            index.column(field)
+        for op in ('gt', 'gte', 'lt', 'lte'):
+            if bounds.get(op) is None:
+                continue
+            if as_date:
+                bound = parse_date_math(bounds[op],
+                                        round_up=op in ('gt', 'lte'))
+            else:
+                bound = bounds[op]
+            if op == 'gt':
+                rows = [r for r in rows
+                        if column[r] is not None and column[r] > bound]
+            elif op == 'gte':
+                rows = [r for r in rows
+                        if column[r] is not None and column[r] >= bound]
+            elif op == 'lt':
+                rows = [r for r in rows
+                        if column[r] is not None and column[r] < bound]
+            else:
+                rows = [r for r in rows
+                        if column[r] is not None and column[r] <= bound]
+        return rows
+
+    def _select(self, index, doc_type, query, ignore_unavailable=False):
+        """Get the matching rows of each searched index.
+
+        :returns: list of (index, rows) tuples.
+        """
+        types = set(_split_names(doc_type))
+        selection = []
+        for name in self.resolve(index, ignore_unavailable):
+            memory_index = self.indices_data[name]
+            rows = memory_index.rows()
+            if types:
+                rows = [r for r in rows if memory_index.types[r] in types]
+            rows = self._filter(memory_index, rows, query)
+            selection.append((memory_index, rows))
+        return selection
+
+    @staticmethod
+    def _sort(selection, sort):
+        """Sort the documents of a selection.
+
+        :returns: list of (index, row, sort values) tuples.
+        """
+        docs = [(index, row) for index, rows in selection for row in rows]
+        if not sort:
+            return [(index, row, None) for index, row in docs]
+        if not isinstance(sort, list):
+            sort = [sort]
+        keys = []
+        for spec in sort:
+            if isinstance(spec, six.string_types):
+                keys.append((spec, 'asc'))
+            else:
+                for field, order in spec.items():
+                    if isinstance(order, dict):
+                        order = order.get('order', 'asc')
+                    keys.append((field, order))
+
+        def value(index, row, field):
+            if field == '_doc':
+                return row
+            elif field == '_id':
+                return index.ids[row]
+            if index.is_date(field):
+                return index.date_column(field)[row]
+            return index.column(field)[row]
+
+        # Sort by the least significant key first, keeping missing values
+        # at the end whatever the order.
+        for field, order in reversed(keys):
+            present = [d for d in docs
+                       if value(d[0], d[1], field) is not None]
+            missing = docs[len(present):]
+            present.sort(key=lambda d: value(d[0], d[1], field),
+                         reverse=order == 'desc')
+            docs = present + missing
+        return [(index, row, [value(index, row, f) for f, _ in keys])
+                for index, row in docs]
+
+    def _hits(self, selection, body, source=True):
+        """Build the hits of a search."""
+        docs = self._sort(selection, body.get('sort'))
+        start = body.get('from', 0)
+        size = body.get('size', 10)
+        hits = []
+        for index, row, sort_values in docs[start:start + size]:
+            hit = self._hit(index, row, source=body.get('_source', source))
+            if sort_values is not None:
+                hit['_score'] = None
+                hit['sort'] = sort_values
+            hits.append(hit)
+        return hits
+
+    def _aggregate(self, aggs, selection):
+        """Compute aggregations over a selection."""
+        result = {}
+        for name, spec in (aggs or {}).items():
+            sub_aggs = spec.get('aggs') or spec.get('aggregations')
+            agg_type, = [k for k in spec
+                         if k not in ('aggs', 'aggregations', 'meta')]
+            params = spec[agg_type]
+            method = getattr(self, '_agg_{}'.format(agg_type), None)
+            if method is None:
+                raise RequestError(400, 'parsing_exception',
+                                   'Unsupported aggregation {}'.format(
+                                       agg_type))
+            result[name] = method(params, selection, sub_aggs)
+        return result
+
+    def _bucket(self, bucket, selection, sub_aggs):
+        """Add the document count and sub-aggregations of a bucket."""
+        bucket['doc_count'] = sum(len(rows) for _, rows in selection)
+        bucket.update(self._aggregate(sub_aggs, selection))
+        return bucket
+
+    @staticmethod
+    def _group(selection, key_func):
+        """Group the rows of a selection by key.
+
+        :returns: dictionary of key -> selection.
+        """
+        groups = {}
+        for index, rows in selection:
+            index_groups = {}
+            row_key = key_func(index)
+            for row in rows:
+                key = row_key(row)
+                if key is None:
+                    continue
+                if isinstance(key, list):
+                    for k in key:
+                        index_groups.setdefault(k, []).append(row)
+                else:
+                    index_groups.setdefault(key, []).append(row)
+            for key, key_rows in index_groups.items():
+                groups.setdefault(key, []).append((index, key_rows))
+        return groups
+
+    def _agg_date_histogram(self, params, selection, sub_aggs):
+        """Compute a ``date_histogram`` aggregation."""
+        field = params['field']
+        interval = params['interval']
+        unit = CALENDAR_INTERVALS.get(interval)
+        if unit is None:
+            match = re.match(r'(\d+)(ms|[dhms])$', interval)
+            if not match:
+                raise RequestError(400, 'parsing_exception',
+                                   'Invalid interval {}'.format(interval))
+            fixed = int(match.group(1)) * FIXED_UNITS[match.group(2)]
+
+        def key_func(index):
+            column = index.date_column(field)
+            if unit is None:
+                return lambda row: None if column[row] is None else \
+                    column[row] - column[row] % fixed
+            cache = {}
+
+            def key(row):
+                millis = column[row]
+                if millis is None:
+                    return None
+                day = millis - millis % DAY
+                if unit in ('year', 'quarter', 'month'):
+                    if day not in cache:
+                        cache[day] = floor_date(day, unit)
+                    return cache[day]
+                return floor_date(millis, unit)
+            return key
+
+        groups = self._group(selection, key_func)
+        date_format = DEFAULT_DATE_FORMAT
+        for index, _ in selection:
+            if index.is_date(field):
+                date_format = index.date_format(field)
+                break
+        keys = sorted(groups)
+        min_doc_count = params.get('min_doc_count', 0)
+        if keys and min_doc_count == 0:
+            all_keys = []
+            key = keys[0]
+            while key <= keys[-1]:
+                all_keys.append(key)
+                key = key + fixed if unit is None else add_date(key, unit)
+            keys = all_keys
+        buckets = []
+        for key in keys:
+            bucket = dict(
+                key=key,
+                key_as_string=_to_datetime(key).strftime(date_format))
+            bucket = self._bucket(bucket, groups.get(key, []), sub_aggs)
+            if bucket['doc_count'] >= min_doc_count:
+                buckets.append(bucket)
+        return dict(buckets=buckets)
+
+    def _agg_terms(self, params, selection, sub_aggs):
+        """Compute a ``terms`` aggregation."""
+        field = params['field']
+        groups = self._group(
+            selection, lambda index: index.column(field).__getitem__)
+        counts = [(key, sum(len(rows) for _, rows in group))
+                  for key, group in groups.items()]
+        counts.sort(key=lambda c: (-c[1], _term_sort_key(c[0])))
+        size = params.get('size', 10)
+        min_doc_count = params.get('min_doc_count', 1)
+        counts = [c for c in counts if c[1] >= min_doc_count]
+        shown = counts[:size] if size else counts
+        buckets = []
+        for key, _ in shown:
+            bucket = dict(key=key)
+            if isinstance(key, bool):
+                bucket = dict(key=int(key), key_as_string=str(key).lower())
+            buckets.append(self._bucket(bucket, groups[key], sub_aggs))
+        return dict(
+            doc_count_error_upper_bound=0,
+            sum_other_doc_count=sum(c[1] for c in counts[len(shown):]),
+            buckets=buckets)
+
+    def _agg_top_hits(self, params, selection, sub_aggs):
+        """Compute a ``top_hits`` aggregation."""
+        return dict(hits=dict(
+            total=sum(len(rows) for _, rows in selection),
+            max_score=None,
+            hits=self._hits(selection, dict(params, size=params.get(
+                'size', 3)))))
+
+    @staticmethod
+    def _values(params, selection):
+        """Get the numeric values of a metric aggregation."""
+        field = params['field']
+        missing = params.get('missing')
+        values = []
+        for index, rows in selection:
+            column = index.date_column(field) if index.is_date(field) \
+                else index.column(field)
+            for row in rows:
+                value = column[row]
+                if value is None:
+                    value = missing
+                if value is None:
+                    continue
+                if isinstance(value, list):
+                    values.extend(value)
+                else:
+                    values.append(value)
+        return values
+
+    def _agg_sum(self, params, selection, sub_aggs):
+        """Compute a ``sum`` aggregation."""
+        return dict(value=float(sum(self._values(params, selection))))
+
+    def _agg_min(self, params, selection, sub_aggs):
+        """Compute a ``min`` aggregation."""
+        values = self._values(params, selection)
+        return dict(value=float(min(values)) if values else None)
+
+    def _agg_max(self, params, selection, sub_aggs):
+        """Compute a ``max`` aggregation."""
+        values = self._values(params, selection)
+        return dict(value=float(max(values)) if values else None)
+
+    def _agg_avg(self, params, selection, sub_aggs):
+        """Compute an ``avg`` aggregation."""
+        values = self._values(params, selection)
+        return dict(value=sum(values) / float(len(values))
+                    if values else None)
+
+    def _agg_value_count(self, params, selection, sub_aggs):
+        """Compute a ``value_count`` aggregation."""
+        return dict(value=len(self._values(params, selection)))
+
+    def _agg_stats(self, params, selection, sub_aggs):
+        """Compute a ``stats`` aggregation."""
+        values = self._values(params, selection)
+        return dict(
+            count=len(values),
+            min=float(min(values)) if values else None,
+            max=float(max(values)) if values else None,
+            avg=sum(values) / float(len(values)) if values else None,
+            sum=float(sum(values)))
+
+    def _agg_cardinality(self, params, selection, sub_aggs):
+        """Compute an exact ``cardinality`` aggregation."""
+        field = params['field']
+        values = set()
+        for index, rows in selection:
+            column = index.column(field)
+            values.update(column[row] for row in rows
+                          if column[row] is not None)
+        return dict(value=len(values))
+
+    def _search(self, index=None, doc_type=None, body=None, **kwargs):
+        """Run a search and build its response."""
+        start = time.time()
+        body = dict(body or {})
+        for param in ('size', 'from', 'sort', '_source'):
+            if kwargs.get(param) is not None:
+                body[param] = kwargs[param]
+        if kwargs.get('from_') is not None:
+            body['from'] = kwargs['from_']
+        ignore_unavailable = kwargs.get('ignore_unavailable') in (
+            True, 'true')
+        selection = self._select(index, doc_type, body.get('query'),
+                                 ignore_unavailable)
+        response = dict(
+            timed_out=False,
+            _shards=dict(total=max(len(selection), 1),
+                         successful=max(len(selection), 1), failed=0),
+            hits=dict(total=sum(len(rows) for _, rows in selection),
+                      max_score=1.0, hits=[]))
+        if kwargs.get('scroll'):
+            scroll_id = uuid.uuid4().hex
+            docs = [dict(self._hit(i, r, source=body.get('_source', True)))
+                    for i, r, _ in self._sort(selection, body.get('sort'))]
+            self._scrolls[scroll_id] = (docs, body.get('size', 10))
+            response['_scroll_id'] = scroll_id
+            if kwargs.get('search_type') != 'scan':
+                response['hits']['hits'] = self._next_page(scroll_id)
+        else:
+            response['hits']['hits'] = self._hits(selection, body)
+        aggs = body.get('aggs') or body.get('aggregations')
+        if aggs:
+            response['aggregations'] = self._aggregate(aggs, selection)
+        response['took'] = int((time.time() - start) * 1000)
+        return response
+
+    @_ignorable
+    def search(self, index=None, doc_type=None, body=None, **kwargs):
+        """Search documents."""
+        self.requests['search'] += 1
+        return self._search(index, doc_type, body, **kwargs)
+
+    @_ignorable
+    def count(self, index=None, doc_type=None, body=None, **kwargs):
+        """Count documents."""
+        self.requests['count'] += 1
+        selection = self._select(index, doc_type, (body or {}).get('query'),
+                                 kwargs.get('ignore_unavailable', False))
+        return dict(count=sum(len(rows) for _, rows in selection),
+                    _shards=dict(total=1, successful=1, failed=0))
+
+    def _next_page(self, scroll_id):
+        """Get the next page of hits of a scroll."""
+        docs, size = self._scrolls[scroll_id]
+        self._scrolls[scroll_id] = (docs[size:], size)
+        return docs[:size]
+
+    @_ignorable
+    def scroll(self, scroll_id, **kwargs):
+        """Get the next page of a scroll search."""
+        self.requests['scroll'] += 1
+        if scroll_id not in self._scrolls:
+            raise NotFoundError(404, 'search_context_missing_exception',
+                                dict(scroll_id=scroll_id))
+        hits = self._next_page(scroll_id)
+        return dict(_scroll_id=scroll_id, timed_out=False,
+                    _shards=dict(total=1, successful=1, failed=0),
+                    hits=dict(total=len(hits), max_score=None, hits=hits))
+
+    @_ignorable
+    def clear_scroll(self, scroll_id=None, body=None, **kwargs):
+        """Delete scroll searches."""
+        scroll_ids = (body or {}).get('scroll_id') or [scroll_id]
+        for scroll_id in scroll_ids:
+            self._scrolls.pop(scroll_id, None)
+        return dict(succeeded=True)
+
+    @_ignorable
+    def msearch(self, body, index=None, doc_type=None, **kwargs):
+        """Run several searches."""
+        self.requests['msearch'] += 1
+        if isinstance(body, six.string_types):
+            body = [json.loads(line) for line in body.splitlines()
+                    if line.strip()]
+        responses = []
+        for header, search_body in zip(body[::2], body[1::2]):
+            params = dict(header)
+            search_index = params.pop('index', index)
+            search_type = params.pop('type', doc_type)
+            try:
+                responses.append(self._search(
+                    search_index, search_type, search_body, **params))
+            except TransportError as e:
+                responses.append(dict(
+                    error=e.info if isinstance(e.info, dict) else
+                    dict(type=e.error, reason=e.info),
+                    status=e.status_code))
+        return dict(responses=responses)
+
+
+def put_contrib_templates(client, paths=FILE_DOWNLOAD_TEMPLATES):
+    """Put index templates of :mod:`invenio_stats.contrib` in a client.
+
+    :param client: the :class:`MemorySearchClient`.
+    :param paths: paths of the templates, relative to the contrib package.
+        Defaults to the Elasticsearch 2 templates of the file-download events
+        and aggregations.
+    """
+    from . import contrib
+    for path in paths:
+        with open(os.path.join(os.path.dirname(contrib.__file__), path)) as f:
+            client.indices.put_template(path, json.load(f))
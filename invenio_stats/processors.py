@@ -11,17 +11,41 @@
 from __future__ import absolute_import, print_function
 
 import hashlib
+import threading
+from collections import defaultdict
 from time import mktime
 
-import arrow
-import elasticsearch
-from counter_robots import is_machine, is_robot
-from dateutil import parser
 from flask import current_app
-from invenio_search import current_search_client
-from pytz import utc
 
-from .utils import get_anonymization_salt, get_geoip, obj_or_import_string
+from .codecs import iter_events
+from .tracing import trace_client
+from .utils import get_anonymization_salt, get_geoip, get_search_client, \
+    obj_or_import_string
+
+_arrow = None
+_robots_detection = None
+
+
+def _get_arrow():
+    """Get the :mod:`arrow` module, imported on first use."""
+    global _arrow
+    if _arrow is None:
+        import arrow
+        _arrow = arrow
+    return _arrow
+
+
+def _get_robots_detection():
+    """Get the robots and machines detection functions, imported on first use.
+
+    :returns: the ``is_robot`` and ``is_machine`` functions of
+        :mod:`counter_robots`.
+    """
+    global _robots_detection
+    if _robots_detection is None:
+        from counter_robots import is_machine, is_robot
+        _robots_detection = (is_robot, is_machine)
+    return _robots_detection
 
 
 def anonymize_user(doc):
@@ -58,7 +82,7 @@ def anonymize_user(doc):
     # one hour. timeslice represents the hour of the day in which
     # the event has been generated and together with user info it determines
     # the 'User Session'
-    timestamp = arrow.get(doc.get('timestamp'))
+    timestamp = _get_arrow().get(doc.get('timestamp'))
     timeslice = timestamp.strftime('%Y%m%d%H')
     salt = get_anonymization_salt(timestamp)
 
@@ -105,7 +129,8 @@ def flag_robots(doc):
     into robots and machines by `the Make Data Count project
     <https://github.com/CDLUC3/Make-Data-Count/tree/master/user-agents>`_.
     """
-    doc['is_robot'] = 'user_agent' in doc and is_robot(doc['user_agent'])
+    doc['is_robot'] = 'user_agent' in doc and \
+        _get_robots_detection()[0](doc['user_agent'])
     return doc
 
 
@@ -120,7 +145,8 @@ def flag_machines(doc):
     <https://github.com/CDLUC3/Make-Data-Count/tree/master/user-agents>`_.
 
     """
-    doc['is_machine'] = 'user_agent' in doc and is_machine(doc['user_agent'])
+    doc['is_machine'] = 'user_agent' in doc and \
+        _get_robots_detection()[1](doc['user_agent'])
     return doc
 
 
@@ -134,17 +160,28 @@ def hash_id(iso_timestamp, msg):
                             hexdigest())
 
 
+def _robot_counter():
+    """Create the daily counter of robot and machine events."""
+    return dict(robots=0, machines=0)
+
+
 class EventsIndexer(object):
     """Simple events indexer.
 
     Subclass this class in order to provide custom indexing behaviour.
+
+    The indexers are built once per process and shared, see
+    :meth:`invenio_stats.ext._InvenioStatsState.get_processor`. The robot
+    counts of a run are kept in the indexer, thus concurrent runs are
+    serialized.
     """
 
     default_preprocessors = [flag_robots, anonymize_user]
     """Default preprocessors ran on every event."""
 
     def __init__(self, queue, prefix='events', suffix='%Y-%m-%d', client=None,
-                 preprocessors=None, double_click_window=10):
+                 preprocessors=None, double_click_window=10,
+                 routing_field=None, drop_robots=False):
         """Initialize indexer.
 
         :param prefix: prefix appended to elasticsearch indices' name.
@@ -156,9 +193,19 @@ class EventsIndexer(object):
             event before it is indexed. Each function should return the
             processed event. If it returns None, the event is filtered and
             won't be indexed.
+        :param routing_field: field of the event used as routing value, e.g.
+            ``unique_id``. All the events with the same value are then stored
+            in the same shard. Changing it on existing indices would index
+            the same event twice in different shards.
+        :param drop_robots: discard the events flagged by the
+            :func:`flag_robots` or :func:`flag_machines` preprocessors instead
+            of indexing them. Only the number of discarded events is kept, in
+            one document per day of the ``robots-<events index>`` index.
         """
         self.queue = queue
-        self.client = client or current_search_client
+        self.client = trace_client(
+            client if client is not None else get_search_client(),
+            'indexer', queue.routing_key)
         self.doctype = queue.routing_key
         self.index = '{0}-{1}'.format(prefix, self.queue.routing_key)
         self.suffix = suffix
@@ -167,10 +214,103 @@ class EventsIndexer(object):
             obj_or_import_string(preproc) for preproc in preprocessors
         ] if preprocessors is not None else self.default_preprocessors
         self.double_click_window = double_click_window
+        self.routing_field = routing_field
+        self.drop_robots = drop_robots
+        self.robots_index = 'robots-{}'.format(self.index)
+        self.robot_counts = defaultdict(_robot_counter)
+        self._robot_ids = set()
+        self._run_lock = threading.Lock()
+
+    def _count_robot(self, msg, event_id):
+        """Count a discarded robot or machine event.
+
+        Like the indexed events, the events having the same id as an event
+        already counted in the run, i.e. the double clicks, are counted once.
+        """
+        if event_id in self._robot_ids:
+            return
+        self._robot_ids.add(event_id)
+        day = _get_arrow().get(msg.get('timestamp')).strftime('%Y-%m-%d')
+        weight = msg.get('weight', 1)
+        if msg.get('is_robot'):
+            self.robot_counts[day]['robots'] += weight
+        if msg.get('is_machine'):
+            self.robot_counts[day]['machines'] += weight
+
+    def save_robot_counts(self, retries=3):
+        """Add the counted robot and machine events to the daily counters.
+
+        Counters are updated with optimistic concurrency control, so that
+        concurrent indexers do not overwrite each other's counts.
+        """
+        from elasticsearch.helpers import bulk
+        counts = self.robot_counts
+        for _ in range(retries):
+            if not counts:
+                return
+            docs = self.client.mget(
+                index=self.robots_index, doc_type='robot-counter',
+                body={'ids': sorted(counts)})['docs']
+            actions = []
+            for doc in docs:
+                day = doc['_id']
+                source = doc['_source'] if doc.get('found') else \
+                    dict(timestamp=day, robots=0, machines=0)
+                source['robots'] += counts[day]['robots']
+                source['machines'] += counts[day]['machines']
+                action = dict(_index=self.robots_index,
+                              _type='robot-counter', _id=day, _source=source)
+                if doc.get('found'):
+                    action['_version'] = doc['_version']
+                else:
+                    action['_op_type'] = 'create'
+                actions.append(action)
+            _, errors = bulk(self.client, actions, raise_on_error=False)
+            conflicts = {}
+            for error in errors:
+                for info in error.values():
+                    if info.get('status') == 409:
+                        conflicts[info['_id']] = counts[info['_id']]
+                    else:
+                        current_app.logger.error(
+                            u'Could not update the robot counter: %s', info)
+            # Retry the days whose counters were updated concurrently
+            counts = conflicts
+        if counts:
+            current_app.logger.error(
+                u'Could not update the robot counters of %s', sorted(counts))
+
+    def get_robot_counts(self, start_date=None, end_date=None):
+        """Get the number of discarded robot and machine events per day.
+
+        :param start_date: first day, included.
+        :param end_date: last day, included.
+        :returns: dictionary of day -> dictionary of the robots and machines
+            events counts.
+        """
+        from elasticsearch_dsl import Search
+        if not self.client.indices.exists(index=self.robots_index):
+            return {}
+        search = Search(using=self.client, index=self.robots_index,
+                        doc_type='robot-counter')
+        range_args = {}
+        if start_date:
+            range_args['gte'] = start_date.strftime('%Y-%m-%d')
+        if end_date:
+            range_args['lte'] = end_date.strftime('%Y-%m-%d')
+        if range_args:
+            search = search.filter('range', timestamp=range_args)
+        return dict(
+            (hit.meta.id, dict(robots=hit.robots, machines=hit.machines))
+            for hit in search.scan()
+        )
 
     def actionsiter(self):
         """Iterator."""
-        for msg in self.queue.consume():
+        from dateutil import parser
+        from pytz import utc
+        arrow = _get_arrow()
+        for msg in iter_events(self.queue.consume()):
             try:
                 for preproc in self.preprocessors:
                     msg = preproc(msg)
@@ -192,21 +332,43 @@ class EventsIndexer(object):
                         timestamp // self.double_click_window *
                         self.double_click_window
                     )
-                yield dict(
-                    _id=hash_id(ts.isoformat(), msg),
+                event_id = hash_id(ts.isoformat(), msg)
+                if self.drop_robots and \
+                        (msg.get('is_robot') or msg.get('is_machine')):
+                    self._count_robot(msg, event_id)
+                    continue
+                action = dict(
+                    _id=event_id,
                     _op_type='index',
                     _index='{0}-{1}'.format(self.index, suffix),
                     _type=self.doctype,
                     _source=msg,
                 )
+                if self.routing_field and msg.get(self.routing_field):
+                    action['_routing'] = msg[self.routing_field]
+                yield action
             except Exception:
                 current_app.logger.exception(u'Error while processing event')
 
     def run(self):
         """Process events queue."""
-        return elasticsearch.helpers.bulk(
-            self.client,
-            self.actionsiter(),
-            stats_only=True,
-            chunk_size=50
-        )
+        import elasticsearch.helpers
+        with self._run_lock:
+            self.robot_counts = defaultdict(_robot_counter)
+            self._robot_ids = set()
+            try:
+                return elasticsearch.helpers.bulk(
+                    self.client,
+                    self.actionsiter(),
+                    stats_only=True,
+                    chunk_size=50
+                )
+            finally:
+                # The consumed robot events are counted even if indexing
+                # the other events failed.
+                if self.robot_counts:
+                    try:
+                        self.save_robot_counts()
+                    except Exception:
+                        current_app.logger.exception(
+                            u'Could not save the robot counters')
@@ -8,55 +8,323 @@
 
 """Query processing classes."""
 
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
-import dateutil.parser
 import six
-from elasticsearch_dsl import Search
-from invenio_search import current_search_client
+from flask import current_app
 
 from .errors import InvalidRequestInputError
+from .proxies import current_stats
+from .status import get_aggregated_until
+from .tracing import TracedClient, trace_client
+from .utils import INDEX_INTERVAL_SUFFIXES, get_search_client, \
+    get_time_based_indices
 
 
 class ESQuery(object):
     """Elasticsearch query."""
 
+    max_pruned_indices = 100
+    """Maximum number of indices targeted instead of the queried alias."""
+
     def __init__(self, query_name, doc_type, index, client=None,
+                 index_interval=None, routing_field=None,
+                 near_real_time=False, aggregation=None, event_fields=None,
                  *args, **kwargs):
         """Constructor.
 
         :param doc_type: queried document type.
         :param index: queried index.
         :param client: elasticsearch client used to query.
+        :param index_interval: time window of the indices behind the queried
+            alias, i.e. the ``index_interval`` of the aggregation writing
+            them. When set, queries having a start and an end date only
+            search the indices of this date range.
+        :param routing_field: field used as routing value by the aggregation
+            writing the queried documents. Queries filtering on this field
+            are routed to the shard holding its value.
+        :param near_real_time: add the events which are not aggregated yet
+            to the results. They are counted from the raw events of the
+            ``aggregation``, in the same multi-search request as the
+            aggregated documents. Only the ``sum`` metrics of the ``count``
+            and of the summed fields of the aggregation are completed.
+        :param aggregation: name of the aggregation writing the queried
+            documents. Required by ``near_real_time``.
+        :param event_fields: Dict of "aggregated field" -> "event field" for
+            the filtered and aggregated fields whose names differ in the raw
+            events.
         """
         super(ESQuery, self).__init__()
         self.index = index
-        self.client = client or current_search_client
+        self.client = trace_client(
+            client if client is not None else get_search_client(),
+            'query', query_name)
         self.query_name = query_name
         self.doc_type = doc_type
+        self.index_interval = index_interval
+        self.routing_field = routing_field
+        if near_real_time and not aggregation:
+            raise ValueError('Near real time query {} requires the name of '
+                             'its aggregation.'.format(query_name))
+        self.near_real_time = near_real_time
+        self.aggregation = aggregation
+        self.event_fields = event_fields or {}
+        self.aggregated_until = None
+
+    def get_search(self, start_date=None, end_date=None):
+        """Create the search on the indices covering a date range.
+
+        Unbounded ranges search the whole ``index`` alias. Missing indices
+        are ignored.
+        """
+        from elasticsearch_dsl import Search
+        index = self.index
+        if self.index_interval and start_date and end_date:
+            indices = get_time_based_indices(
+                self.index, INDEX_INTERVAL_SUFFIXES[self.index_interval],
+                start_date, end_date, max_indices=self.max_pruned_indices)
+            if indices is not None:
+                index = indices
+        search = Search(using=self.client, index=index,
+                        doc_type=self.doc_type)
+        if index is not self.index:
+            search = search.params(ignore_unavailable=True)
+        return search
 
     def extract_date(self, date):
         """Extract date from string if necessary.
 
-        :returns: the extracted date.
+        :returns: the extracted date, as a naive UTC datetime.
         """
         if isinstance(date, six.string_types):
+            import dateutil.parser
             try:
                 date = dateutil.parser.parse(date)
-            except ValueError:
+            except (OverflowError, ValueError):
                 raise ValueError(
                     'Invalid date format for statistic {}.'
-                ).format(self.query_name)
+                    .format(self.query_name))
         if not isinstance(date, datetime):
             raise TypeError(
                 'Invalid date type for statistic {}.'
-            ).format(self.query_name)
+                .format(self.query_name))
+        if date.utcoffset() is not None:
+            # Dates are compared with the naive UTC dates of the indices
+            try:
+                date = date.replace(tzinfo=None) - date.utcoffset()
+            except OverflowError:
+                raise ValueError(
+                    'Invalid date for statistic {}.'.format(self.query_name))
         return date
 
-    def run(self, *args, **kwargs):
-        """Run the query."""
+    def apply_routing(self, search, filters, **kwargs):
+        """Route a search filtering on the routing field.
+
+        :param search: the search to route.
+        :param filters: Dict of "query parameter" -> "filtered field".
+        :param kwargs: the query parameters.
+        """
+        if self.routing_field:
+            for query_param, filtered_field in filters.items():
+                if filtered_field == self.routing_field and \
+                        query_param in kwargs:
+                    return search.params(routing=kwargs[query_param])
+        return search
+
+    def parse_arguments(self, **kwargs):
+        """Parse and validate the query arguments.
+
+        :returns: dict of the arguments given to ``build_query`` and
+            ``process_query_result``.
+        """
+        raise NotImplementedError()
+
+    def build_query(self, **kwargs):
+        """Build the elasticsearch query."""
+        raise NotImplementedError()
+
+    def process_query_result(self, query_result, **kwargs):
+        """Build the result using the query result."""
+        raise NotImplementedError()
+
+    def get_events_search(self, lower, upper, filters, **kwargs):
+        """Create the search of the raw events of the query's aggregation.
+
+        :param lower: first date of the events (inclusive), or ``None``.
+        :param upper: last date of the events (exclusive), or ``None``.
+        :param filters: Dict of "query parameter" -> "filtered field".
+        :param kwargs: the query parameters.
+        """
+        from elasticsearch_dsl import Search
+        aggregator = current_stats.get_aggregator(self.aggregation)
+        index = aggregator.event_index
+        if lower is not None:
+            indices = get_time_based_indices(
+                aggregator.event_index, aggregator.event_index_suffix, lower,
+                upper or datetime.utcnow(),
+                max_indices=self.max_pruned_indices)
+            if indices is not None:
+                index = indices
+        search = Search(using=self.client, index=index)[0:0]
+        if index is not aggregator.event_index:
+            search = search.params(ignore_unavailable=True)
+        time_range = {}
+        if lower is not None:
+            time_range['gte'] = lower.isoformat()
+        if upper is not None:
+            time_range['lt'] = upper.isoformat()
+        if time_range:
+            search = search.filter('range', timestamp=time_range)
+        for modifier in aggregator.query_modifiers:
+            search = modifier(search)
+        for query_param, filtered_field in filters.items():
+            if query_param in kwargs:
+                search = search.filter('term', **{
+                    self.event_fields.get(filtered_field, filtered_field):
+                    kwargs[query_param]})
+        return search
+
+    def get_tail_search(self, start_date, end_date, filters, **kwargs):
+        """Create the search of the events which are not aggregated yet.
+
+        :param filters: Dict of "query parameter" -> "filtered field".
+        :param kwargs: the query parameters.
+        :returns: the search, or ``None`` if the date range is fully
+            aggregated.
+        """
+        aggregator = current_stats.get_aggregator(self.aggregation)
+        self.aggregated_until = until = \
+            get_aggregated_until(self.aggregation)
+        upper = None
+        if end_date is not None:
+            # Aggregated documents are selected by the start of their
+            # interval, thus the whole interval of the end date is included.
+            upper = aggregator._next_interval_dt(
+                aggregator._truncate_dt(end_date))
+            if until is not None and until >= upper:
+                return None
+        lower = max(d for d in (until, start_date) if d is not None) \
+            if until is not None or start_date is not None else None
+        return self.get_events_search(lower, upper, filters, **kwargs)
+
+    def get_tail_metrics(self, metric_fields):
+        """Get the metrics of the events completing the aggregated metrics.
+
+        :param metric_fields: Dict of "destination field" ->
+            tuple("metric type", "source field", "metric_options").
+        :returns: Dict of "destination field" -> tuple("metric type",
+            "event field", "metric_options"), or ``None`` for the number
+            of events.
+        """
+        aggregator = current_stats.get_aggregator(self.aggregation)
+        sources = dict(count=None)
+        if aggregator.weight_field:
+            sources['count'] = ('sum', aggregator.weight_field,
+                                dict(missing=1))
+        for dst, (metric, src, opts) in \
+                aggregator.metric_aggregation_fields.items():
+            if metric == 'sum':
+                sources[dst] = ('sum', src, {})
+        return dict(
+            (dst, sources[field])
+            for dst, (metric, field, _) in metric_fields.items()
+            if metric == 'sum' and field in sources
+        )
+
+    @staticmethod
+    def get_tail_values(agg, tail_metrics, doc_count):
+        """Get the metrics of a bucket of the events search."""
+        return dict(
+            (dst, agg[dst]['value'] if spec is not None else doc_count)
+            for dst, spec in tail_metrics.items()
+        )
+
+    def build_tail_query(self, **kwargs):
+        """Build the search of the events which are not aggregated yet."""
+        raise NotImplementedError()
+
+    def merge_tail_result(self, result, tail_result, **kwargs):
+        """Add the events which are not aggregated yet to the result."""
         raise NotImplementedError()
 
+    def build_searches(self, **kwargs):
+        """Build the searches of the query, sent in one multi-search.
+
+        :returns: the search of the aggregated documents, followed by the
+            search of the events which are not aggregated yet for near real
+            time queries.
+        """
+        searches = [self.build_query(**kwargs)]
+        if self.near_real_time:
+            tail = self.build_tail_query(**kwargs)
+            if tail is not None:
+                searches.append(tail)
+        return searches
+
+    def process_responses(self, responses, **kwargs):
+        """Build the result using the responses of the searches.
+
+        The results of near real time queries carry a ``freshness`` marker
+        giving the date up to which the events are aggregated and the date
+        of the query, the events in between being counted from the raw
+        events.
+        """
+        result = self.process_query_result(responses[0], **kwargs)
+        if len(responses) > 1:
+            self.merge_tail_result(result, responses[1], **kwargs)
+        if self.near_real_time:
+            result['freshness'] = dict(
+                aggregated_until=self.aggregated_until.isoformat()
+                if self.aggregated_until else None,
+                as_of=datetime.utcnow().replace(microsecond=0).isoformat(),
+            )
+        return result
+
+    def run(self, **kwargs):
+        """Run the query."""
+        arguments = self.parse_arguments(**kwargs)
+        searches = self.build_searches(**arguments)
+        if len(searches) == 1:
+            responses = [searches[0].execute().to_dict()]
+        else:
+            responses = msearch(self.client, searches)
+            for response in responses:
+                if isinstance(response, Exception):
+                    raise response
+        return self.process_responses(responses, **arguments)
+
+
+def msearch(client, searches, query_names=None):
+    """Execute several searches in a single multi-search request.
+
+    :param client: elasticsearch client used to run the searches.
+    :param searches: list of ``elasticsearch_dsl.Search``.
+    :param query_names: names of the queries grouped in the request, which
+        are traced with it.
+    :returns: list containing for each search either its response as a dict
+        or the ``TransportError`` describing why it failed.
+    """
+    from elasticsearch.exceptions import TransportError
+    if query_names is not None and isinstance(client, TracedClient):
+        client = client.grouped(query_names)
+    body = []
+    for search in searches:
+        header = {}
+        if search._index:
+            header['index'] = search._index
+        if search._doc_type:
+            header['type'] = search._doc_type
+        header.update(search._params)
+        body.extend([header, search.to_dict()])
+    responses = client.msearch(body=body)['responses']
+    return [
+        TransportError(response.get('status', 'N/A'), 'msearch_error',
+                       response['error'])
+        if 'error' in response else response
+        for response in responses
+    ]
+
 
 class ESDateHistogramQuery(ESQuery):
     """Elasticsearch date histogram query."""
@@ -109,9 +377,7 @@ class ESDateHistogramQuery(ESQuery):
 
     def build_query(self, interval, start_date, end_date, **kwargs):
         """Build the elasticsearch query."""
-        agg_query = Search(using=self.client,
-                           index=self.index,
-                           doc_type=self.doc_type)[0:0]
+        agg_query = self.get_search(start_date, end_date)[0:0]
         if start_date is not None or end_date is not None:
             time_range = {}
             if start_date is not None:
@@ -146,10 +412,58 @@ class ESDateHistogramQuery(ESQuery):
                     'term', **{filtered_field: kwargs[query_param]}
                 )
 
-        return agg_query
+        return self.apply_routing(agg_query, self.required_filters, **kwargs)
+
+    def build_tail_query(self, interval, start_date, end_date, **kwargs):
+        """Build the search of the events which are not aggregated yet."""
+        search = self.get_tail_search(start_date, end_date,
+                                      self.required_filters, **kwargs)
+        if search is None:
+            return None
+        base_agg = search.aggs.bucket(
+            'histogram',
+            'date_histogram',
+            field='timestamp',
+            interval=interval
+        )
+        for dst, spec in self.get_tail_metrics(self.metric_fields).items():
+            if spec is not None:
+                base_agg.metric(dst, spec[0], field=spec[1], **spec[2])
+        if self.copy_fields:
+            base_agg.metric(
+                'top_hit', 'top_hits', size=1, sort={'timestamp': 'desc'}
+            )
+        return search
+
+    def merge_tail_result(self, result, tail_result, **kwargs):
+        """Add the events which are not aggregated yet to the result."""
+        tail_metrics = self.get_tail_metrics(self.metric_fields)
+        buckets = dict((b['key'], b) for b in result['buckets'])
+        for agg in tail_result['aggregations']['histogram']['buckets']:
+            if not agg['doc_count']:
+                continue
+            bucket = buckets.get(agg['key'])
+            if bucket is None:
+                bucket = buckets[agg['key']] = dict(
+                    key=agg['key'],
+                    date=agg['key_as_string'],
+                )
+                for metric in self.metric_fields:
+                    bucket[metric] = 0 if metric in tail_metrics else None
+                if self.copy_fields and agg['top_hit']['hits']['hits']:
+                    doc = agg['top_hit']['hits']['hits'][0]['_source']
+                    for destination, source in self.copy_fields.items():
+                        if isinstance(source, six.string_types):
+                            bucket[destination] = doc.get(
+                                self.event_fields.get(source, source))
+            values = self.get_tail_values(agg, tail_metrics,
+                                          agg['doc_count'])
+            for metric, value in values.items():
+                bucket[metric] = (bucket[metric] or 0) + (value or 0)
+        result['buckets'] = sorted(buckets.values(), key=lambda b: b['key'])
 
     def process_query_result(self, query_result, interval,
-                             start_date, end_date):
+                             start_date, end_date, **kwargs):
         """Build the result using the query result."""
         def build_buckets(agg):
             """Build recursively result buckets."""
@@ -178,19 +492,252 @@ class ESDateHistogramQuery(ESQuery):
             buckets=[build_buckets(b) for b in buckets]
         )
 
-    def run(self, interval='day', start_date=None,
-            end_date=None, **kwargs):
-        """Run the query."""
+    def parse_arguments(self, interval='day', start_date=None,
+                        end_date=None, **kwargs):
+        """Parse and validate the query arguments."""
         start_date = self.extract_date(start_date) if start_date else None
         end_date = self.extract_date(end_date) if end_date else None
         self.validate_arguments(interval, start_date, end_date, **kwargs)
+        return dict(interval=interval, start_date=start_date,
+                    end_date=end_date, **kwargs)
+
+
+RESOLUTIONS = ['hour', 'day', 'month', 'year']
+"""Aggregation intervals, from the finest to the coarsest."""
+
+
+class ESPlannedHistogramQuery(ESDateHistogramQuery):
+    """Date histogram query reading the coarsest statistics available.
+
+    The query is given the aggregations of an event at different intervals,
+    e.g. a daily and a monthly aggregation. For each request it chooses the
+    coarsest aggregation able to compute the requested ``interval``, and
+    splits the date range so that the partial aggregation intervals at its
+    edges, and the intervals which are not aggregated yet, are read from
+    finer aggregations or from the raw events. The results of all the
+    sources are merged into a single histogram, with a single multi-search
+    request.
+
+    For example a yearly histogram reads the monthly aggregation documents,
+    plus the daily documents of the current month, plus the raw events of
+    the current day if ``raw_events`` is enabled.
+
+    Only ``sum`` metrics can be merged. The raw events are counted like
+    :meth:`~invenio_stats.queries.ESQuery.get_tail_metrics` does, for the
+    first aggregation. End dates without time include their whole day.
+    """
+
+    allowed_intervals = ['year', 'quarter', 'month', 'week', 'day', 'hour']
+    """Allowed intervals for the histogram aggregation."""
+
+    resolutions = dict(hour='hour', day='day', week='day', month='month',
+                       quarter='month', year='year')
+    """Coarsest aggregation interval able to compute each interval."""
+
+    def __init__(self, query_name, aggregations, raw_events=False, *args,
+                 **kwargs):
+        """Constructor.
+
+        :param aggregations: names of the aggregations of the queried event,
+            e.g. ``['file-download-agg', 'file-download-month-agg']``.
+        :param raw_events: read the events which are not aggregated from the
+            raw events. It enables hourly histograms, and completes the
+            partial aggregation intervals at the edges of the date range and
+            the events which are not aggregated yet. Such results are not
+            cached.
+        """
+        kwargs.setdefault('index', None)
+        kwargs.setdefault('doc_type', None)
+        super(ESPlannedHistogramQuery, self).__init__(
+            query_name=query_name, aggregation=aggregations[0], *args,
+            **kwargs)
+        if any(metric != 'sum' for metric, _, _ in
+               self.metric_fields.values()):
+            raise ValueError('Planned query {} only accepts sum '
+                             'metrics.'.format(query_name))
+        self.aggregations = aggregations
+        self.raw_events = raw_events
+        self.segments = []
+
+    def plan(self, interval, start_date, end_date):
+        """Split a date range between the statistics sources.
+
+        :returns: list of ``(aggregator, lower, upper)`` tuples, where the
+            aggregator is ``None`` for the raw events, ``lower`` is inclusive
+            and ``upper`` is exclusive. Unbounded limits are ``None``.
+        """
+        resolution = RESOLUTIONS.index(self.resolutions[interval])
+        aggregators = [current_stats.get_aggregator(name)
+                       for name in self.aggregations]
+        aggregators = sorted(
+            (a for a in aggregators
+             if RESOLUTIONS.index(a.aggregation_interval) <= resolution),
+            key=lambda a: RESOLUTIONS.index(a.aggregation_interval),
+            reverse=True)
+        sources = []
+        for aggregator in aggregators:
+            until = get_aggregated_until(aggregator.name)
+            # Only the aggregation intervals older than the last run are
+            # complete.
+            sources.append((aggregator, aggregator._truncate_dt(until)
+                            if until is not None else None))
+        if self.raw_events:
+            sources.append((None, None))
+        if not sources:
+            raise InvalidRequestInputError(
+                'Interval {0} is not available for statistic {1}.'.format(
+                    interval, self.query_name))
+
+        upper = None
+        if end_date is not None:
+            if end_date == datetime(end_date.year, end_date.month,
+                                    end_date.day):
+                upper = end_date + timedelta(days=1)
+            else:
+                upper = end_date + timedelta(seconds=1)
+        return self._split(start_date, upper, sources) or \
+            [(sources[-1][0], start_date, upper)]
+
+    def _split(self, lower, upper, sources):
+        """Split a date range between sources, coarsest first."""
+        if lower is not None and upper is not None and lower >= upper:
+            return []
+        aggregator, complete_until = sources[0]
+        if len(sources) == 1:
+            return [(aggregator, lower, upper)]
+        if complete_until is None:
+            return self._split(lower, upper, sources[1:])
+        first = lower
+        if lower is not None:
+            first = aggregator._truncate_dt(lower)
+            if first < lower:
+                first = aggregator._next_interval_dt(first)
+        last = complete_until
+        if upper is not None:
+            last = min(last, aggregator._truncate_dt(upper))
+        if first is not None and first >= last:
+            return self._split(lower, upper, sources[1:])
+        before = self._split(lower, first, sources[1:]) \
+            if lower is not None else []
+        return before + [(aggregator, first, last)] + \
+            self._split(last, upper, sources[1:])
+
+    def build_segment_query(self, aggregator, lower, upper, interval,
+                            **kwargs):
+        """Build the histogram search of a source on a date range."""
+        from elasticsearch_dsl import Search
+        if aggregator is None:
+            search = self.get_events_search(lower, upper,
+                                            self.required_filters, **kwargs)
+            time_field = 'timestamp'
+            metrics = dict(
+                (dst, spec or ('value_count', 'timestamp', {}))
+                for dst, spec in
+                self.get_tail_metrics(self.metric_fields).items())
+        else:
+            index = aggregator.aggregation_alias
+            if lower is not None and upper is not None:
+                indices = get_time_based_indices(
+                    index, aggregator.index_name_suffix, lower,
+                    upper - timedelta(microseconds=1),
+                    max_indices=self.max_pruned_indices)
+                if indices is not None:
+                    index = indices
+            search = Search(using=self.client, index=index,
+                            doc_type=aggregator.aggregation_doc_type)[0:0]
+            if index is not aggregator.aggregation_alias:
+                search = search.params(ignore_unavailable=True)
+            time_range = {}
+            if lower is not None:
+                time_range['gte'] = lower.isoformat()
+            if upper is not None:
+                time_range['lt'] = upper.isoformat()
+            if time_range:
+                search = search.filter('range',
+                                       **{self.time_field: time_range})
+            for modifier in self.query_modifiers:
+                search = modifier(search, **kwargs)
+            for query_param, filtered_field in self.required_filters.items():
+                if query_param in kwargs:
+                    search = search.filter(
+                        'term', **{filtered_field: kwargs[query_param]})
+            if aggregator.routing_field:
+                for query_param, filtered_field in \
+                        self.required_filters.items():
+                    if filtered_field == aggregator.routing_field and \
+                            query_param in kwargs:
+                        search = search.params(routing=kwargs[query_param])
+            time_field = self.time_field
+            metrics = self.metric_fields
+
+        base_agg = search.aggs.bucket(
+            'histogram',
+            'date_histogram',
+            field=time_field,
+            interval=interval
+        )
+        for dst, (metric, field, opts) in metrics.items():
+            base_agg.metric(dst, metric, field=field, **opts)
+        if self.copy_fields:
+            base_agg.metric(
+                'top_hit', 'top_hits', size=1, sort={'timestamp': 'desc'}
+            )
+        return search
 
-        agg_query = self.build_query(interval, start_date,
-                                     end_date, **kwargs)
-        query_result = agg_query.execute().to_dict()
-        res = self.process_query_result(query_result, interval,
-                                        start_date, end_date)
-        return res
+    def build_query(self, interval, start_date, end_date, **kwargs):
+        """Build the search of the first source of the date range.
+
+        The searches of all the sources are built by :meth:`build_searches`.
+        """
+        return self.build_searches(interval, start_date, end_date,
+                                   **kwargs)[0]
+
+    def build_searches(self, interval, start_date, end_date, **kwargs):
+        """Build the searches of the sources of the date range."""
+        self.segments = self.plan(interval, start_date, end_date)
+        return [self.build_segment_query(aggregator, lower, upper, interval,
+                                         **kwargs)
+                for aggregator, lower, upper in self.segments]
+
+    def process_responses(self, responses, interval, start_date, end_date,
+                          **kwargs):
+        """Merge the histograms of the sources."""
+        buckets = {}
+        copied = set()
+        for (aggregator, _, _), response in zip(self.segments, responses):
+            for agg in response['aggregations']['histogram']['buckets']:
+                bucket = buckets.get(agg['key'])
+                if bucket is None:
+                    bucket = buckets[agg['key']] = dict(
+                        key=agg['key'],
+                        date=agg['key_as_string'],
+                    )
+                    for metric in self.metric_fields:
+                        bucket[metric] = 0
+                for metric in self.metric_fields:
+                    if metric in agg:
+                        bucket[metric] += agg[metric]['value'] or 0
+                if not self.copy_fields or agg['key'] in copied or \
+                        not agg['top_hit']['hits']['hits']:
+                    continue
+                copied.add(agg['key'])
+                doc = agg['top_hit']['hits']['hits'][0]['_source']
+                for destination, source in self.copy_fields.items():
+                    if aggregator is None:
+                        if isinstance(source, six.string_types):
+                            bucket[destination] = doc.get(
+                                self.event_fields.get(source, source))
+                    elif isinstance(source, six.string_types):
+                        bucket[destination] = doc[source]
+                    else:
+                        bucket[destination] = source(bucket, doc)
+        return dict(
+            interval=interval,
+            key_type='date',
+            start_date=start_date.isoformat() if start_date else None,
+            end_date=end_date.isoformat() if end_date else None,
+            buckets=sorted(buckets.values(), key=lambda b: b['key'])
+        )
 
 
 class ESTermsQuery(ESQuery):
@@ -233,9 +780,7 @@ class ESTermsQuery(ESQuery):
 
     def build_query(self, start_date, end_date, **kwargs):
         """Build the elasticsearch query."""
-        agg_query = Search(using=self.client,
-                           index=self.index,
-                           doc_type=self.doc_type)[0:0]
+        agg_query = self.get_search(start_date, end_date)[0:0]
         if start_date is not None or end_date is not None:
             time_range = {}
             if start_date is not None:
@@ -273,9 +818,75 @@ class ESTermsQuery(ESQuery):
                     'term', **{filtered_field: kwargs[query_param]}
                 )
 
-        return agg_query
+        return self.apply_routing(agg_query, self.required_filters, **kwargs)
+
+    def build_tail_query(self, start_date, end_date, **kwargs):
+        """Build the search of the events which are not aggregated yet."""
+        search = self.get_tail_search(start_date, end_date,
+                                      self.required_filters, **kwargs)
+        if search is None:
+            return None
+        tail_metrics = self.get_tail_metrics(self.metric_fields)
+
+        def _apply_metric_aggs(agg):
+            for dst, spec in tail_metrics.items():
+                if spec is not None:
+                    agg.metric(dst, spec[0], field=spec[1], **spec[2])
+
+        base_agg = search.aggs
+        _apply_metric_aggs(base_agg)
+        cur_agg = base_agg
+        for term in self.aggregated_fields:
+            cur_agg = cur_agg.bucket(
+                term, 'terms', field=self.event_fields.get(term, term),
+                size=0)
+            _apply_metric_aggs(cur_agg)
+        if self.copy_fields:
+            base_agg.metric(
+                'top_hit', 'top_hits', size=1, sort={'timestamp': 'desc'}
+            )
+        return search
+
+    def merge_tail_result(self, result, tail_result, **kwargs):
+        """Add the events which are not aggregated yet to the result."""
+        tail_metrics = self.get_tail_metrics(self.metric_fields)
 
-    def process_query_result(self, query_result, start_date, end_date):
+        def merge_buckets(bucket, agg, doc_count, fields):
+            """Merge recursively the events buckets."""
+            values = self.get_tail_values(agg, tail_metrics, doc_count)
+            for metric, value in values.items():
+                bucket[metric] = (bucket.get(metric) or 0) + (value or 0)
+            if not fields:
+                return
+            current_level = fields[0]
+            buckets = dict((b['key'], b) for b in bucket['buckets'])
+            for sub_agg in agg[current_level]['buckets']:
+                sub_bucket = buckets.get(sub_agg['key'])
+                if sub_bucket is None:
+                    sub_bucket = dict(key=sub_agg['key'])
+                    for metric in self.metric_fields:
+                        sub_bucket[metric] = None
+                    if fields[1:]:
+                        sub_bucket.update(type='bucket', field=fields[1],
+                                          key_type='terms', buckets=[])
+                    bucket['buckets'].append(sub_bucket)
+                merge_buckets(sub_bucket, sub_agg, sub_agg['doc_count'],
+                              fields[1:])
+
+        aggs = tail_result['aggregations']
+        hits = tail_result['hits']['total']
+        hits = hits['value'] if isinstance(hits, dict) else hits
+        merge_buckets(result, aggs, hits, self.aggregated_fields)
+        if self.copy_fields and aggs['top_hit']['hits']['hits']:
+            doc = aggs['top_hit']['hits']['hits'][0]['_source']
+            for destination, source in self.copy_fields.items():
+                if destination not in result and \
+                        isinstance(source, six.string_types):
+                    result[destination] = doc.get(
+                        self.event_fields.get(source, source))
+
+    def process_query_result(self, query_result, start_date, end_date,
+                             **kwargs):
         """Build the result using the query result."""
         def build_buckets(agg, fields, bucket_result):
             """Build recursively result buckets."""
@@ -309,13 +920,258 @@ class ESTermsQuery(ESQuery):
 
         return build_buckets(aggs, self.aggregated_fields, result)
 
-    def run(self, start_date=None, end_date=None, **kwargs):
-        """Run the query."""
+    def parse_arguments(self, start_date=None, end_date=None, **kwargs):
+        """Parse and validate the query arguments."""
         start_date = self.extract_date(start_date) if start_date else None
         end_date = self.extract_date(end_date) if end_date else None
         self.validate_arguments(start_date, end_date, **kwargs)
+        return dict(start_date=start_date, end_date=end_date, **kwargs)
+
+
+class ESBulkTermsQuery(ESQuery):
+    """Elasticsearch query computing statistics for a list of identifiers.
+
+    All the identifiers are filtered and aggregated in a single terms
+    aggregation. This enables to display the statistics of all the hits of a
+    search result page at once.
+    """
+
+    def __init__(self, id_field, time_field='timestamp', query_modifiers=None,
+                 metric_fields=None, max_ids=None, *args, **kwargs):
+        """Constructor.
+
+        :param id_field: field containing the identifiers, e.g.
+            ``record_id`` or ``bucket_id``.
+        :param time_field: name of the timestamp field.
+        :param query_modifiers: List of functions accepting a ``query`` and
+            ``**kwargs`` (same as provided to the ``run`` method), that will
+            be applied to the aggregation query.
+        :param metric_fields: Dict of "destination field" ->
+            tuple("metric type", "source field", "metric_options").
+        :param max_ids: maximum number of identifiers accepted in one query.
+            Defaults to ``STATS_BULK_QUERY_MAX_IDS``.
+        """
+        super(ESBulkTermsQuery, self).__init__(*args, **kwargs)
+        self.id_field = id_field
+        self.time_field = time_field
+        self.query_modifiers = query_modifiers or []
+        self.metric_fields = metric_fields or {'value': ('sum', 'count', {})}
+        self.max_ids = max_ids
+
+    def validate_arguments(self, ids, start_date, end_date, **kwargs):
+        """Validate query arguments."""
+        if not isinstance(ids, list) or not ids:
+            raise InvalidRequestInputError(
+                'Parameter "ids" of statistic {} should be a non empty '
+                'list.'.format(self.query_name)
+            )
+        max_ids = (self.max_ids or
+                   current_app.config['STATS_BULK_QUERY_MAX_IDS'])
+        if len(ids) > max_ids:
+            raise InvalidRequestInputError(
+                'Too many ids requested for statistic {0}, the maximum '
+                'is {1}.'.format(self.query_name, max_ids)
+            )
+
+    def parse_arguments(self, ids=None, start_date=None, end_date=None,
+                        **kwargs):
+        """Parse and validate the query arguments."""
+        start_date = self.extract_date(start_date) if start_date else None
+        end_date = self.extract_date(end_date) if end_date else None
+        if isinstance(ids, list):
+            # Remove duplicates while keeping the order
+            ids = list(OrderedDict.fromkeys(six.text_type(i) for i in ids))
+        self.validate_arguments(ids, start_date, end_date, **kwargs)
+        return dict(ids=ids, start_date=start_date, end_date=end_date,
+                    **kwargs)
+
+    def build_query(self, ids, start_date, end_date, **kwargs):
+        """Build the elasticsearch query."""
+        agg_query = self.get_search(start_date, end_date)[0:0]
+        agg_query = agg_query.filter('terms', **{self.id_field: ids})
+        if start_date is not None or end_date is not None:
+            time_range = {}
+            if start_date is not None:
+                time_range['gte'] = start_date.isoformat()
+            if end_date is not None:
+                time_range['lte'] = end_date.isoformat()
+            agg_query = agg_query.filter(
+                'range',
+                **{self.time_field: time_range})
+
+        for modifier in self.query_modifiers:
+            agg_query = modifier(agg_query, **kwargs)
+
+        ids_agg = agg_query.aggs.bucket(
+            'ids', 'terms', field=self.id_field, size=len(ids)
+        )
+        for dst, (metric, field, opts) in self.metric_fields.items():
+            ids_agg.metric(dst, metric, field=field, **opts)
+        return agg_query
+
+    def process_query_result(self, query_result, ids, start_date, end_date,
+                             **kwargs):
+        """Build the result using the query result."""
+        results = OrderedDict(
+            (i, {metric: 0 for metric in self.metric_fields}) for i in ids
+        )
+        for bucket in query_result['aggregations']['ids']['buckets']:
+            # The ids are text while numeric fields have numeric keys
+            results[six.text_type(bucket['key'])] = {
+                metric: bucket[metric]['value'] or 0
+                for metric in self.metric_fields
+            }
+        return dict(
+            start_date=start_date.isoformat() if start_date else None,
+            end_date=end_date.isoformat() if end_date else None,
+            field=self.id_field,
+            key_type='terms',
+            results=results,
+        )
+
+
+class ESTotalsQuery(object):
+    """Query reading the all-time totals materialized by an aggregation.
+
+    The totals are kept up to date by the aggregator (see the
+    ``totals_fields`` of :class:`~invenio_stats.aggregations.StatAggregator`)
+    so that they are read with a single multi-get request instead of summing
+    every aggregation document. The totals of one key are queried with the
+    ``key_field`` parameter, e.g. ``{"bucket_id": "<id>"}``, and the totals
+    of several keys with the ``ids`` parameter.
+    """
+
+    def __init__(self, query_name, index, doc_type, key_field,
+                 metric_fields=None, client=None, max_ids=None):
+        """Constructor.
+
+        :param index: index of the totals, e.g.
+            ``stats-totals-file-download``.
+        :param doc_type: document type of the totals.
+        :param key_field: field of the aggregation documents whose totals are
+            queried, e.g. ``unique_id`` or ``bucket_id``.
+        :param metric_fields: Dict of "destination field" -> "total field".
+        :param client: elasticsearch client used to query.
+        :param max_ids: maximum number of identifiers accepted in one query.
+            Defaults to ``STATS_BULK_QUERY_MAX_IDS``.
+        """
+        self.query_name = query_name
+        self.index = index
+        self.doc_type = doc_type
+        self.key_field = key_field
+        self.metric_fields = metric_fields or {'value': 'count'}
+        self.client = trace_client(
+            client if client is not None else get_search_client(),
+            'query', query_name)
+        self.max_ids = max_ids
+
+    def parse_arguments(self, ids=None, **kwargs):
+        """Parse and validate the query arguments."""
+        if ids is None:
+            if kwargs.get(self.key_field) is None:
+                raise InvalidRequestInputError(
+                    'Missing the parameter "{0}" or "ids" in query '
+                    '{1}'.format(self.key_field, self.query_name))
+            return dict(key=six.text_type(kwargs[self.key_field]))
+        if not isinstance(ids, list) or not ids:
+            raise InvalidRequestInputError(
+                'Parameter "ids" of statistic {} should be a non empty '
+                'list.'.format(self.query_name)
+            )
+        max_ids = (self.max_ids or
+                   current_app.config['STATS_BULK_QUERY_MAX_IDS'])
+        if len(ids) > max_ids:
+            raise InvalidRequestInputError(
+                'Too many ids requested for statistic {0}, the maximum '
+                'is {1}.'.format(self.query_name, max_ids)
+            )
+        return dict(ids=list(OrderedDict.fromkeys(
+            six.text_type(i) for i in ids)))
+
+    def get_totals(self, keys):
+        """Get the metrics of the totals of some keys."""
+        docs = self.client.mget(
+            index=self.index, doc_type=self.doc_type,
+            body={'ids': ['{0}:{1}'.format(self.key_field, key)
+                          for key in keys]})['docs']
+        return OrderedDict(
+            (key, {
+                metric: (doc['_source'].get(field) or 0)
+                if doc.get('found') else 0
+                for metric, field in self.metric_fields.items()
+            }) for key, doc in zip(keys, docs)
+        )
+
+    def run(self, **kwargs):
+        """Run the query."""
+        arguments = self.parse_arguments(**kwargs)
+        if 'key' in arguments:
+            result = dict(field=self.key_field, key=arguments['key'])
+            result.update(self.get_totals([arguments['key']])[
+                arguments['key']])
+            return result
+        return dict(
+            field=self.key_field,
+            key_type='terms',
+            results=self.get_totals(arguments['ids']),
+        )
+
+
+class LocalTotalsQuery(ESTotalsQuery):
+    """Query reading the all-time totals from the local counter stores.
+
+    The totals are read from the memory-mapped counter store of the host
+    (see :mod:`invenio_stats.counters`), without any request to the search
+    cluster. The keys missing from the store are read from the totals index
+    like :class:`ESTotalsQuery` does, which is also the case for every key
+    when :data:`~invenio_stats.config.STATS_COUNTER_STORE_DIR` is not set or
+    when the store is older than
+    :data:`~invenio_stats.config.STATS_COUNTER_STORE_MAX_AGE`.
+    """
+
+    def get_totals(self, keys):
+        """Get the metrics of the totals of some keys."""
+        store = current_stats.get_counter_store(self.index, self.key_field)
+        max_age = current_app.config['STATS_COUNTER_STORE_MAX_AGE']
+        if store is not None and max_age is not None:
+            age = store.age()
+            if age is None or age > max_age:
+                store = None
+        results = OrderedDict()
+        missing = []
+        for key in keys:
+            totals = store.get(key) if store is not None else None
+            if totals is None or \
+                    any(f not in totals for f in self.metric_fields.values()):
+                missing.append(key)
+                results[key] = None
+            else:
+                results[key] = dict(
+                    (metric, totals[field])
+                    for metric, field in self.metric_fields.items())
+        if missing:
+            results.update(super(LocalTotalsQuery, self).get_totals(missing))
+        return results
+
+
+def get_bulk_statistics(query_name, ids, **kwargs):
+    """Get a statistic for many identifiers in one query.
+
+    This is meant to be used for example by record serializers in order to
+    enrich all the hits of a search result page at once.
+
+    .. code-block:: python
+
+        stats = get_bulk_statistics(
+            'record-view-bulk-total', [hit['id'] for hit in hits])
+        for hit in hits:
+            hit['views'] = stats[hit['id']]['value']
 
-        agg_query = self.build_query(start_date, end_date, **kwargs)
-        query_result = agg_query.execute().to_dict()
-        res = self.process_query_result(query_result, start_date, end_date)
-        return res
+    :param query_name: name of a statistic using :class:`ESBulkTermsQuery`.
+    :param ids: list of identifiers.
+    :param kwargs: additional query parameters, e.g. ``start_date``.
+    :returns: dict of identifier -> dict of metrics.
+    """
+    query_cfg = current_stats.queries[query_name]
+    query = query_cfg.query_class(**query_cfg.query_config)
+    return query.run(ids=ids, **kwargs)['results']
@@ -12,6 +12,7 @@ from __future__ import absolute_import, print_function
 
 from flask import current_app
 
+from .buffers import buffer_event
 from .proxies import current_stats
 from .utils import obj_or_import_string
 
@@ -34,7 +35,15 @@ class EventEmmiter(object):
                     event = builder(event, *args, **kwargs)
                     if event is None:
                         return
-                current_stats.publish(self.name, [event])
+                sampler = current_stats.sampler
+                if sampler is not None:
+                    event = sampler(self.name, event)
+                    if event is None:
+                        return
+                if current_app.config['STATS_PUBLISH_BUFFERED']:
+                    buffer_event(self.name, event)
+                else:
+                    current_stats.publish(self.name, [event])
         except Exception:
             current_app.logger.exception(u'Error building event')
 
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Sampling and shedding of the emitted events."""
+
+from __future__ import absolute_import, print_function
+
+import random
+import re
+import time
+
+from flask import current_app
+
+from .status import get_queue_size
+
+
+class EventSampler(object):
+    """Decide which events are emitted and with which weight.
+
+    The sampling rate of an event is the product of the rate of its event
+    type, the robots rate if its user agent looks like a robot, and the
+    shedding rate corresponding to the current depth of its queue. Emitted
+    events which were sampled carry a ``weight`` field, the inverse of their
+    sampling rate, which the aggregations sum instead of counting events.
+    """
+
+    def __init__(self, rates=None, robots_rate=None, robots_pattern=None,
+                 queue_thresholds=None, queue_check_interval=10):
+        """Constructor.
+
+        :param rates: dictionary of event type -> sampling rate.
+        :param robots_rate: sampling rate of the events whose user agent
+            matches ``robots_pattern``.
+        :param robots_pattern: regular expression matching the user agents of
+            obvious robots.
+        :param queue_thresholds: list of (queue size, sampling rate) tuples,
+            the queue size being a number of messages. The rate of the
+            highest threshold reached by the queue of an event type is
+            applied.
+        :param queue_check_interval: time in seconds during which a queue
+            size is reused before being fetched again from the broker.
+        """
+        self.rates = rates or {}
+        self.robots_rate = robots_rate
+        self.robots_regex = re.compile(robots_pattern, re.IGNORECASE) \
+            if robots_pattern else None
+        self.queue_thresholds = sorted(queue_thresholds or [], reverse=True)
+        self.queue_check_interval = queue_check_interval
+        self._queue_sizes = {}
+
+    def queue_size(self, event_type):
+        """Get the number of pending messages in an event type queue."""
+        size, checked_at = self._queue_sizes.get(event_type, (0, None))
+        if checked_at is None or \
+                time.time() - checked_at >= self.queue_check_interval:
+            try:
+                size = get_queue_size(event_type)
+            except Exception:
+                current_app.logger.exception(
+                    u'Error while getting the size of the queue of %s',
+                    event_type)
+            self._queue_sizes[event_type] = (size, time.time())
+        return size
+
+    def is_robot(self, event):
+        """Cheaply check if an event was created by a robot."""
+        return bool(self.robots_regex and event.get('user_agent') and
+                    self.robots_regex.search(event['user_agent']))
+
+    def get_rate(self, event_type, event):
+        """Get the sampling rate of an event."""
+        rate = self.rates.get(event_type, 1)
+        if self.robots_rate is not None and self.is_robot(event):
+            rate *= self.robots_rate
+        if self.queue_thresholds:
+            size = self.queue_size(event_type)
+            for threshold, threshold_rate in self.queue_thresholds:
+                if size >= threshold:
+                    rate *= threshold_rate
+                    break
+        return rate
+
+    def __call__(self, event_type, event):
+        """Sample an event.
+
+        :returns: the event with its ``weight`` or ``None`` if it is dropped.
+        """
+        rate = self.get_rate(event_type, event)
+        if rate >= 1:
+            return event
+        if rate <= 0 or random.random() >= rate:
+            return None
+        event['weight'] = event.get('weight', 1) / float(rate)
+        return event
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Local disk spool of the events which could not be published."""
+
+from __future__ import absolute_import, print_function
+
+import atexit
+import errno
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+
+from flask import current_app
+
+OPEN_SUFFIX = '.open'
+"""Suffix of the segments which are still written."""
+
+CLOSED_SUFFIX = '.spool'
+"""Suffix of the segments ready to be drained."""
+
+TMP_SUFFIX = '.tmp'
+"""Suffix of the segments being rewritten by a drainer."""
+
+
+def publish_events(queue, events, timeout):
+    """Publish events without waiting more than ``timeout`` per operation.
+
+    :param queue: :class:`invenio_queues.queue.Queue` to publish to.
+    :param events: list of events.
+    :param timeout: timeout in seconds of the broker operations.
+    :returns: number of published events. It is lower than the number of
+        events only if an exception is raised, in which case it is set as the
+        ``published`` attribute of the exception.
+    """
+    published = 0
+    try:
+        with queue.connection_pool.acquire(block=True,
+                                           timeout=timeout) as conn:
+            conn.ensure_connection(max_retries=1, interval_start=0,
+                                   timeout=timeout)
+            producer = queue.producer(conn)
+            for event in events:
+                producer.publish(event, retry=False, timeout=timeout)
+                published += 1
+    except Exception as e:
+        e.published = published
+        raise
+    return published
+
+
+def _pid_alive(pid):
+    """Check if a process of this host is still running."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _remove_file(path):
+    """Remove a file if it exists."""
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _lock_segment(path):
+    """Open a segment and lock it exclusively without blocking.
+
+    :returns: the open file, or ``None`` if the segment is already locked by
+        another drainer or does not exist anymore.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # The segment could have been drained and removed or rewritten
+        # between its opening and its locking.
+        if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+            f.close()
+            return None
+    except (IOError, OSError) as e:
+        f.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES, errno.ENOENT):
+            return None
+        raise
+    return f
+
+
+class EventSpool(object):
+    """Append-only spool of events stored in segment files.
+
+    Each process appends to its own segment, one JSON line per batch of
+    events. A segment is closed, i.e. renamed with the ``.spool`` suffix, when
+    it reaches ``segment_size`` bytes, when it is ``segment_age`` seconds old,
+    even if no events are appended anymore, or when the process exits. Closed
+    segments are replayed by :meth:`drain`, which locks each segment so that
+    concurrent drainers do not publish the same events twice. Writes are synced
+    to disk at most every ``fsync_interval`` seconds so that spooling does not
+    cost a disk flush per event.
+
+    The spool is local to a host: it must be drained by a process running on
+    the same host as the processes writing to it.
+    """
+
+    def __init__(self, directory, segment_size=1024 * 1024, segment_age=60,
+                 fsync_interval=1):
+        """Constructor.
+
+        :param directory: directory containing the segment files.
+        :param segment_size: size in bytes after which a segment is closed.
+        :param segment_age: age in seconds after which a segment is closed.
+        :param fsync_interval: maximum time in seconds between two syncs of
+            the written events to disk.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._segment = None
+        self._segment_path = None
+        self._segment_opened = None
+        self._last_sync = None
+        self._timer = None
+        atexit.register(self.close)
+
+    def _open_segment(self):
+        """Open a new segment for this process."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        name = '{0:.6f}-{1}-{2}'.format(
+            time.time(), os.getpid(), uuid.uuid4().hex)
+        self._segment_path = os.path.join(self.directory, name + OPEN_SUFFIX)
+        self._segment = open(self._segment_path, 'ab')
+        self._segment_opened = self._last_sync = time.time()
+        # Close the segment once it is old enough even if the process does
+        # not spool events anymore, e.g. because the broker recovered.
+        self._timer = threading.Timer(
+            self.segment_age, self._expire_segment, (self._segment_path,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire_segment(self, path):
+        """Close a segment if it is still the current one."""
+        with self._lock:
+            if self._segment_path == path:
+                self._close_segment()
+
+    def _close_segment(self):
+        """Sync and close the current segment so that it can be drained."""
+        if self._segment is None:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._segment.flush()
+        os.fsync(self._segment.fileno())
+        self._segment.close()
+        os.rename(self._segment_path,
+                  self._segment_path[:-len(OPEN_SUFFIX)] + CLOSED_SUFFIX)
+        self._segment = self._segment_path = None
+
+    def append(self, event_type, events):
+        """Spool a batch of events."""
+        line = json.dumps([event_type, events]).encode('utf-8') + b'\n'
+        with self._lock:
+            if self._segment is None or \
+                    time.time() - self._segment_opened >= self.segment_age:
+                self._close_segment()
+                self._open_segment()
+            self._segment.write(line)
+            now = time.time()
+            if now - self._last_sync >= self.fsync_interval:
+                self._segment.flush()
+                os.fsync(self._segment.fileno())
+                self._last_sync = now
+            if self._segment.tell() >= self.segment_size:
+                self._close_segment()
+
+    def close(self):
+        """Close the segment of this process."""
+        with self._lock:
+            self._close_segment()
+
+    def segments(self):
+        """List the segments ready to be drained, oldest first.
+
+        Open segments left by processes which are not running anymore are
+        included as well.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        result = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(CLOSED_SUFFIX):
+                result.append(path)
+            elif name.endswith(OPEN_SUFFIX) and path != self._segment_path:
+                pid = int(name.split('-')[1])
+                if not _pid_alive(pid):
+                    result.append(path)
+        return sorted(result, key=os.path.basename)
+
+    def __len__(self):
+        """Number of segments ready to be drained."""
+        return len(self.segments())
+
+    def _read_segment(self, path, f):
+        """Read the batches of events of an open segment."""
+        batches = []
+        for line in f:
+            try:
+                batches.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                # The last line of a segment can be truncated if the
+                # process was killed while writing it.
+                current_app.logger.warning(
+                    u'Skipping corrupted line of spool segment %s', path)
+        return batches
+
+    def _rewrite_segment(self, path, batches):
+        """Atomically replace a segment with its remaining batches."""
+        tmp_path = path + TMP_SUFFIX
+        with open(tmp_path, 'wb') as f:
+            for batch in batches:
+                f.write(json.dumps(batch).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+    def _remove_orphan_files(self):
+        """Remove the rewritten segments left without their segment."""
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(TMP_SUFFIX) and \
+                    not os.path.exists(path[:-len(TMP_SUFFIX)]):
+                _remove_file(path)
+
+    def drain(self, publish, rate=None, max_events=None):
+        """Replay the spooled events.
+
+        Segments are deleted once all their events are published. If
+        publishing fails, the events which were not published are kept in
+        the segment and the draining stops. Segments locked by another
+        drainer are skipped. The temporary files left by a drainer which
+        crashed while rewriting a segment are removed, the segment still
+        holding all its events.
+
+        :param publish: function called with an event type and a list of
+            events to publish them.
+        :param rate: maximum number of events published per second.
+        :param max_events: stop after this number of events was published.
+        :returns: number of published events.
+        """
+        count = 0
+        started = time.time()
+        if os.path.isdir(self.directory):
+            self._remove_orphan_files()
+        for path in self.segments():
+            f = _lock_segment(path)
+            if f is None:
+                continue
+            try:
+                # Only the drainer holding the lock rewrites the segment.
+                _remove_file(path + TMP_SUFFIX)
+                count, done = self._drain_segment(
+                    path, f, publish, rate, max_events, count, started)
+            finally:
+                f.close()
+            if not done or (max_events is not None and count >= max_events):
+                break
+        return count
+
+    def _drain_segment(self, path, f, publish, rate, max_events, count,
+                       started):
+        """Replay the events of a locked segment.
+
+        :returns: the total number of published events and whether all the
+            events of the segment were published.
+        """
+        batches = self._read_segment(path, f)
+        while batches:
+            event_type, events = batches[0]
+            if max_events is not None:
+                if count >= max_events:
+                    self._rewrite_segment(path, batches)
+                    return count, False
+                events = events[:max_events - count]
+            try:
+                publish(event_type, events)
+            except Exception:
+                current_app.logger.exception(
+                    u'Error while draining spooled events')
+                self._rewrite_segment(path, batches)
+                return count, False
+            count += len(events)
+            if len(events) < len(batches[0][1]):
+                batches[0] = [event_type, batches[0][1][len(events):]]
+                self._rewrite_segment(path, batches)
+                return count, False
+            batches.pop(0)
+            if rate:
+                # Keep the average publishing rate under the limit.
+                delay = count / float(rate) - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+        os.remove(path)
+        return count, True
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Status of the statistics processing.
+
+The status tells how far behind the statistics are: the number of messages
+waiting in the queue and the timestamp of the newest indexed event of each
+event type, the bookmark and the last run of each aggregation. Collecting it
+costs one request per event type and per aggregation, thus it is cached for
+:data:`~invenio_stats.config.STATS_STATUS_CACHE_TIMEOUT` seconds.
+"""
+
+from __future__ import absolute_import, print_function
+
+import datetime
+import time
+
+from flask import current_app
+from invenio_cache import current_cache
+from invenio_queues.proxies import current_queues
+
+from .proxies import current_stats
+from .utils import get_event_indices, get_search_client
+
+
+def _run_key(aggregation):
+    """Get the cache key of the last run of an aggregation."""
+    return 'stats:agg_run:{}'.format(aggregation)
+
+
+def set_aggregation_run(aggregation, duration, documents):
+    """Record the last run of an aggregation.
+
+    :param duration: duration of the run in seconds.
+    :param documents: number of aggregation documents written.
+    """
+    current_cache.set(_run_key(aggregation), dict(
+        timestamp=time.time(), duration=duration, documents=documents,
+    ), timeout=0)
+
+
+def get_aggregation_run(aggregation):
+    """Get the last run of an aggregation, if any was recorded."""
+    return current_cache.get(_run_key(aggregation))
+
+
+def _until_key(aggregation):
+    """Get the cache key of the end of the aggregated events."""
+    return 'stats:agg_until:{}'.format(aggregation)
+
+
+def set_aggregated_until(aggregation, date):
+    """Record the date up to which the events have been aggregated.
+
+    :param date: naive UTC datetime. The events older than it are counted by
+        the aggregation documents.
+    """
+    current_cache.set(_until_key(aggregation), date, timeout=0)
+
+
+def get_aggregated_until(aggregation):
+    """Get the date up to which the events have been aggregated.
+
+    When it was not recorded, e.g. because the cache was cleared, it is
+    estimated as the end of the aggregation interval of the last bookmark.
+    The estimate is only cached for
+    :data:`~invenio_stats.config.STATS_STATUS_CACHE_TIMEOUT` seconds, so that
+    the date recorded by the next aggregation run replaces it.
+    """
+    date = current_cache.get(_until_key(aggregation))
+    if date is None:
+        bookmark = get_bookmark(aggregation)
+        if bookmark is not None:
+            aggregator = current_stats.get_aggregator(aggregation)
+            date = aggregator._next_interval_dt(
+                aggregator._truncate_dt(bookmark))
+            current_cache.set(_until_key(aggregation), date,
+                              timeout=current_app.config[
+                                  'STATS_STATUS_CACHE_TIMEOUT'])
+    return date
+
+
+def get_queue_size(event_type):
+    """Get the number of pending messages in an event type queue."""
+    queue = current_queues.queues['stats-{}'.format(event_type)]
+    _, size, _ = queue.queue.queue_declare(passive=True)
+    return size
+
+
+def get_newest_event_timestamp(event_type, client=None):
+    """Get the timestamp of the newest indexed event of an event type.
+
+    Events indices are named after their date, thus only the newest
+    non-empty index is searched.
+    """
+    from dateutil import parser
+    from elasticsearch_dsl import Search
+    client = client if client is not None else get_search_client()
+    indices = get_event_indices(client, 'events-stats-{}'.format(event_type))
+    for index in reversed(indices):
+        search = Search(using=client, index=index)
+        search = search[0:1].sort({'timestamp': {'order': 'desc'}})
+        search = search.params(ignore_unavailable=True)
+        hits = search.execute().to_dict()['hits']['hits']
+        if hits:
+            return parser.parse(hits[0]['_source']['timestamp'])
+
+
+def get_bookmark(aggregation):
+    """Get the date of the last bookmark of an aggregation.
+
+    Unlike :meth:`~invenio_stats.aggregations.StatAggregator.get_bookmark`,
+    no date is estimated when no bookmark was written yet.
+    """
+    from elasticsearch.exceptions import NotFoundError
+    aggregator = current_stats.get_aggregator(aggregation)
+    try:
+        bookmarks = aggregator.list_bookmarks(limit=1)
+    except NotFoundError:
+        return None
+    if len(bookmarks) > 0:
+        return datetime.datetime.strptime(bookmarks[0].date,
+                                          aggregator.doc_id_suffix)
+
+
+def _timestamp(date):
+    """Convert a naive UTC datetime to seconds since the epoch."""
+    if date is not None:
+        return (date.replace(tzinfo=None) -
+                datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+def _collect(collector, *args):
+    """Call a collector, logging its errors."""
+    try:
+        return collector(*args)
+    except Exception:
+        current_app.logger.exception(
+            u'Error while collecting the statistics status with %s',
+            collector.__name__)
+
+
+def collect_status():
+    """Collect the status of the events and aggregations.
+
+    :returns: dict with the ``events`` and ``aggregations`` status, keyed by
+        event type and aggregation name. Dates are in seconds since the
+        epoch. Values which could not be collected are ``None``.
+    """
+    status = dict(collected_at=time.time(), events={}, aggregations={})
+    for event_type in sorted(current_stats.events):
+        status['events'][event_type] = dict(
+            queue_messages=_collect(get_queue_size, event_type),
+            newest_event=_timestamp(
+                _collect(get_newest_event_timestamp, event_type)),
+        )
+    for name in sorted(current_stats.aggregations):
+        last_run = get_aggregation_run(name) or {}
+        status['aggregations'][name] = dict(
+            bookmark=_timestamp(_collect(get_bookmark, name)),
+            last_run=last_run.get('timestamp'),
+            last_run_duration=last_run.get('duration'),
+            last_run_documents=last_run.get('documents'),
+        )
+    return status
+
+
+def get_status():
+    """Get the status, collecting it again when its cached value expired."""
+    status = current_cache.get('stats:status')
+    if status is None:
+        status = collect_status()
+        current_cache.set('stats:status', status, timeout=current_app.config[
+            'STATS_STATUS_CACHE_TIMEOUT'])
+    return status
+
+
+METRICS = [
+    ('events', 'queue_messages', 'invenio_stats_queue_messages', 'gauge',
+     'Number of messages waiting in the queue.'),
+    ('events', 'newest_event', 'invenio_stats_newest_event_timestamp_seconds',
+     'gauge', 'Timestamp of the newest indexed event.'),
+    ('aggregations', 'bookmark_age', 'invenio_stats_bookmark_age_seconds',
+     'gauge', 'Time elapsed since the aggregation bookmark.'),
+    ('aggregations', 'last_run', 'invenio_stats_last_run_timestamp_seconds',
+     'gauge', 'Timestamp of the end of the last aggregation run.'),
+    ('aggregations', 'last_run_duration',
+     'invenio_stats_last_run_duration_seconds', 'gauge',
+     'Duration of the last aggregation run.'),
+    ('aggregations', 'last_run_documents', 'invenio_stats_last_run_documents',
+     'gauge', 'Number of documents written by the last aggregation run.'),
+]
+"""Exported metrics: status section, status key, name, type and help."""
+
+
+def format_metrics(status, now=None):
+    """Format the status as Prometheus text metrics.
+
+    :param status: status returned by :func:`get_status`.
+    :param now: current time in seconds since the epoch, from which the
+        bookmarks age is computed.
+    """
+    now = time.time() if now is None else now
+    labels = dict(events='event_type', aggregations='aggregation')
+    lines = []
+    for section, key, name, metric_type, description in METRICS:
+        lines.append('# HELP {0} {1}'.format(name, description))
+        lines.append('# TYPE {0} {1}'.format(name, metric_type))
+        for item, values in sorted(status[section].items()):
+            if key == 'bookmark_age':
+                value = values['bookmark']
+                value = now - value if value is not None else None
+            else:
+                value = values[key]
+            if value is not None:
+                lines.append('{0}{{{1}="{2}"}} {3!r}'.format(
+                    name, labels[section], item, float(value)))
+    return '\n'.join(lines) + '\n'
@@ -10,20 +10,34 @@
 
 from __future__ import absolute_import, print_function
 
+from celery import current_app as current_celery_app
 from celery import shared_task
-from dateutil.parser import parse as dateutil_parse
+from celery.signals import worker_process_init
+from flask import current_app
 
 from .proxies import current_stats
 
 
+@worker_process_init.connect
+def warm_up_worker(**kwargs):
+    """Prepare the events and aggregations processing of a worker process."""
+    app = getattr(current_celery_app, 'flask_app', None)
+    if app is None or 'invenio-stats' not in app.extensions or \
+            not app.config['STATS_WORKER_WARM_UP']:
+        return
+    with app.app_context():
+        try:
+            current_stats.warm_up()
+        except Exception:
+            app.logger.exception(u'Error while warming up the stats worker')
+
+
 @shared_task
 def process_events(event_types):
     """Index statistics events."""
     results = []
     for e in event_types:
-        processor = current_stats.events[e].processor_class(
-            **current_stats.events[e].processor_config)
-        results.append((e, processor.run()))
+        results.append((e, current_stats.get_processor(e).run()))
     return results
 
 
@@ -31,12 +45,40 @@ def process_events(event_types):
 def aggregate_events(aggregations, start_date=None, end_date=None,
                      update_bookmark=True):
     """Aggregate indexed events."""
+    from dateutil.parser import parse as dateutil_parse
     start_date = dateutil_parse(start_date) if start_date else None
     end_date = dateutil_parse(end_date) if end_date else None
     results = []
     for a in aggregations:
-        aggr_cfg = current_stats.aggregations[a]
-        aggregator = aggr_cfg.aggregator_class(
-            name=aggr_cfg.name, **aggr_cfg.aggregator_config)
-        results.append(aggregator.run(start_date, end_date, update_bookmark))
+        results.append(current_stats.get_aggregator(a).run(
+            start_date, end_date, update_bookmark))
     return results
+
+
+@shared_task
+def rebuild_counter_stores(aggregations=None):
+    """Write again the local counter stores of aggregations from the totals.
+
+    The counter stores are local to each host, thus the task only rebuilds
+    the stores of the worker which runs it. It must be scheduled on each host
+    reading the stores, by routing it to a queue consumed on the host.
+    """
+    aggregations = aggregations or list(current_stats.enabled_aggregations)
+    for a in aggregations:
+        aggregator = current_stats.get_aggregator(a)
+        if aggregator.totals_fields:
+            aggregator.rebuild_counter_stores()
+
+
+@shared_task
+def drain_spooled_events(rate=None, max_events=None):
+    """Publish the events of the local spool.
+
+    The spool is local to each host, so the task only drains the spool of the
+    worker which runs it. It must be routed to a queue consumed on the host of
+    the spool, e.g. by scheduling it per host with
+    ``options={'queue': '<host queue>'}``.
+    """
+    if rate is None:
+        rate = current_app.config['STATS_SPOOL_DRAIN_RATE']
+    return current_stats.drain_spool(rate=rate, max_events=max_events)
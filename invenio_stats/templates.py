@@ -21,4 +21,6 @@ def register_templates():
                              ['templates']
                              for a in
                              current_stats._aggregations_config]
-    return event_templates + aggregation_templates
+    # Counters of the robot events discarded by the indexers
+    robots_templates = ['invenio_stats.contrib.robots']
+    return event_templates + aggregation_templates + robots_templates
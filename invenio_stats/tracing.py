@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Tracing of the requests sent to the search cluster.
+
+The events indexers, the aggregators and the queries wrap their search client
+with :func:`trace_client` when :data:`~invenio_stats.config.STATS_TRACING_SINK`
+is set. Each sampled request then produces a span, a dict sent to the sink:
+
+.. code-block:: python
+
+    {
+        'component': 'aggregator',     # indexer, aggregator or query
+        'name': 'file-download-agg',   # event type, aggregation or query
+        'operation': 'search',         # client method, e.g. indices.flush
+        'index': 'events-stats-file-download-2018-01-01',
+        'start': 1514800000.0,         # seconds since the epoch
+        'duration_ms': 12.5,           # measured by the client
+        'took_ms': 10,                 # reported by the cluster, if any
+        'hits': 1000,                  # total hits of searches, if any
+        'buckets': 42,                 # aggregation buckets, if any
+        'items': 50,                   # bulk actions, if any
+        'request_bytes': 512,
+        'response_bytes': 4096,
+        'error': None,                 # exception class name on failure
+    }
+
+The multi-searches grouping several queries, sent by the REST API, produce a
+span named ``msearch`` with the ``queries`` names and their ``query_count``.
+When tracing is disabled the clients are not wrapped at all.
+"""
+
+from __future__ import absolute_import, print_function
+
+import json
+import logging
+import random
+import time
+
+import six
+from flask import current_app, has_app_context
+
+from .utils import load_or_import_from_config
+
+logger = logging.getLogger(__name__)
+
+TRACED_OPERATIONS = {'search', 'msearch', 'count', 'scroll', 'clear_scroll',
+                     'bulk', 'index', 'get', 'mget', 'delete'}
+"""Traced methods of the search client."""
+
+TRACED_INDICES_OPERATIONS = {'exists', 'create', 'delete', 'flush',
+                             'refresh', 'get_alias', 'put_alias'}
+"""Traced methods of the indices client."""
+
+
+def log_span(span):
+    """Log a span as JSON with the ``invenio_stats.tracing`` logger."""
+    logger.info(json.dumps(span, sort_keys=True))
+
+
+def _size(body):
+    """Get the size of a request or response body."""
+    if body is None:
+        return 0
+    if isinstance(body, (six.binary_type, six.text_type)):
+        return len(body)
+    if isinstance(body, (list, tuple)):
+        return sum(_size(item) + 1 for item in body)
+    return len(json.dumps(body, default=str))
+
+
+def _count_buckets(aggregations):
+    """Count the buckets of (nested) aggregations results."""
+    count = 0
+    for value in aggregations.values():
+        if not isinstance(value, dict):
+            continue
+        buckets = value.get('buckets')
+        if isinstance(buckets, dict):
+            buckets = list(buckets.values())
+        if isinstance(buckets, list):
+            count += len(buckets)
+            for bucket in buckets:
+                count += _count_buckets(bucket)
+        else:
+            count += _count_buckets(value)
+    return count
+
+
+def _index_pattern(operation, kwargs, response):
+    """Get the index targeted by a request."""
+    index = kwargs.get('index')
+    if index is None and operation == 'msearch':
+        index = [header.get('index') for header in kwargs.get('body', [])[::2]
+                 if isinstance(header, dict) and header.get('index')]
+    elif index is None and operation == 'bulk' and \
+            isinstance(response, dict):
+        index = set(action.get('_index') for item in response.get('items', [])
+                    for action in item.values())
+    if isinstance(index, (list, tuple, set)):
+        index = ','.join(sorted(set(
+            i for value in index
+            for i in (value if isinstance(value, list) else [value]))))
+    return index or None
+
+
+def make_span(operation, kwargs, response, start, duration, error=None):
+    """Describe a request and its response."""
+    span = dict(
+        operation=operation,
+        index=_index_pattern(operation, kwargs, response),
+        start=start,
+        duration_ms=duration * 1000,
+        took_ms=None,
+        hits=None,
+        buckets=None,
+        items=None,
+        request_bytes=_size(kwargs.get('body')),
+        response_bytes=_size(response),
+        error=error,
+    )
+    if isinstance(response, dict):
+        responses = response.get('responses', [response])
+        took = [r['took'] for r in responses if 'took' in r]
+        if took:
+            span['took_ms'] = max(took)
+        hits = [r['hits']['total'] for r in responses
+                if isinstance(r.get('hits'), dict) and 'total' in r['hits']]
+        if hits:
+            span['hits'] = sum(
+                h['value'] if isinstance(h, dict) else h for h in hits)
+        aggregations = [r['aggregations'] for r in responses
+                        if 'aggregations' in r]
+        if aggregations:
+            span['buckets'] = sum(_count_buckets(a) for a in aggregations)
+        if 'items' in response:
+            span['items'] = len(response['items'])
+        if 'count' in response:
+            span['hits'] = response['count']
+    return span
+
+
+class _Tracer(object):
+    """Trace the calls of some methods of a client."""
+
+    def __init__(self, client, operations, prefix, sink, sample_rate,
+                 component, name, attributes=None):
+        self._client = client
+        self._operations = operations
+        self._prefix = prefix
+        self._sink = sink
+        self._sample_rate = sample_rate
+        self._component = component
+        self._name = name
+        self._attributes = attributes or {}
+
+    def __getattr__(self, attr):
+        """Get the attributes of the client, tracing its methods calls."""
+        value = getattr(self._client, attr)
+        if attr not in self._operations:
+            return value
+
+        def traced(*args, **kwargs):
+            if self._sample_rate < 1 and random.random() >= self._sample_rate:
+                return value(*args, **kwargs)
+            # The bulk helper gives the body as first argument
+            if attr in ('bulk', 'msearch') and args and 'body' not in kwargs:
+                kwargs['body'] = args[0]
+                args = args[1:]
+            error = response = None
+            start = time.time()
+            try:
+                response = value(*args, **kwargs)
+                return response
+            except Exception as e:
+                error = e.__class__.__name__
+                raise
+            finally:
+                self._emit(self._prefix + attr, kwargs, response, start,
+                           time.time() - start, error)
+        return traced
+
+    def _emit(self, operation, kwargs, response, start, duration, error):
+        """Send the span of a request to the sink."""
+        try:
+            span = make_span(operation, kwargs, response, start, duration,
+                             error)
+            span.update(self._attributes)
+            span.update(component=self._component, name=self._name)
+            self._sink(span)
+        except Exception:
+            logger.exception(u'Error while tracing %s', operation)
+
+
+class TracedClient(_Tracer):
+    """Search client sending the spans of its requests to a sink.
+
+    Traced clients are equal when they wrap the same client for the same
+    component, so that requests grouped by client (e.g. in a multi-search)
+    stay grouped.
+    """
+
+    def __init__(self, client, sink, sample_rate=1, component=None,
+                 name=None, attributes=None):
+        """Constructor.
+
+        :param client: traced search client.
+        :param sink: function receiving the spans.
+        :param sample_rate: ratio of the traced requests.
+        :param component: name of the component using the client.
+        :param name: name of the event type, aggregation or query.
+        :param attributes: dict of additional attributes of the spans.
+        """
+        super(TracedClient, self).__init__(
+            client, TRACED_OPERATIONS, '', sink, sample_rate, component,
+            name, attributes)
+        self.indices = _Tracer(
+            client.indices, TRACED_INDICES_OPERATIONS, 'indices.', sink,
+            sample_rate, component, name, attributes)
+
+    def grouped(self, names):
+        """Get the client tracing a multi-search grouping several queries.
+
+        :param names: names of the grouped queries.
+        :returns: a client whose spans are named ``msearch`` and carry the
+            ``queries`` names and their ``query_count``.
+        """
+        return TracedClient(
+            self._client, self._sink, self._sample_rate, self._component,
+            'msearch', dict(queries=list(names), query_count=len(names)))
+
+    def __eq__(self, other):
+        """Compare the wrapped clients."""
+        return isinstance(other, TracedClient) and \
+            (self._client, self._component) == \
+            (other._client, other._component)
+
+    def __ne__(self, other):
+        """Compare the wrapped clients."""
+        return not self == other
+
+    def __hash__(self):
+        """Hash the wrapped client."""
+        return hash((self._client, self._component))
+
+
+def trace_client(client, component, name=None):
+    """Wrap a search client if the tracing is enabled.
+
+    :param client: search client.
+    :param component: name of the component using the client, i.e.
+        ``indexer``, ``aggregator`` or ``query``.
+    :param name: name of the event type, aggregation or query.
+    :returns: the client itself when
+        :data:`~invenio_stats.config.STATS_TRACING_SINK` is not set, a
+        :class:`TracedClient` otherwise.
+    """
+    if not has_app_context() or isinstance(client, TracedClient):
+        return client
+    sink = load_or_import_from_config('STATS_TRACING_SINK')
+    if sink is None:
+        return client
+    return TracedClient(client, sink,
+                        current_app.config['STATS_TRACING_SAMPLE_RATE'],
+                        component, name)
@@ -10,30 +10,153 @@
 
 from __future__ import absolute_import, print_function
 
+import datetime
+import hashlib
+import hmac
 import os
+import threading
 from base64 import b64encode
+from contextlib import contextmanager
 
 import six
 from flask import current_app, request, session
 from flask_login import current_user
-from geolite2 import geolite2
 from invenio_cache import current_cache
 from werkzeug.utils import import_string
 
 
+INDEX_INTERVAL_SUFFIXES = {
+    'hour': '%Y-%m-%dT%H',
+    'day': '%Y-%m-%d',
+    'month': '%Y-%m',
+    'year': '%Y',
+}
+"""Suffix format of the time-based indices for each index interval."""
+
+
+def _next_index_dt(suffix, date):
+    """Get the start of the index following the one of a date."""
+    if '%H' in suffix:
+        return date + datetime.timedelta(hours=1)
+    elif '%d' in suffix:
+        return date + datetime.timedelta(days=1)
+    elif '%m' in suffix:
+        return date.replace(year=date.year + date.month // 12,
+                            month=date.month % 12 + 1)
+    return date.replace(year=date.year + 1)
+
+
+def get_time_based_indices(prefix, suffix, start_date, end_date,
+                           max_indices=None):
+    """Get the names of the time-based indices covering a date range.
+
+    Indices are named ``<prefix>-<date formatted with suffix>``, e.g.
+    ``stats-file-download-2018-01`` for the prefix ``stats-file-download``
+    and the suffix ``%Y-%m``.
+
+    :param prefix: prefix of the index names, usually an alias name.
+    :param suffix: ``strftime`` format of the index name suffix.
+    :param start_date: first date of the range (inclusive).
+    :param end_date: last date of the range (inclusive).
+    :param max_indices: maximum number of indices listed.
+    :returns: sorted list of index names, or ``None`` if the range is
+        covered by more than ``max_indices`` indices.
+    """
+    if end_date < start_date:
+        return []
+    current = datetime.datetime(start_date.year, start_date.month,
+                                start_date.day, start_date.hour)
+    if '%H' not in suffix:
+        current = current.replace(hour=0)
+        if '%d' not in suffix:
+            current = current.replace(day=1)
+            if '%m' not in suffix:
+                current = current.replace(month=1)
+    indices = []
+    while current <= end_date:
+        if max_indices is not None and len(indices) >= max_indices:
+            return None
+        indices.append('{0}-{1}'.format(prefix, current.strftime(suffix)))
+        try:
+            current = _next_index_dt(suffix, current)
+        except (OverflowError, ValueError):
+            # The range ends with the last representable date
+            break
+    return indices
+
+
+def get_event_indices(client, event_index):
+    """Get the names of the existing time-based indices of an events alias.
+
+    :param client: elasticsearch client.
+    :param event_index: alias of the events indices, e.g.
+        ``events-stats-file-download``.
+    :returns: sorted list of index names, i.e. from the oldest to the newest.
+    """
+    from elasticsearch.exceptions import NotFoundError
+    try:
+        indices = client.indices.get_alias(index=event_index)
+    except NotFoundError:
+        return []
+    prefix = '{}-'.format(event_index)
+    return sorted(i for i in indices if i.startswith(prefix))
+
+
+_salts = {}
+
+_import_salt = threading.local()
+
+
+@contextmanager
+def import_salt(salt):
+    """Derive the anonymization salts of the current thread from a secret.
+
+    Used to import old events, e.g. from access logs, whose random salt has
+    expired: importing them again with the same ``salt`` gives the same
+    visitor ids. The salt should be discarded once the import is done, like
+    the random salts.
+
+    :param salt: secret string, or ``None`` to use the random salts.
+    """
+    previous = getattr(_import_salt, 'value', None)
+    _import_salt.value = salt
+    try:
+        yield
+    finally:
+        _import_salt.value = previous
+
+
 def get_anonymization_salt(ts):
-    """Get the anonymization salt based on the event timestamp's day."""
+    """Get the anonymization salt based on the event timestamp's day.
+
+    The salts are kept in memory once they are loaded from the cache, so that
+    the cache is only requested once per day and process.
+    """
     salt_key = 'stats:salt:{}'.format(ts.date().isoformat())
+    secret = getattr(_import_salt, 'value', None)
+    if secret:
+        return b64encode(hmac.new(
+            secret.encode('utf-8'), salt_key.encode('utf-8'),
+            hashlib.sha256).digest()).decode('utf-8')
+    salt = _salts.get(salt_key)
+    if salt:
+        return salt
     salt = current_cache.get(salt_key)
     if not salt:
         salt_bytes = os.urandom(32)
         salt = b64encode(salt_bytes).decode('utf-8')
-        current_cache.set(salt_key, salt, timeout=60 * 60 * 24)
+        # Keep the salt of another process which created it concurrently.
+        current_cache.add(salt_key, salt, timeout=60 * 60 * 24)
+        salt = current_cache.get(salt_key) or salt
+    if len(_salts) >= 8:
+        _salts.clear()
+    _salts[salt_key] = salt
     return salt
 
 
 def get_geoip(ip):
     """Lookup country for IP address."""
+    from geolite2 import geolite2
     reader = geolite2.reader()
     ip_data = reader.get(ip) or {}
     return ip_data.get('country', {}).get('iso_code')
@@ -88,11 +211,28 @@ def load_or_import_from_config(key, app=None, default=None):
     return obj_or_import_string(imp, default=default)
 
 
+def get_search_client():
+    """Get the search client used by default to index and query statistics.
+
+    :returns: the ``STATS_SEARCH_CLIENT`` if it is set, the Invenio-Search
+        client otherwise.
+    """
+    client = load_or_import_from_config('STATS_SEARCH_CLIENT')
+    if client is None:
+        from invenio_search import current_search_client as client
+    return client
+
+
 AllowAllPermission = type('Allow', (), {
     'can': lambda self: True,
     'allows': lambda *args: True,
 })()
 
+DenyAllPermission = type('Deny', (), {
+    'can': lambda self: False,
+    'allows': lambda *args: False,
+})()
+
 
 def default_permission_factory(query_name, params):
     """Default permission factory.
@@ -107,3 +247,20 @@ def default_permission_factory(query_name, params):
         return current_stats.queries[query_name].permission_factory(
             query_name, params
         )
+
+
+def default_events_permission_factory(event_type):
+    """Default permission factory of the events ingestion REST API.
+
+    It forbids sending events, which must be explicitly allowed.
+    """
+    return DenyAllPermission
+
+
+def default_metrics_permission_factory():
+    """Default permission factory of the metrics endpoint.
+
+    It forbids reading the metrics, which must be explicitly allowed, e.g.
+    for the monitoring system only.
+    """
+    return DenyAllPermission
@@ -8,12 +8,19 @@
 
 """InvenioStats views."""
 
-from elasticsearch.exceptions import NotFoundError
-from flask import Blueprint, abort, jsonify, request
+import json
+import time
+
+import six
+from flask import Blueprint, Response, abort, current_app, jsonify, \
+    request
 from invenio_rest.views import ContentNegotiatedMethodView
 
 from .errors import InvalidRequestInputError, UnknownQueryError
+from .processors import _get_arrow
 from .proxies import current_stats
+from .queries import ESQuery, msearch
+from .status import format_metrics, get_status
 from .utils import current_user
 
 blueprint = Blueprint(
@@ -23,6 +30,27 @@ blueprint = Blueprint(
 )
 
 
+def _add_timing(timings, stage, start):
+    """Add the time elapsed since ``start`` to the duration of a stage.
+
+    :returns: the current time.
+    """
+    now = time.time()
+    timings[stage] = timings.get(stage, 0) + now - start
+    return now
+
+
+def _is_batched(query):
+    """Check if a query can be sent in the multi-search request.
+
+    Only the Elasticsearch queries keeping the default ``run`` are batched,
+    the other ones are run on their own.
+    """
+    return isinstance(query, ESQuery) and \
+        six.get_unbound_function(type(query).run) is \
+        six.get_unbound_function(ESQuery.run)
+
+
 class StatsQueryResource(ContentNegotiatedMethodView):
     """REST API resource providing access to statistics."""
 
@@ -43,10 +71,14 @@ class StatsQueryResource(ContentNegotiatedMethodView):
 
     def post(self, **kwargs):
         """Get statistics."""
+        from elasticsearch.exceptions import NotFoundError
         data = request.get_json(force=False)
         if data is None:
             data = {}
         result = {}
+        searches = {}
+        timings = {}
+        start = time.time()
         for query_name, config in data.items():
             if config is None or not isinstance(config, dict) \
                     or (set(config.keys()) != {'stat', 'params'} and
@@ -71,21 +103,201 @@ class StatsQueryResource(ContentNegotiatedMethodView):
                 if current_user.is_authenticated:
                     abort(403, message)
                 abort(401, message)
+            start = _add_timing(timings, 'permission', start)
+            query_cache = current_stats.query_cache
+            cache_key = None
+            # Results read from the raw events change with every indexed
+            # event.
+            if query_cfg.query_config.get('near_real_time') or \
+                    query_cfg.query_config.get('raw_events'):
+                query_cache = None
+            if query_cache is not None:
+                cache_key = query_cache.make_key(stat, params)
+                cached_result = query_cache.get(cache_key)
+                start = _add_timing(timings, 'cache', start)
+                if cached_result is not None:
+                    result[query_name] = cached_result
+                    continue
             try:
                 query = query_cfg.query_class(**query_cfg.query_config)
+                if _is_batched(query):
+                    # Elasticsearch queries are sent together in a single
+                    # multi-search request once all of them are built.
+                    arguments = query.parse_arguments(**params)
+                    searches.setdefault(query.client, []).append((
+                        query_name, query, arguments, cache_key,
+                        query.build_searches(**arguments)
+                    ))
+                    start = _add_timing(timings, 'build', start)
+                    continue
                 result[query_name] = query.run(**params)
+                if query_cache is not None:
+                    query_cache.set(cache_key, result[query_name])
+                start = _add_timing(timings, 'search', start)
             except ValueError as e:
                 raise InvalidRequestInputError(e.args[0])
             except NotFoundError as e:
                 return None
-        return self.make_response(result)
+
+        for client, pending in searches.items():
+            start = time.time()
+            responses = msearch(
+                client, [search for p in pending for search in p[-1]],
+                query_names=[p[1].query_name for p in pending])
+            start = _add_timing(timings, 'search', start)
+            for query_name, query, arguments, cache_key, query_searches in \
+                    pending:
+                query_responses = responses[:len(query_searches)]
+                responses = responses[len(query_searches):]
+                errors = [r for r in query_responses
+                          if isinstance(r, Exception)]
+                if errors:
+                    # A failing statistic does not fail the other ones.
+                    current_app.logger.error(
+                        u'Error while querying statistic %s', query_name,
+                        exc_info=errors[0])
+                    result[query_name] = None
+                    continue
+                result[query_name] = query.process_responses(
+                    query_responses, **arguments)
+                if cache_key is not None:
+                    current_stats.query_cache.set(cache_key,
+                                                  result[query_name])
+            start = _add_timing(timings, 'process', start)
+        response = self.make_response(result)
+        if current_app.config['STATS_SERVER_TIMING']:
+            response.headers['Server-Timing'] = ', '.join(
+                '{0};dur={1:.3f}'.format(stage, duration * 1000)
+                for stage, duration in sorted(timings.items()))
+        return response
+
+
+class StatsEventsResource(ContentNegotiatedMethodView):
+    """REST API resource receiving batches of events."""
+
+    view_name = 'stat_events'
+
+    def __init__(self, **kwargs):
+        """Constructor."""
+        super(StatsEventsResource, self).__init__(
+            serializers={
+                'application/json':
+                lambda data, *args, **kwargs: jsonify(data),
+            },
+            default_media_type='application/json',
+            **kwargs)
+
+    @staticmethod
+    def validate_event(event, required_fields):
+        """Check that an event can be published.
+
+        :returns: an error message or ``None`` if the event is valid.
+        """
+        if not isinstance(event, dict):
+            return 'The event is not a JSON object.'
+        missing = [f for f in required_fields if not event.get(f)]
+        if missing:
+            return 'Missing fields: {}.'.format(', '.join(missing))
+        if 'timestamp' in event:
+            from dateutil import parser
+            # The timestamp is parsed like the events indexer parses it.
+            try:
+                _get_arrow().get(event['timestamp'])
+                parser.parse(event['timestamp'])
+            except Exception:
+                return 'Invalid timestamp.'
+
+    def post(self, event_type, **kwargs):
+        """Publish a batch of events.
+
+        The request body contains one JSON event per line. Valid events are
+        published and invalid ones are reported with their line number. Valid
+        events dropped by the sampling are counted as ``sampled_out``.
+        """
+        if event_type not in current_stats.events:
+            abort(404, 'Unknown event type "{}"'.format(event_type))
+        permission = current_stats.events_permission_factory(event_type)
+        if permission is not None and not permission.can():
+            message = ('You do not have a permission to send '
+                       '"{}" events'.format(event_type))
+            if current_user.is_authenticated:
+                abort(403, message)
+            abort(401, message)
+
+        config = current_app.config
+        if request.content_length is None:
+            abort(411)
+        if request.content_length > config['STATS_EVENTS_MAX_CONTENT_LENGTH']:
+            abort(413)
+        lines = request.get_data().splitlines()
+        if len(lines) > config['STATS_EVENTS_MAX_BATCH_SIZE']:
+            raise InvalidRequestInputError(
+                'Too many events, the maximum is {}.'.format(
+                    config['STATS_EVENTS_MAX_BATCH_SIZE']))
+
+        required_fields = current_stats.events[event_type].config.get(
+            'required_fields', ['timestamp'])
+        sampler = current_stats.sampler
+        events = []
+        errors = []
+        accepted = rejected = sampled_out = 0
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line.decode('utf-8'))
+                error = self.validate_event(event, required_fields)
+            except ValueError:
+                error = 'Invalid JSON.'
+            if error:
+                rejected += 1
+                if len(errors) < config['STATS_EVENTS_MAX_ERRORS']:
+                    errors.append(dict(line=line_number, message=error))
+                continue
+            if sampler is not None:
+                event = sampler(event_type, event)
+                if event is None:
+                    sampled_out += 1
+                    continue
+            accepted += 1
+            events.append(event)
+        # All the events are sent with a single producer.
+        if events:
+            current_stats.publish(event_type, events)
+        return self.make_response(dict(
+            accepted=accepted,
+            rejected=rejected,
+            sampled_out=sampled_out,
+            errors=errors,
+        ))
+
+
+@blueprint.route('/metrics')
+def metrics():
+    """Export the status of the statistics as Prometheus text metrics."""
+    permission = current_stats.metrics_permission_factory()
+    if permission is not None and not permission.can():
+        if current_user.is_authenticated:
+            abort(403)
+        abort(401)
+    return Response(format_metrics(get_status()),
+                    mimetype='text/plain; version=0.0.4')
 
 
 stats_view = StatsQueryResource.as_view(
     StatsQueryResource.view_name,
 )
 
+events_view = StatsEventsResource.as_view(
+    StatsEventsResource.view_name,
+)
+
 blueprint.add_url_rule(
     '',
     view_func=stats_view,
 )
+
+blueprint.add_url_rule(
+    '/events/<string:event_type>',
+    view_func=events_view,
+)
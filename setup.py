@@ -26,6 +26,7 @@ tests_require = [
     'invenio-records>=1.0.0',
     'isort>=4.2.15',
     'mock>=1.0.0',
+    'msgpack>=0.5.6',
     'pydocstyle>=1.0.0',
     'pytest-cov>=1.8.0',
     'pytest-pep8>=1.0.6',
@@ -48,6 +49,9 @@ extras_require = {
     'elasticsearch6': [
         'invenio-search[elasticsearch6]>={}'.format(invenio_search_version)
     ],
+    'msgpack': [
+        'msgpack>=0.5.6',
+    ],
     'tests': tests_require,
 }
 
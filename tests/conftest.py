@@ -50,6 +50,7 @@ from invenio_stats import InvenioStats
 from invenio_stats.contrib.event_builders import build_file_unique_id, \
     build_record_unique_id, file_download_event_builder
 from invenio_stats.contrib.registrations import register_queries
+from invenio_stats.memsearch import MemorySearchClient, put_contrib_templates
 from invenio_stats.processors import EventsIndexer
 from invenio_stats.tasks import aggregate_events
 from invenio_stats.views import blueprint
@@ -169,6 +170,14 @@ def mock_anonymization_salt():
         yield
 
 
+@pytest.fixture()
+def memsearch_client():
+    """In-memory search client with the file-download templates."""
+    client = MemorySearchClient()
+    put_contrib_templates(client)
+    return client
+
+
 def date_range(start_date, end_date):
     """Get all dates in a given range."""
     if start_date >= end_date:
@@ -296,3 +296,99 @@ def test_metric_aggregations(app, event_queues, es_with_templates):
     assert results[0].count == 12  # 3 views over 4 differnet hour slices
     assert results[0].unique_count == 4  # 4 different hour slices accessed
     assert results[0].volume == 9000 * 12
+
+
+@pytest.mark.parametrize('indexed_events',
+                         [dict(file_number=1,
+                               event_number=2,
+                               start_date=datetime.date(2017, 1, 1),
+                               end_date=datetime.date(2017, 1, 7))],
+                         indirect=['indexed_events'])
+def test_events_indices_pruning(app, es, event_queues, indexed_events):
+    """Test that only the events indices of the window are searched."""
+    stat_agg = StatAggregator(name='file-download-agg',
+                              client=current_search_client,
+                              event='file-download',
+                              aggregation_field='file_id',
+                              aggregation_interval='day')
+    assert stat_agg._get_oldest_event_timestamp() == \
+        datetime.datetime(2017, 1, 1, 0, 1, 1)
+
+    stat_agg.indices = set()
+    docs = list(stat_agg.agg_iter(datetime.datetime(2017, 1, 3, 12),
+                                  datetime.datetime(2017, 1, 4, 12)))
+    assert stat_agg.agg_query._index == [
+        'events-stats-file-download-2017-01-03',
+        'events-stats-file-download-2017-01-04',
+    ]
+    assert sorted(d['_source']['timestamp'] for d in docs) == \
+        ['2017-01-03T00:00:00', '2017-01-04T00:00:00']
+
+    # No events index exists in the window
+    assert list(stat_agg.agg_iter(datetime.datetime(2017, 2, 1),
+                                  datetime.datetime(2017, 2, 2))) == []
+    assert stat_agg.last_index_written is None
+
+
+def test_weighted_aggregations(app, event_queues, es_with_templates):
+    """Test that the count of an aggregation sums the events weights."""
+    es = es_with_templates
+    events = [_create_file_download_event(date) for date in
+              [(2018, 1, 1, 12, 10), (2018, 1, 1, 12, 20),
+               (2018, 1, 1, 12, 30), (2018, 1, 1, 12, 40)]]
+    events[0]['weight'] = 4.0
+    events[1]['weight'] = 2.5
+    current_stats.publish('file-download', events)
+    process_events(['file-download'])
+    es.indices.refresh(index='*')
+
+    StatAggregator(name='file-download-agg',
+                   client=current_search_client,
+                   event='file-download',
+                   aggregation_field='file_id',
+                   metric_aggregation_fields={
+                       'volume': ('sum', 'size', {}),
+                   },
+                   aggregation_interval='day').run()
+    es.indices.refresh(index='*')
+
+    results = Search(
+        using=current_search_client,
+        index='stats-file-download',
+        doc_type='file-download-day-aggregation'
+    ).execute()
+    assert len(results) == 1
+    # Events without weight count as one, the count is not rounded
+    assert results[0].count == 8.5
+    # Sums are scaled by the weights as well
+    assert results[0].volume == 8.5 * 9000
+
+
+def test_aggregation_routing(app, event_queues, es_with_templates):
+    """Test routing the aggregation documents with a copied field."""
+    with pytest.raises(ValueError):
+        StatAggregator('file-download-agg', 'file-download',
+                       current_search_client, aggregation_field='file_id',
+                       routing_field='bucket_id')
+
+    es = es_with_templates
+    events = [_create_file_download_event((2018, 1, 1, 12), file_id='F1'),
+              _create_file_download_event((2018, 1, 1, 13), file_id='F2')]
+    events[1]['bucket_id'] = None
+    current_stats.publish('file-download', events)
+    process_events(['file-download'])
+    es.indices.refresh(index='*')
+
+    aggregator = StatAggregator(name='file-download-agg',
+                                client=current_search_client,
+                                event='file-download',
+                                aggregation_field='file_id',
+                                copy_fields={'bucket_id': 'bucket_id'},
+                                routing_field='bucket_id',
+                                aggregation_interval='day')
+    actions = sorted(aggregator.agg_iter(datetime.datetime(2018, 1, 1),
+                                         datetime.datetime(2018, 1, 1)),
+                     key=lambda action: action['_id'])
+    # Documents without the copied value are not routed
+    assert [action.get('_routing') for action in actions] == \
+        ['B0000000000000000000000000000001', None]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Query results cache tests."""
+
+import json
+
+from flask import url_for
+from mock import patch
+
+from invenio_stats.cache import bump_aggregation_stamp
+from invenio_stats.proxies import current_stats
+
+
+def test_query_cache(app, db, query_entrypoints, users,
+                     sample_histogram_query_data):
+    """Test that query results are cached until the bookmark moves."""
+    app.config['STATS_QUERY_CACHE'] = True
+    sample_histogram_query_data['mystat']['stat'] = 'test-query'
+    query_cache = current_stats.query_cache
+    assert query_cache.query_aggregations('test-query') == \
+        ['file-download-agg']
+
+    def post():
+        with app.test_client() as client:
+            headers = [('Content-Type', 'application/json'),
+                       ('Accept', 'application/json')]
+            resp = client.post(
+                url_for('invenio_stats.stat_query',
+                        access_token=users['authorized'].allowed_token),
+                headers=headers,
+                data=json.dumps(sample_histogram_query_data))
+            assert resp.status_code == 200
+            return json.loads(resp.data.decode('utf-8'))
+
+    with patch('conftest.CustomQuery.run',
+               return_value=dict(value=100)) as run:
+        assert post()['mystat']['value'] == 100
+        assert post()['mystat']['value'] == 100
+        assert run.call_count == 1
+        assert query_cache.metrics == dict(hits=1, misses=1)
+
+        # Moving the aggregation bookmark invalidates the cached results
+        bump_aggregation_stamp('file-download-agg')
+        assert post()['mystat']['value'] == 100
+        assert run.call_count == 2
+        assert query_cache.metrics == dict(hits=1, misses=2)
+
+        # Different parameters are cached separately
+        sample_histogram_query_data['mystat']['params']['interval'] = 'month'
+        post()
+        assert run.call_count == 3
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Queue messages codecs tests."""
+
+import json
+
+import pytest
+
+from invenio_stats.codecs import decode_events, encode_events, iter_events
+
+USER_AGENT = ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+              '(KHTML, like Gecko) Chrome/67.0.3396.99 Safari/537.36')
+
+
+def _events(count):
+    return [dict(timestamp='2018-01-01T10:00:{:02d}'.format(i % 60),
+                 bucket_id='B0000000000000000000000000000001',
+                 file_id='F{}'.format(i), user_agent=USER_AGENT,
+                 ip_address='192.168.0.1', size=9000, referrer=None)
+            for i in range(count)]
+
+
+@pytest.mark.parametrize('codec', ['msgpack', 'msgpack-zlib'])
+def test_codec_roundtrip(codec):
+    """Test that events are encoded in batches and decoded back."""
+    events = _events(250)
+    events[3]['extra'] = u'données'
+    messages = encode_events(events, codec=codec, batch_size=100)
+    assert len(messages) == 3
+    assert all(isinstance(m, bytes) for m in messages)
+    assert [e for m in messages for e in decode_events(m)] == events
+
+
+def test_codec_size():
+    """Test that encoded events are much smaller than JSON events."""
+    events = _events(100)
+    json_size = sum(len(json.dumps(e)) for e in events)
+    msgpack_size = len(encode_events(events, codec='msgpack')[0])
+    zlib_size = len(encode_events(events, codec='msgpack-zlib')[0])
+    assert msgpack_size < json_size * 0.8
+    assert zlib_size < json_size * 0.1
+
+
+def test_iter_events(app):
+    """Test reading encoded, plain JSON and corrupted messages."""
+    events = _events(3)
+    messages = [events[0]] + encode_events(events[1:], codec='msgpack-zlib')
+    messages.append(b'Xcorrupted')
+    assert list(iter_events(messages)) == events
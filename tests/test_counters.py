@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Local counter stores tests."""
+
+import datetime
+import os
+import threading
+
+from elasticsearch.helpers import bulk
+
+from invenio_stats.aggregations import StatAggregator
+from invenio_stats.counters import CounterStore, patch_counter_store, \
+    write_counter_store
+from invenio_stats.queries import LocalTotalsQuery
+
+
+def test_counter_store(tmpdir):
+    """Test writing, reading and patching a counter store."""
+    path = str(tmpdir.join('totals.counters'))
+    store = CounterStore(path, check_interval=0)
+    assert store.get('A') is None
+    write_counter_store(path, ['count', 'volume'], {
+        'F{}'.format(i): dict(count=i, volume=i * 0.5) for i in range(1000)
+    })
+    assert store.count == 0
+    assert store.get('F10') == dict(count=10, volume=5)
+    assert store.get('F999') == dict(count=999, volume=499.5)
+    assert store.get('unknown') is None
+    assert store.count == 1000
+
+    patch_counter_store(path, ['count', 'volume'], {
+        'F10': dict(count=11, volume=6), 'new': dict(count=1)})
+    assert store.get('F10') == dict(count=11, volume=6)
+    assert store.get('new') == dict(count=1, volume=0)
+    assert store.get('F3') == dict(count=3, volume=1.5)
+    assert store.count == 1001
+    assert 0 <= store.age() < 60
+
+    # A replaced mapping stays readable by the threads still using it
+    mapped = store._mapped
+    patch_counter_store(path, ['count', 'volume'], {'F3': dict(count=4)})
+    assert store.get('F3') == dict(count=4, volume=0)
+    assert store._mapped is not mapped
+    assert mapped.mmap[:8] == b'ISTCNT1\n'
+
+
+def test_counter_store_concurrent_patches(tmpdir):
+    """Test that concurrent patches do not lose each other's totals."""
+    path = str(tmpdir.join('totals.counters'))
+
+    def patch(prefix):
+        for i in range(20):
+            patch_counter_store(path, ['count'], {
+                '{0}{1}'.format(prefix, i): dict(count=i)})
+
+    threads = [threading.Thread(target=patch, args=(p, )) for p in 'AB']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    store = CounterStore(path)
+    assert store.count == 40
+    assert store.get('A19') == store.get('B19') == dict(count=19)
+
+
+def test_local_totals_query(app, memsearch_client, tmpdir):
+    """Test reading the totals from the local counter stores."""
+    client = memsearch_client
+    app.config.update(STATS_SEARCH_CLIENT=client,
+                      STATS_COUNTER_STORE_DIR=str(tmpdir),
+                      STATS_COUNTER_STORE_CHECK_INTERVAL=0)
+    bulk(client, [
+        dict(_index='events-stats-file-download-2018-01-0{}'.format(day),
+             _type='stats-file-download',
+             _source=dict(timestamp='2018-01-0{}T10:00:00'.format(day),
+                          unique_id='B1_F{}'.format(i), bucket_id='B1',
+                          is_robot=False))
+        for day in (1, 2) for i in range(3)
+    ])
+    aggregator = StatAggregator(
+        'file-download-agg', 'file-download',
+        aggregation_field='unique_id', aggregation_interval='day',
+        index_interval='day', copy_fields={'bucket_id': 'bucket_id'},
+        totals_fields=['count'], totals_parent_fields=['bucket_id'])
+    aggregator.run(end_date=datetime.datetime(2018, 1, 3))
+    assert sorted(f for f in os.listdir(str(tmpdir))
+                  if f.endswith('.counters')) == [
+        'stats-totals-file-download-bucket_id.counters',
+        'stats-totals-file-download-unique_id.counters',
+    ]
+
+    query = LocalTotalsQuery('total', 'stats-totals-file-download',
+                             'file-download-total', key_field='unique_id')
+    bucket_query = LocalTotalsQuery(
+        'bucket-total', 'stats-totals-file-download', 'file-download-total',
+        key_field='bucket_id')
+    # The totals are not read from the cluster anymore
+    client.indices.delete(index='stats-totals-file-download')
+    assert query.run(unique_id='B1_F0') == dict(
+        field='unique_id', key='B1_F0', value=2)
+    assert bucket_query.run(bucket_id='B1')['value'] == 6
+    assert list(query.run(ids=['B1_F1', 'unknown'])['results'].items()) == [
+        ('B1_F1', dict(value=2)), ('unknown', dict(value=0))]
+
+    # Missing keys are read from the cluster
+    client.index(index='stats-totals-file-download',
+                 doc_type='file-download-total', id='unique_id:B2_F0',
+                 body=dict(key_field='unique_id', key='B2_F0', count=4))
+    assert query.run(unique_id='B2_F0')['value'] == 4
+    aggregator.rebuild_counter_stores()
+    assert query.run(unique_id='B1_F0')['value'] == 0
+    assert query.run(unique_id='B2_F0')['value'] == 4
+
+    # Outdated stores are not read anymore
+    write_counter_store(
+        os.path.join(str(tmpdir),
+                     'stats-totals-file-download-unique_id.counters'),
+        ['count'], {'B2_F0': dict(count=5)})
+    assert query.run(unique_id='B2_F0')['value'] == 5
+    app.config['STATS_COUNTER_STORE_MAX_AGE'] = 0
+    assert query.run(unique_id='B2_F0')['value'] == 4
@@ -10,6 +10,9 @@
 
 from __future__ import absolute_import, print_function
 
+import subprocess
+import sys
+
 from flask import Flask
 
 from invenio_stats import InvenioStats
@@ -32,3 +35,23 @@ def test_init():
     assert 'invenio-stats' not in app.extensions
     ext.init_app(app)
     assert 'invenio-stats' in app.extensions
+
+
+def test_lazy_imports():
+    """Test that the extension does not import the processing modules."""
+    script = '\n'.join([
+        'import sys',
+        'import flask, invenio_cache, invenio_queues, invenio_rest, kombu',
+        'modules = set(sys.modules)',
+        'import invenio_stats, invenio_stats.views',
+        'app = flask.Flask("test")',
+        # The signals of the receivers are defined by other modules
+        'app.config["STATS_REGISTER_RECEIVERS"] = False',
+        'invenio_stats.InvenioStats(app)',
+        'print(" ".join(sorted(set(sys.modules) - modules)))',
+    ])
+    imported = subprocess.check_output(
+        [sys.executable, '-c', script]).decode('utf-8').split()
+    for module in ['arrow', 'counter_robots', 'dateutil', 'elasticsearch',
+                   'elasticsearch_dsl', 'geolite2', 'invenio_search']:
+        assert module not in imported
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Access logs import tests."""
+
+import gzip
+
+from elasticsearch_dsl import Search
+
+from invenio_stats.logs import LogImporter, parse_combined_log
+
+LOG_LINE = (
+    '{ip} - - [01/Jan/2018:{hour:02d}:15:00 +0100] '
+    '"GET /records/{pid_value} HTTP/1.1" {status} 2326 "-" "{ua}"\n'
+)
+
+
+def test_parse_combined_log():
+    """Test parsing access logs lines."""
+    assert parse_combined_log(LOG_LINE.format(
+        ip='192.168.0.1', hour=10, pid_value='1?page=2', status=200,
+        ua='Mozilla/5.0')) == dict(
+            ip_address='192.168.0.1', method='GET', path='/records/1?page=2',
+            status=200, size='2326', referrer=None, user_agent='Mozilla/5.0',
+            timestamp='2018-01-01T09:15:00')
+    assert parse_combined_log('invalid line') is None
+
+
+def record_resolver(pid_value):
+    """Resolve the records of the test logs."""
+    if pid_value != 'deleted':
+        return dict(record_id='R{}'.format(pid_value), pid_type='recid',
+                    pid_value=pid_value)
+
+
+def test_import_logs(app, event_queues, es_with_templates, tmpdir):
+    """Test importing events from a compressed access log."""
+    es = es_with_templates
+    log_file = str(tmpdir.join('access.log.gz'))
+    with gzip.open(log_file, 'wb') as f:
+        for hour, pid_value, status in [(1, '1', 200), (2, '2', 200),
+                                        (3, '2', 404), (4, 'deleted', 200),
+                                        (5, '1', 200)]:
+            f.write(LOG_LINE.format(
+                ip='192.168.0.1', hour=hour, pid_value=pid_value,
+                status=status, ua='Mozilla/5.0').encode('utf-8'))
+        f.write(b'invalid line\n')
+
+    importer = LogImporter(
+        rules=[dict(event_type='record-view',
+                    pattern=r'^/records/(?P<pid_value>[^/?#]+)/?(?:[?#]|$)',
+                    resolver=record_resolver)],
+        parsers=['invenio_stats.logs:parse_combined_log'],
+        state_file=str(tmpdir.join('state.json')),
+        processes=1, chunk_size=2)
+    assert importer.import_file(log_file) == 3
+    es.indices.refresh(index='*')
+    search = Search(using=es, index='events-stats-record-view')
+    assert sorted(h.record_id for h in search.scan()) == ['R1', 'R1', 'R2']
+    assert all(h.visitor_id for h in search.scan())
+
+    # Already imported lines are skipped
+    assert importer.import_file(log_file) == 0
+    assert importer.import_file(log_file, restart=True) == 3
+
+
+def test_import_logs_processes(app, event_queues, es_with_templates, tmpdir):
+    """Test parsing the chunks of a log in a pool of processes."""
+    es = es_with_templates
+    log_file = str(tmpdir.join('access.log'))
+    with open(log_file, 'w') as f:
+        for hour in range(7):
+            f.write(LOG_LINE.format(
+                ip='192.168.0.{}'.format(hour), hour=hour,
+                pid_value=hour % 3, status=200, ua='Mozilla/5.0'))
+
+    importer = LogImporter(
+        rules=[dict(event_type='record-view',
+                    pattern=r'^/records/(?P<pid_value>[^/?#]+)/?(?:[?#]|$)',
+                    resolver=record_resolver)],
+        parsers=['invenio_stats.logs:parse_combined_log'],
+        state_file=str(tmpdir.join('state.json')),
+        processes=2, chunk_size=2, salt='import secret')
+    assert importer.import_file(log_file) == 7
+    es.indices.refresh(index='*')
+    search = Search(using=es, index='events-stats-record-view')
+    assert sorted(h.record_id for h in search.scan()) == \
+        ['R0', 'R0', 'R0', 'R1', 'R1', 'R2', 'R2']
+    visitor_ids = sorted(h.visitor_id for h in search.scan())
+
+    # The events get the same visitor ids when imported with the same salt
+    assert importer.import_file(log_file, restart=True) == 7
+    es.indices.refresh(index='*')
+    assert sorted(h.visitor_id for h in search.scan()) == visitor_ids
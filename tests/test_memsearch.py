@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""In-memory search client tests."""
+
+import datetime
+
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl import Search
+
+from invenio_stats.aggregations import StatAggregator
+from invenio_stats.contrib.event_builders import build_file_unique_id
+from invenio_stats.memsearch import MemorySearchClient, parse_date_math
+from invenio_stats.processors import EventsIndexer, anonymize_user, \
+    flag_robots
+from invenio_stats.queries import ESDateHistogramQuery, ESTermsQuery
+
+
+class _ListQueue(object):
+    """Queue returning a list of events."""
+
+    routing_key = 'stats-file-download'
+
+    def __init__(self, events):
+        self.events = events
+
+    def consume(self, payload=True):
+        return iter(self.events)
+
+
+def test_memsearch_documents(memsearch_client):
+    """Test writing and reading documents."""
+    client = memsearch_client
+    index = 'events-stats-file-download-2018-01-01'
+    assert bulk(client, [
+        dict(_index=index, _type='stats-file-download', _id=str(i),
+             _source=dict(timestamp='2018-01-01T00:00:0{}'.format(i)))
+        for i in range(3)
+    ], stats_only=True) == (3, 0)
+    # Templates give their aliases to the created indices
+    assert client.indices.exists(index='events-stats-file-download')
+    assert not client.indices.exists(index='stats-file-download')
+    assert list(client.indices.get_alias(
+        index='events-stats-file-download')) == [index]
+
+    _, errors = bulk(client, [
+        dict(_op_type='create', _index=index, _type='stats-file-download',
+             _id='0', _source={}),
+        dict(_index=index, _type='stats-file-download', _id='1',
+             _version=2, _source={}),
+        dict(_index=index, _type='stats-file-download', _id='2',
+             _version=1, _source=dict(timestamp='2018-01-01T00:00:05')),
+    ], raise_on_error=False)
+    assert [list(e.values())[0]['status'] for e in errors] == [409, 409]
+
+    docs = client.mget(index=index, doc_type='stats-file-download',
+                       body={'ids': ['2', '3']})['docs']
+    assert docs[0]['_version'] == 2
+    assert docs[0]['_source']['timestamp'] == '2018-01-01T00:00:05'
+    assert not docs[1]['found']
+
+    bulk(client, [dict(_op_type='delete', _index=index,
+                       _type='stats-file-download', _id='0')])
+    assert sorted(hit.meta.id for hit in Search(
+        using=client, index='events-stats-file-download').scan()) == \
+        ['1', '2']
+    assert client.search(index='missing', ignore=404)['error']
+
+
+def test_memsearch_aggregations(memsearch_client):
+    """Test the aggregations."""
+    client = memsearch_client
+    bulk(client, [
+        dict(_index='events-stats-file-download-2018-01-0{}'.format(day),
+             _type='stats-file-download',
+             _source=dict(
+                 timestamp='2018-01-0{0}T{1:02d}:00:00'.format(day, hour),
+                 unique_id='file-{}'.format(hour % 2),
+                 visitor_id='visitor-{}'.format(hour % 3),
+                 size=10, is_robot=hour == 0))
+        for day in (1, 3) for hour in range(6)
+    ])
+    search = Search(using=client, index='events-stats-file-download')[0:0]
+    search = search.filter('range', timestamp={
+        'gte': '2018-01-01T12:00:00||/d', 'lte': '2018-01-03T01:00:00'})
+    search = search.filter('term', is_robot=False)
+    histogram = search.aggs.bucket('histogram', 'date_histogram',
+                                   field='timestamp', interval='day')
+    terms = histogram.bucket('terms', 'terms', field='unique_id', size=0)
+    terms.metric('top_hit', 'top_hits', size=1, sort={'timestamp': 'desc'})
+    terms.metric('visitors', 'cardinality', field='visitor_id')
+    terms.metric('volume', 'sum', field='size')
+    terms.metric('weighted_count', 'sum', field='weight', missing=1)
+    response = search.execute()
+
+    buckets = response.aggregations.histogram.buckets
+    # Empty intervals are filled
+    assert [(b.key_as_string, b.doc_count) for b in buckets] == [
+        ('2018-01-01T00:00:00', 5), ('2018-01-02T00:00:00', 0),
+        ('2018-01-03T00:00:00', 1)]
+    assert [(t.key, t.doc_count, t.visitors.value, t.volume.value,
+             t.weighted_count.value,
+             t.top_hit.hits.hits[0]['_source']['timestamp'])
+            for t in buckets[0].terms.buckets] == [
+        ('file-1', 3, 3, 30, 3, '2018-01-01T05:00:00'),
+        ('file-0', 2, 2, 20, 2, '2018-01-01T04:00:00')]
+    assert parse_date_math('2018-01-15||/M', round_up=True) == \
+        parse_date_math('2018-02-01') - 1
+
+
+def test_memsearch_terms_mixed_types():
+    """Test the terms aggregation of a field with values of several types."""
+    client = MemorySearchClient()
+    bulk(client, [
+        dict(_index='test', _type='doc', _source=dict(value=value))
+        for value in ['b', 10, 'a', 9, True]
+    ])
+    search = Search(using=client, index='test')
+    search.aggs.bucket('values', 'terms', field='value')
+    buckets = search.execute().aggregations['values'].buckets
+    assert [b.key for b in buckets] == [1, 9, 10, 'a', 'b']
+
+
+def test_memsearch_stats(app, memsearch_client, mock_anonymization_salt):
+    """Test indexing, aggregating and querying events in memory."""
+    client = memsearch_client
+    app.config['STATS_SEARCH_CLIENT'] = client
+    events = [
+        dict(timestamp='2018-01-0{0}T{1:02d}:00:00'.format(day, hour),
+             bucket_id='B0000000000000000000000000000001',
+             file_id='F000000000000000000000000000000{}'.format(hour % 2),
+             file_key='file-{}.pdf'.format(hour % 2), size=1,
+             ip_address='131.169.180.{}'.format(hour), user_id=str(hour),
+             user_agent='Mozilla/5.0 (X11; Linux x86_64) Firefox/62.0')
+        for day in (1, 2) for hour in range(10)
+    ]
+    indexer = EventsIndexer(
+        _ListQueue(events),
+        preprocessors=[flag_robots, anonymize_user, build_file_unique_id])
+    assert indexer.run() == (20, 0)
+
+    aggregator = StatAggregator(
+        'file-download-agg', 'file-download',
+        aggregation_field='unique_id', aggregation_interval='day',
+        copy_fields=dict(bucket_id='bucket_id', file_key='file_key'))
+    aggregator.run(end_date=datetime.datetime(2018, 1, 3))
+    assert aggregator.get_bookmark() == datetime.datetime(2018, 1, 3)
+
+    histogram = ESDateHistogramQuery(
+        query_name='histogram', index='stats-file-download',
+        doc_type='file-download-day-aggregation',
+        required_filters=dict(bucket_id='bucket_id'))
+    assert [b['value'] for b in histogram.run(
+        bucket_id='B0000000000000000000000000000001', interval='day',
+        start_date='2018-01-01', end_date='2018-01-02')['buckets']] == \
+        [10, 10]
+    total = ESTermsQuery(
+        query_name='total', index='stats-file-download',
+        doc_type='file-download-day-aggregation',
+        required_filters=dict(bucket_id='bucket_id'),
+        aggregated_fields=['file_key'])
+    result = total.run(bucket_id='B0000000000000000000000000000001')
+    assert result['value'] == 20
+    assert [(b['key'], b['value']) for b in result['buckets']] == \
+        [('file-0.pdf', 10), ('file-1.pdf', 10)]
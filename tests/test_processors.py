@@ -18,6 +18,7 @@ from helpers import get_queue_size
 from invenio_queues.proxies import current_queues
 from mock import patch
 
+from invenio_stats.codecs import encode_events
 from invenio_stats.contrib.event_builders import build_file_unique_id, \
     file_download_event_builder
 from invenio_stats.processors import EventsIndexer, anonymize_user, \
@@ -245,6 +246,97 @@ def test_events_indexer_id_windowing(app, mock_event_queue):
     assert len(ids) == 3
 
 
+def test_events_indexer_routing(app, mock_event_queue):
+    """Check that EventsIndexer routes events with the routing field."""
+    indexer = EventsIndexer(mock_event_queue, preprocessors=[],
+                            routing_field='unique_id')
+
+    received_docs = []
+
+    def bulk(client, generator, *args, **kwargs):
+        received_docs.extend(generator)
+
+    mock_event_queue.consume.return_value = [
+        _create_file_download_event((2017, 6, 1), file_id=file_id)
+        for file_id in ['F1', 'F2']
+    ]
+
+    with patch('elasticsearch.helpers.bulk', side_effect=bulk):
+        indexer.run()
+
+    assert [doc['_routing'] for doc in received_docs] == \
+        ['B0000000000000000000000000000001_F1',
+         'B0000000000000000000000000000001_F2']
+
+
+def test_events_indexer_codec(app, mock_event_queue):
+    """Check that EventsIndexer reads encoded and JSON messages."""
+    indexer = EventsIndexer(mock_event_queue, preprocessors=[])
+
+    received_docs = []
+
+    def bulk(client, generator, *args, **kwargs):
+        received_docs.extend(generator)
+
+    events = [_create_file_download_event((2017, 6, 1), file_id=file_id)
+              for file_id in ['F1', 'F2', 'F3']]
+    mock_event_queue.consume.return_value = \
+        [events[0]] + encode_events(events[1:], codec='msgpack-zlib')
+
+    with patch('elasticsearch.helpers.bulk', side_effect=bulk):
+        indexer.run()
+
+    assert [doc['_source']['file_id'] for doc in received_docs] == \
+        ['F1', 'F2', 'F3']
+
+
+def test_events_indexer_drop_robots(app, mock_event_queue,
+                                    es_with_templates):
+    """Check that robot events are counted instead of being indexed."""
+    es = es_with_templates
+    indexer = EventsIndexer(mock_event_queue, preprocessors=[flag_robots],
+                            double_click_window=0, drop_robots=True)
+
+    events = [_create_file_download_event(date) for date in
+              [(2017, 6, 1, 10), (2017, 6, 1, 11), (2017, 6, 1, 12),
+               (2017, 6, 2, 10)]]
+    for event in events[1:]:
+        event['user_agent'] = 'Googlebot/2.1'
+    events[2]['weight'] = 2
+    # Double clicks of robots are counted once
+    mock_event_queue.consume.return_value = events + [dict(events[3])]
+    indexer.run()
+
+    # The counters of concurrent runs are added
+    mock_event_queue.consume.return_value = [dict(events[1])]
+    indexer.run()
+    es.indices.refresh(index='*')
+
+    assert Search(using=es, index='events-stats-file-download').count() == 1
+    assert indexer.get_robot_counts() == {
+        '2017-06-01': dict(robots=4, machines=0),
+        '2017-06-02': dict(robots=1, machines=0),
+    }
+    assert indexer.get_robot_counts(
+        start_date=datetime(2017, 6, 2), end_date=datetime(2017, 6, 2)) == \
+        {'2017-06-02': dict(robots=1, machines=0)}
+    mapping = es.indices.get_mapping(index=indexer.robots_index)
+    assert list(mapping.values())[0]['mappings']['robot-counter'][
+        'properties']['robots']['type'] == 'double'
+
+    # The consumed robot events are counted even if the run fails
+    def failing_consume():
+        yield dict(events[3])
+        raise Exception('consuming failed')
+
+    mock_event_queue.consume.side_effect = failing_consume
+    with pytest.raises(Exception):
+        indexer.run()
+    es.indices.refresh(index='*')
+    assert indexer.get_robot_counts()['2017-06-02'] == \
+        dict(robots=2, machines=0)
+
+
 def test_double_clicks(app, mock_event_queue, es):
     """Test that events occurring within a time window are counted as 1."""
     event_type = 'file-download'
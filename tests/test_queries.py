@@ -11,9 +11,14 @@
 import datetime
 
 import pytest
+from elasticsearch.helpers import bulk
+from invenio_cache import current_cache
 
+from invenio_stats import current_stats
 from invenio_stats.contrib.registrations import register_queries
-from invenio_stats.queries import ESDateHistogramQuery, ESTermsQuery
+from invenio_stats.errors import InvalidRequestInputError
+from invenio_stats.queries import ESBulkTermsQuery, ESDateHistogramQuery, \
+    ESPlannedHistogramQuery, ESTermsQuery
 
 
 @pytest.mark.parametrize('aggregated_events',
@@ -52,3 +57,255 @@ def test_terms_query(app, event_queues, aggregated_events):
                               start_date=datetime.datetime(2017, 1, 1),
                               end_date=datetime.datetime(2017, 1, 7))
     assert int(results['buckets'][0]['value']) == 49
+
+
+@pytest.mark.parametrize('aggregated_events',
+                         [dict(file_number=2,
+                               event_number=3,
+                               start_date=datetime.date(2017, 1, 1),
+                               end_date=datetime.date(2017, 1, 7))],
+                         indirect=['aggregated_events'])
+def test_bulk_terms_query(app, event_queues, aggregated_events):
+    """Test that the bulk query returns the count of each requested id."""
+    query_configs = register_queries()
+    bulk_query = ESBulkTermsQuery(query_name='test_bulk_total',
+                                  **query_configs[2]['query_config'])
+    results = bulk_query.run(ids=['B0000000000000000000000000000001',
+                                  'B0000000000000000000000000000002',
+                                  'B0000000000000000000000000000009'],
+                             start_date=datetime.datetime(2017, 1, 1),
+                             end_date=datetime.datetime(2017, 1, 7))
+    assert results['field'] == 'bucket_id'
+    assert {k: int(v['value']) for k, v in results['results'].items()} == {
+        'B0000000000000000000000000000001': 21,
+        'B0000000000000000000000000000002': 21,
+        'B0000000000000000000000000000009': 0,
+    }
+
+
+def test_bulk_terms_query_max_ids(app):
+    """Test that the number of requested ids is limited."""
+    app.config['STATS_BULK_QUERY_MAX_IDS'] = 2
+    bulk_query = ESBulkTermsQuery(query_name='test_bulk_total',
+                                  index='stats-file-download',
+                                  doc_type='file-download-day-aggregation',
+                                  id_field='bucket_id')
+    # Duplicates are ignored
+    assert bulk_query.parse_arguments(ids=['a', 'b', 'a'])['ids'] == \
+        ['a', 'b']
+    with pytest.raises(InvalidRequestInputError):
+        bulk_query.parse_arguments(ids=['a', 'b', 'c'])
+    with pytest.raises(InvalidRequestInputError):
+        bulk_query.parse_arguments(ids='a')
+
+    # Numeric keys are returned with the requested text ids
+    arguments = bulk_query.parse_arguments(ids=[5, 6])
+    result = bulk_query.process_query_result({'aggregations': {'ids': {
+        'buckets': [{'key': 5, 'value': {'value': 3.0}}]}}}, **arguments)
+    assert list(result['results'].items()) == [
+        ('5', dict(value=3.0)), ('6', dict(value=0))]
+
+
+def test_query_index_pruning(app):
+    """Test that bounded queries only search the indices of their range."""
+    query_configs = register_queries()
+    terms_query = ESTermsQuery(query_name='test_total_count',
+                               **query_configs[1]['query_config'])
+    search = terms_query.build_query(
+        start_date=datetime.datetime(2017, 1, 25),
+        end_date=datetime.datetime(2017, 2, 3),
+        bucket_id='B0000000000000000000000000000001')
+    assert search._index == ['stats-file-download-2017-01',
+                             'stats-file-download-2017-02']
+    assert search._params['ignore_unavailable'] is True
+
+    # Aware dates are converted to naive UTC dates
+    arguments = terms_query.parse_arguments(
+        start_date='2017-01-25T00:00:00Z',
+        end_date='2017-02-03T01:00:00+02:00',
+        bucket_id='B0000000000000000000000000000001')
+    assert arguments['start_date'] == datetime.datetime(2017, 1, 25)
+    assert arguments['end_date'] == datetime.datetime(2017, 2, 2, 23)
+    assert terms_query.build_query(**arguments)._index == [
+        'stats-file-download-2017-01', 'stats-file-download-2017-02']
+
+    # Ranges covering too many indices search the whole alias
+    search = terms_query.build_query(
+        start_date=datetime.datetime(1, 1, 1),
+        end_date=datetime.datetime(2017, 2, 3),
+        bucket_id='B0000000000000000000000000000001')
+    assert search._index == ['stats-file-download']
+
+    # Unbounded queries search the whole alias
+    search = terms_query.build_query(
+        start_date=datetime.datetime(2017, 1, 25), end_date=None,
+        bucket_id='B0000000000000000000000000000001')
+    assert search._index == ['stats-file-download']
+
+
+def test_query_routing(app):
+    """Test that queries filtering on the routing field are routed."""
+    query_configs = register_queries()
+    histo_query = ESDateHistogramQuery(query_name='test_histo',
+                                       routing_field='bucket_id',
+                                       **query_configs[0]['query_config'])
+    search = histo_query.build_query(
+        interval='day', start_date=None, end_date=None,
+        bucket_id='B0000000000000000000000000000001', file_key='test.pdf')
+    assert search._params['routing'] == 'B0000000000000000000000000000001'
+
+    histo_query = ESDateHistogramQuery(query_name='test_histo',
+                                       routing_field='unique_id',
+                                       **query_configs[0]['query_config'])
+    search = histo_query.build_query(
+        interval='day', start_date=None, end_date=None,
+        bucket_id='B0000000000000000000000000000001', file_key='test.pdf')
+    assert 'routing' not in search._params
+
+
+def test_near_real_time_queries(app, memsearch_client, event_entrypoints):
+    """Test completing the aggregations with the unaggregated events."""
+    client = memsearch_client
+    app.config['STATS_SEARCH_CLIENT'] = client
+
+    def index_events(day, files, weight=None):
+        events = [dict(timestamp='2018-01-0{}T10:00:00'.format(day),
+                       unique_id='B1_F{}'.format(i), bucket_id='B1',
+                       file_id='F{}'.format(i), file_key='f{}'.format(i),
+                       size=1, unique_session_id='S', is_robot=False)
+                  for i in files]
+        if weight:
+            events[0]['weight'] = weight
+        bulk(client, [
+            dict(_index='events-stats-file-download-2018-01-0{}'.format(day),
+                 _type='stats-file-download', _source=event)
+            for event in events
+        ])
+
+    index_events(1, range(3))
+    index_events(2, range(3))
+    current_stats.get_aggregator('file-download-agg').run(
+        end_date=datetime.datetime(2018, 1, 3))
+    # Events which are not aggregated yet, the first one sampled
+    index_events(4, range(2), weight=2)
+    index_events(5, [1, 2])
+    robot = dict(timestamp='2018-01-05T11:00:00', unique_id='B1_F0',
+                 bucket_id='B1', file_key='f0', is_robot=True)
+    client.index(index='events-stats-file-download-2018-01-05',
+                 doc_type='stats-file-download', body=robot)
+
+    metric_fields = dict(value=('sum', 'count', {}),
+                         volume=('sum', 'volume', {}))
+    histo_query = ESDateHistogramQuery(
+        query_name='test_histo', index='stats-file-download',
+        doc_type='file-download-day-aggregation',
+        copy_fields=dict(bucket_id='bucket_id'),
+        required_filters=dict(bucket_id='bucket_id'),
+        metric_fields=metric_fields, near_real_time=True,
+        aggregation='file-download-agg')
+    result = histo_query.run(bucket_id='B1', interval='day',
+                             start_date='2018-01-01', end_date='2018-01-05')
+    assert [(b['date'][:10], b['value'], b['volume'], b['bucket_id'])
+            for b in result['buckets']] == [
+        ('2018-01-01', 3, 3, 'B1'),
+        ('2018-01-02', 3, 3, 'B1'),
+        ('2018-01-04', 3, 2, 'B1'),
+        ('2018-01-05', 2, 2, 'B1'),
+    ]
+    assert result['freshness']['aggregated_until'] == '2018-01-04T00:00:00'
+
+    terms_query = ESTermsQuery(
+        query_name='test_total', index='stats-file-download',
+        doc_type='file-download-day-aggregation',
+        required_filters=dict(bucket_id='bucket_id'),
+        aggregated_fields=['file_key'], metric_fields=metric_fields,
+        near_real_time=True, aggregation='file-download-agg')
+    result = terms_query.run(bucket_id='B1')
+    assert (result['value'], result['volume']) == (11, 10)
+    assert sorted((b['key'], b['value']) for b in result['buckets']) == [
+        ('f0', 4), ('f1', 4), ('f2', 3)]
+
+    # Date ranges which are fully aggregated are searched once
+    assert len(terms_query.build_searches(**terms_query.parse_arguments(
+        bucket_id='B1', end_date='2018-01-03'))) == 1
+    result = terms_query.run(bucket_id='B1', end_date='2018-01-03')
+    assert result['value'] == 6
+    assert result['freshness']['aggregated_until'] == '2018-01-04T00:00:00'
+
+    # The date is estimated from the last bookmark when it is not cached
+    current_cache.delete('stats:agg_until:file-download-agg')
+    result = terms_query.run(bucket_id='B1')
+    assert (result['value'], result['volume']) == (11, 10)
+    assert result['freshness']['aggregated_until'] == '2018-01-04T00:00:00'
+
+
+def test_planned_histogram_query(app, memsearch_client, event_entrypoints):
+    """Test reading the coarsest statistics of each date range."""
+    client = memsearch_client
+    app.config['STATS_SEARCH_CLIENT'] = client
+
+    def index_event(timestamp, **kwargs):
+        event = dict(timestamp=timestamp, unique_id='B1_F0', bucket_id='B1',
+                     file_id='F0', file_key='f0', size=1,
+                     unique_session_id='S', is_robot=False, **kwargs)
+        client.index(index='events-stats-file-download-{}'.format(
+            timestamp[:10]), doc_type='stats-file-download', body=event)
+
+    for timestamp in ('2017-12-15T10:00:00', '2018-01-10T10:00:00',
+                      '2018-01-11T10:00:00', '2018-02-03T10:00:00'):
+        index_event(timestamp)
+    day_agg = current_stats.aggregations['file-download-agg']
+    current_stats.aggregations['file-download-month-agg'] = day_agg._replace(
+        name='file-download-month-agg',
+        aggregator_config=dict(day_agg.aggregator_config,
+                               aggregation_interval='month',
+                               totals_fields=None))
+    for name in ('file-download-agg', 'file-download-month-agg'):
+        current_stats.get_aggregator(name).run(
+            end_date=datetime.datetime(2018, 2, 4))
+    # Events which are not aggregated yet
+    index_event('2018-02-06T10:00:00', weight=3)
+    index_event('2018-02-12T10:00:00')
+
+    query = ESPlannedHistogramQuery(
+        query_name='test_planned',
+        aggregations=['file-download-agg', 'file-download-month-agg'],
+        copy_fields=dict(bucket_id='bucket_id'),
+        required_filters=dict(bucket_id='bucket_id'),
+        metric_fields=dict(value=('sum', 'count', {}),
+                           volume=('sum', 'volume', {})),
+        raw_events=True)
+    result = query.run(bucket_id='B1', interval='month',
+                       start_date='2017-12-20', end_date='2018-02-10')
+    assert [(aggregator.name if aggregator else None, lower, upper)
+            for aggregator, lower, upper in query.segments] == [
+        ('file-download-agg', datetime.datetime(2017, 12, 20),
+         datetime.datetime(2018, 1, 1)),
+        ('file-download-month-agg', datetime.datetime(2018, 1, 1),
+         datetime.datetime(2018, 2, 1)),
+        ('file-download-agg', datetime.datetime(2018, 2, 1),
+         datetime.datetime(2018, 2, 5)),
+        (None, datetime.datetime(2018, 2, 5), datetime.datetime(2018, 2, 11)),
+    ]
+    assert [(b['date'][:7], b['value'], b['volume'], b['bucket_id'])
+            for b in result['buckets']] == [
+        ('2018-01', 2, 2, 'B1'),
+        ('2018-02', 4, 2, 'B1'),
+    ]
+
+    # Yearly histograms read the monthly aggregation
+    result = query.run(bucket_id='B1', interval='year', end_date='2018-01-31')
+    assert [a.name for a, _, _ in query.segments] == [
+        'file-download-month-agg']
+    assert [(b['date'][:4], b['value']) for b in result['buckets']] == [
+        ('2017', 1), ('2018', 2)]
+
+    # Hourly histograms read the raw events
+    result = query.run(bucket_id='B1', interval='hour',
+                       start_date='2018-02-06', end_date='2018-02-06')
+    assert [a for a, _, _ in query.segments] == [None]
+    assert [(b['date'], b['value']) for b in result['buckets']] == [
+        ('2018-02-06T10:00:00', 3)]
+    query.raw_events = False
+    with pytest.raises(InvalidRequestInputError):
+        query.run(bucket_id='B1', interval='hour')
@@ -84,3 +84,80 @@ def test_failing_receiver(base_app, event_entrypoints, caplog):
         assert get_queue_size('stats-event_0') == 0
     finally:
         current_queues.delete()
+
+
+def test_buffered_receiver_in_request(base_app, event_entrypoints):
+    """Test that events emitted in a request are published after it."""
+    try:
+        _signals = Namespace()
+        my_signal = _signals.signal('my-signal')
+
+        def event_builder(event, sender_app, signal_param, *args, **kwargs):
+            event.update(dict(event_param=signal_param))
+            return event
+
+        base_app.config.update(dict(
+            STATS_PUBLISH_BUFFERED=True,
+            STATS_EVENTS=dict(
+                event_0=dict(
+                    signal=my_signal,
+                    event_builders=[event_builder]
+                )
+            )
+        ))
+        InvenioStats(base_app)
+        current_queues.declare()
+
+        @base_app.route('/download')
+        def download():
+            my_signal.send(base_app, signal_param=1)
+            my_signal.send(base_app, signal_param=2)
+            # Nothing is published while the request is processed
+            assert get_queue_size('stats-event_0') == 0
+            return 'file content'
+
+        with base_app.test_client() as client:
+            resp = client.get('/download')
+            assert resp.status_code == 200
+            resp.close()
+
+        events = [event for event in current_stats.consume('event_0')]
+        assert events == [{'event_param': 1}, {'event_param': 2}]
+    finally:
+        current_queues.delete()
+
+
+def test_buffered_receiver_outside_request(base_app, event_entrypoints):
+    """Test the process-level events buffer."""
+    try:
+        _signals = Namespace()
+        my_signal = _signals.signal('my-signal')
+
+        def event_builder(event, sender_app, signal_param, *args, **kwargs):
+            event.update(dict(event_param=signal_param))
+            return event
+
+        base_app.config.update(dict(
+            STATS_PUBLISH_BUFFERED=True,
+            STATS_PUBLISH_BUFFER_SIZE=3,
+            STATS_EVENTS=dict(
+                event_0=dict(
+                    signal=my_signal,
+                    event_builders=[event_builder]
+                )
+            )
+        ))
+        InvenioStats(base_app)
+        current_queues.declare()
+
+        for param in range(4):
+            my_signal.send(base_app, signal_param=param)
+        # The buffer is flushed when it is full
+        assert get_queue_size('stats-event_0') == 3
+        assert len(current_stats.event_buffer) == 1
+
+        current_stats.event_buffer.flush()
+        events = [event for event in current_stats.consume('event_0')]
+        assert events == [{'event_param': i} for i in range(4)]
+    finally:
+        current_queues.delete()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Events sampling tests."""
+
+from blinker import Namespace
+from invenio_queues.proxies import current_queues
+from mock import patch
+
+from invenio_stats import InvenioStats
+from invenio_stats.proxies import current_stats
+from invenio_stats.sampling import EventSampler
+
+ROBOT_UA = 'Mozilla/5.0 (compatible; Googlebot/2.1)'
+BROWSER_UA = 'Mozilla/5.0 (X11; Linux x86_64; rv:60.0) Firefox/60.0'
+
+
+def test_sampling_rates(app):
+    """Test the sampling rate of the events."""
+    sampler = EventSampler(rates={'file-download': 0.5}, robots_rate=0.1,
+                           robots_pattern=r'bot|crawl')
+    assert sampler.get_rate('record-view', {}) == 1
+    assert sampler.get_rate('file-download', {}) == 0.5
+    assert sampler.get_rate('file-download', {'user_agent': BROWSER_UA}) == 0.5
+    assert sampler.get_rate('file-download', {'user_agent': ROBOT_UA}) == 0.05
+
+    with patch('random.random', return_value=0.3):
+        assert sampler('record-view', {}) == {}
+        assert sampler('file-download', {}) == {'weight': 2.0}
+        assert sampler('file-download', {'user_agent': ROBOT_UA}) is None
+    with patch('random.random', return_value=0.7):
+        assert sampler('file-download', {}) is None
+
+
+def test_adaptive_shedding(app):
+    """Test that events are shed when their queue is long."""
+    sampler = EventSampler(queue_thresholds=[(100, 0.5), (1000, 0.1)])
+    with patch.object(EventSampler, 'queue_size', return_value=10):
+        assert sampler.get_rate('file-download', {}) == 1
+    with patch.object(EventSampler, 'queue_size', return_value=500):
+        assert sampler.get_rate('file-download', {}) == 0.5
+    with patch.object(EventSampler, 'queue_size', return_value=5000):
+        assert sampler.get_rate('file-download', {}) == 0.1
+
+
+def test_sampled_receiver(base_app, event_entrypoints):
+    """Test that the signal receivers sample the events."""
+    try:
+        _signals = Namespace()
+        my_signal = _signals.signal('my-signal')
+        base_app.config.update(dict(
+            STATS_SAMPLING_RATES={'event_0': 0.25},
+            STATS_EVENTS=dict(event_0=dict(signal=my_signal)),
+        ))
+        InvenioStats(base_app)
+        current_queues.declare()
+        with patch('random.random', side_effect=[0.1, 0.9, 0.2]):
+            for _ in range(3):
+                my_signal.send(base_app)
+        assert list(current_stats.consume('event_0')) == \
+            [{'weight': 4.0}, {'weight': 4.0}]
+    finally:
+        current_queues.delete()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Events spool tests."""
+
+import fcntl
+import os
+import time
+
+from mock import patch
+
+from invenio_stats.proxies import current_stats
+from invenio_stats.spool import CLOSED_SUFFIX, TMP_SUFFIX, EventSpool
+
+
+def test_spool_segments(app, tmpdir):
+    """Test appending events to segments and draining them."""
+    spool = EventSpool(str(tmpdir), segment_size=100)
+    spool.append('file-download', [{'id': 1}, {'id': 2}])
+    # The segment of the current process is not drained while it is written
+    assert spool.segments() == []
+    spool.append('file-download', [{'id': 3}] * 10)
+    assert len(spool) == 1
+    spool.append('record-view', [{'id': 4}])
+    spool.close()
+    assert len(spool) == 2
+    assert all(s.endswith(CLOSED_SUFFIX) for s in spool.segments())
+
+    published = []
+    assert spool.drain(lambda t, e: published.append((t, e))) == 13
+    assert published == [
+        ('file-download', [{'id': 1}, {'id': 2}]),
+        ('file-download', [{'id': 3}] * 10),
+        ('record-view', [{'id': 4}]),
+    ]
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_spool_drain_failure(app, tmpdir):
+    """Test that events which failed to be replayed are kept."""
+    spool = EventSpool(str(tmpdir))
+    spool.append('file-download', [{'id': 1}])
+    spool.append('file-download', [{'id': 2}, {'id': 3}])
+    spool.close()
+
+    published = []
+
+    def failing_publish(event_type, events):
+        if len(published) == 1:
+            raise Exception('broker down')
+        published.append(events)
+
+    assert spool.drain(failing_publish) == 1
+    assert len(spool) == 1
+
+    # Draining can be limited to a number of events
+    assert spool.drain(lambda t, e: published.append(e), max_events=1) == 1
+    assert published == [[{'id': 1}], [{'id': 2}]]
+    assert spool.drain(lambda t, e: published.append(e)) == 1
+    assert published[-1] == [{'id': 3}]
+    assert len(spool) == 0
+
+
+def test_publish_fallback_to_spool(app, event_queues, tmpdir):
+    """Test that events are spooled when they cannot be published."""
+    app.config['STATS_SPOOL_DIR'] = str(tmpdir)
+    events = [{'id': 1}, {'id': 2}]
+
+    def failing_publish(queue, events, timeout):
+        error = Exception('broker down')
+        error.published = 1
+        raise error
+
+    with patch('invenio_stats.ext.publish_events',
+               side_effect=failing_publish) as publish:
+        current_stats.publish('file-download', events)
+        # The broker is not contacted again before the retry interval
+        current_stats.publish('file-download', [{'id': 3}])
+        assert publish.call_count == 1
+    assert len(current_stats.spool) == 0
+
+    # The segment is closed once the broker recovers
+    app.config['STATS_SPOOL_RETRY_INTERVAL'] = 0
+    with patch('invenio_stats.ext.publish_events', return_value=1):
+        current_stats.publish('file-download', [{'id': 4}])
+    assert len(current_stats.spool) == 1
+
+    assert current_stats.drain_spool() == 2
+    assert list(current_stats.consume('file-download')) == \
+        [{'id': 2}, {'id': 3}]
+
+
+def test_spool_segment_expiry(app, tmpdir):
+    """Test that idle segments are closed after their maximum age."""
+    spool = EventSpool(str(tmpdir), segment_age=0.1)
+    spool.append('file-download', [{'id': 1}])
+    assert spool.segments() == []
+    time.sleep(0.5)
+    assert len(spool) == 1
+    assert all(s.endswith(CLOSED_SUFFIX) for s in spool.segments())
+
+
+def test_spool_drain_locked_segment(app, tmpdir):
+    """Test that a segment is not drained by two drainers at once."""
+    spool = EventSpool(str(tmpdir))
+    spool.append('file-download', [{'id': 1}])
+    spool.close()
+    segment, = spool.segments()
+    published = []
+    with open(segment, 'rb') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        assert spool.drain(lambda t, e: published.append(e)) == 0
+    assert spool.drain(lambda t, e: published.append(e)) == 1
+    assert published == [[{'id': 1}]]
+
+
+def test_spool_interrupted_rewrite(app, tmpdir):
+    """Test that the files of an interrupted segment rewrite are removed."""
+    spool = EventSpool(str(tmpdir))
+    spool.append('file-download', [{'id': 1}])
+    spool.close()
+    segment, = spool.segments()
+    with open(segment + TMP_SUFFIX, 'wb') as f:
+        f.write(b'["file-download", [{"id"')
+    orphan = str(tmpdir.join('drained' + CLOSED_SUFFIX + TMP_SUFFIX))
+    with open(orphan, 'wb') as f:
+        f.write(b'["file-download", [{"id": 2}]]\n')
+    published = []
+    assert spool.drain(lambda t, e: published.append(e)) == 1
+    assert published == [[{'id': 1}]]
+    assert os.listdir(str(tmpdir)) == []
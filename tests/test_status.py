@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Statistics status tests."""
+
+import datetime
+
+from click.testing import CliRunner
+from elasticsearch.helpers import bulk
+from flask import url_for
+from mock import patch
+
+from invenio_stats import current_stats
+from invenio_stats.cli import stats
+from invenio_stats.status import format_metrics, get_status
+from invenio_stats.utils import AllowAllPermission, \
+    default_metrics_permission_factory
+
+
+def test_status(app, memsearch_client, event_entrypoints, script_info):
+    """Test collecting and exporting the status."""
+    client = memsearch_client
+    app.config['STATS_SEARCH_CLIENT'] = client
+    bulk(client, [
+        dict(_index='events-stats-file-download-2018-01-0{}'.format(day),
+             _type='stats-file-download',
+             _source=dict(timestamp='2018-01-0{}T10:00:00'.format(day),
+                          unique_id='B1_F{}'.format(i), bucket_id='B1',
+                          file_id='F{}'.format(i), file_key='f{}'.format(i),
+                          size=1, unique_session_id='S', is_robot=False))
+        for day in (1, 2) for i in range(3)
+    ])
+    current_stats.get_aggregator('file-download-agg').run(
+        end_date=datetime.datetime(2018, 1, 3))
+
+    with patch('invenio_stats.status.get_queue_size', return_value=3):
+        status = get_status()
+    assert status['events']['file-download'] == dict(
+        queue_messages=3,
+        newest_event=(datetime.datetime(2018, 1, 2, 10) -
+                      datetime.datetime(1970, 1, 1)).total_seconds())
+    aggregation = status['aggregations']['file-download-agg']
+    assert aggregation['last_run_documents'] == 6
+    assert aggregation['last_run_duration'] >= 0
+    # The status is cached
+    with patch('invenio_stats.status.get_queue_size', return_value=5):
+        assert get_status() == status
+
+    metrics = format_metrics(status, now=aggregation['bookmark'] + 60)
+    assert 'invenio_stats_queue_messages{event_type="file-download"} 3.0\n' \
+        in metrics
+    assert 'invenio_stats_bookmark_age_seconds' \
+        '{aggregation="file-download-agg"} 60.0\n' in metrics
+    # The metrics must be explicitly allowed
+    assert not default_metrics_permission_factory().can()
+    app.config['STATS_METRICS_PERMISSION_FACTORY'] = \
+        lambda: AllowAllPermission
+    with app.test_client() as http_client:
+        resp = http_client.get(url_for('invenio_stats.metrics'))
+        assert resp.status_code == 200
+        assert 'invenio_stats_last_run_documents' \
+            '{aggregation="file-download-agg"} 6.0\n' in \
+            resp.get_data(as_text=True)
+
+    result = CliRunner().invoke(stats, ['status'], obj=script_info)
+    assert result.exit_code == 0
+    assert 'queued messages: 3' in result.output
+    assert 'bookmark: 2018-01-03T00:00:00' in result.output
+    assert 'last run documents: 6' in result.output
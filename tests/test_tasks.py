@@ -10,8 +10,10 @@
 
 from __future__ import absolute_import, print_function
 
+from mock import patch
+
 from invenio_stats import current_stats
-from invenio_stats.tasks import process_events
+from invenio_stats.tasks import process_events, warm_up_worker
 
 
 def test_process_events(app, es, event_queues):
@@ -24,3 +26,19 @@ def test_process_events(app, es, event_queues):
     process_events.delay(['file-download'])
     # FIXME: no need to publish events. We should just mock "consume" and test
     # that the events are properly received and processed.
+
+
+def test_warm_up_worker(app, event_queues):
+    """Test that the worker processes reuse the prepared processors."""
+    state = app.extensions['invenio-stats']
+    with patch('invenio_stats.tasks.current_celery_app') as celery_app:
+        celery_app.flask_app = app
+        warm_up_worker()
+    assert set(state._processors) == set(state.events)
+    assert set(state._aggregators) == set(state.aggregations)
+
+    processor = state.get_processor('file-download')
+    with patch.object(processor, 'run', return_value=(0, 0)) as run:
+        assert process_events(['file-download']) == \
+            [('file-download', (0, 0))]
+        assert run.call_count == 1
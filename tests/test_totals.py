@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""All-time totals tests."""
+
+import datetime
+
+import pytest
+from elasticsearch.exceptions import ConnectionError
+from elasticsearch.helpers import bulk
+from mock import patch
+
+from invenio_stats.aggregations import StatAggregator
+from invenio_stats.errors import InvalidRequestInputError
+from invenio_stats.queries import ESTotalsQuery
+
+
+def _index_events(client, day, files):
+    """Index one download of some files on a day of January 2018."""
+    bulk(client, [
+        dict(_index='events-stats-file-download-2018-01-{:02d}'.format(day),
+             _type='stats-file-download',
+             _source=dict(timestamp='2018-01-{:02d}T10:00:00'.format(day),
+                          unique_id='B1_F{}'.format(i), bucket_id='B1',
+                          file_id='F{}'.format(i), file_key='f{}'.format(i),
+                          size=10, unique_session_id='S', is_robot=False))
+        for i in files
+    ])
+
+
+def _aggregator():
+    """Create a file-download aggregator updating the totals."""
+    return StatAggregator(
+        'file-download-agg', 'file-download',
+        aggregation_field='unique_id', aggregation_interval='day',
+        index_interval='day',
+        metric_aggregation_fields={
+            'volume': ('sum', 'size', {}),
+        },
+        copy_fields={'bucket_id': 'bucket_id'},
+        totals_fields=['count', 'volume'],
+        totals_parent_fields=['bucket_id'])
+
+
+def test_totals(app, memsearch_client):
+    """Test the totals updated by the aggregations."""
+    client = memsearch_client
+    app.config['STATS_SEARCH_CLIENT'] = client
+    _index_events(client, 1, range(3))
+    _index_events(client, 2, range(2))
+
+    _aggregator().run(end_date=datetime.datetime(2018, 1, 3))
+    query = ESTotalsQuery('total', 'stats-totals-file-download',
+                          'file-download-total', key_field='unique_id',
+                          metric_fields=dict(value='count', volume='volume'))
+    bucket_query = ESTotalsQuery('bucket-total', 'stats-totals-file-download',
+                                 'file-download-total', key_field='bucket_id')
+    assert query.run(unique_id='B1_F0') == dict(
+        field='unique_id', key='B1_F0', value=2, volume=20)
+    assert bucket_query.run(bucket_id='B1')['value'] == 5
+    results = query.run(ids=['B1_F2', 'B1_F1', 'unknown'])['results']
+    assert list(results.items()) == [
+        ('B1_F2', dict(value=1, volume=10)),
+        ('B1_F1', dict(value=2, volume=20)),
+        ('unknown', dict(value=0, volume=0)),
+    ]
+
+    # Aggregating a day again only adds its new events
+    _index_events(client, 2, [2])
+    _aggregator().run(start_date=datetime.datetime(2018, 1, 2),
+                      end_date=datetime.datetime(2018, 1, 3))
+    assert query.run(unique_id='B1_F2')['value'] == 2
+    assert bucket_query.run(bucket_id='B1')['value'] == 6
+
+    client.indices.delete(index='stats-totals-file-download')
+    assert bucket_query.run(bucket_id='B1')['value'] == 0
+    _aggregator().rebuild_totals()
+    assert bucket_query.run(bucket_id='B1')['value'] == 6
+    assert query.run(unique_id='B1_F1')['volume'] == 20
+
+    with pytest.raises(InvalidRequestInputError):
+        query.run()
+    with pytest.raises(InvalidRequestInputError):
+        query.run(ids=[])
+
+
+def test_totals_failed_bulk(app, memsearch_client):
+    """Test the totals of the documents written before a failed bulk."""
+    client = memsearch_client
+    app.config['STATS_SEARCH_CLIENT'] = client
+    _index_events(client, 1, range(60))
+    query = ESTotalsQuery('bucket-total', 'stats-totals-file-download',
+                          'file-download-total', key_field='bucket_id')
+    client_bulk = client.bulk
+    calls = []
+
+    def failing_bulk(*args, **kwargs):
+        # The second chunk of aggregation documents fails
+        calls.append(args)
+        if len(calls) == 2:
+            raise ConnectionError('N/A', 'Connection lost', None)
+        return client_bulk(*args, **kwargs)
+
+    with patch.object(client, 'bulk', side_effect=failing_bulk):
+        with pytest.raises(ConnectionError):
+            _aggregator().run(end_date=datetime.datetime(2018, 1, 2))
+    # The totals include the documents of the first chunk
+    assert query.run(bucket_id='B1')['value'] == 50
+
+    _aggregator().run(start_date=datetime.datetime(2018, 1, 1),
+                      end_date=datetime.datetime(2018, 1, 2))
+    assert query.run(bucket_id='B1')['value'] == 60
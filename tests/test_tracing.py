@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2018 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Search requests tracing tests."""
+
+import datetime
+
+from elasticsearch.helpers import bulk
+
+from invenio_stats.aggregations import StatAggregator
+from invenio_stats.queries import ESTermsQuery, msearch
+from invenio_stats.tracing import TracedClient
+
+
+def test_tracing(app, memsearch_client):
+    """Test tracing the requests of the aggregators and queries."""
+    spans = []
+    client = memsearch_client
+    app.config.update(STATS_SEARCH_CLIENT=client,
+                      STATS_TRACING_SINK=spans.append)
+    bulk(client, [
+        dict(_index='events-stats-file-download-2018-01-0{}'.format(day),
+             _type='stats-file-download',
+             _source=dict(timestamp='2018-01-0{}T10:00:00'.format(day),
+                          unique_id='F{}'.format(i), is_robot=False))
+        for day in (1, 2) for i in range(3)
+    ])
+    assert not spans
+
+    StatAggregator('file-download-agg', 'file-download',
+                   aggregation_field='unique_id', aggregation_interval='day',
+                   index_interval='day').run(
+        end_date=datetime.datetime(2018, 1, 3))
+    operations = set(s['operation'] for s in spans)
+    assert {'search', 'bulk', 'indices.flush'} <= operations
+    assert all((s['component'], s['name']) ==
+               ('aggregator', 'file-download-agg') for s in spans)
+    search = [s for s in spans if s['operation'] == 'search' and
+              s['buckets']][0]
+    assert search['index'] == 'events-stats-file-download-2018-01-01,' \
+        'events-stats-file-download-2018-01-02'
+    # 2 days of 3 files
+    assert (search['hits'], search['buckets']) == (6, 8)
+    written = [s for s in spans if s['operation'] == 'bulk' and s['items']]
+    assert written[0]['index'] == 'stats-file-download-2018-01-01,' \
+        'stats-file-download-2018-01-02'
+    assert written[0]['items'] == 6
+    assert all(s['request_bytes'] > 0 for s in written)
+
+    del spans[:]
+    query = ESTermsQuery(query_name='total', index='stats-file-download',
+                         doc_type='file-download-day-aggregation')
+    assert query.run()['value'] == 6
+    assert [(s['component'], s['name'], s['operation'], s['hits'])
+            for s in spans] == [('query', 'total', 'search', 6)]
+    assert spans[0]['response_bytes'] > 0 and spans[0]['error'] is None
+    # Clients wrapped for the same component stay grouped
+    other = ESTermsQuery(query_name='other', index='stats-file-download',
+                         doc_type='file-download-day-aggregation')
+    assert query.client == other.client
+    del spans[:]
+    msearch(query.client, [q.build_searches(**q.parse_arguments())[0]
+                           for q in (query, other)],
+            query_names=['total', 'other'])
+    assert [(s['name'], s['operation'], s['queries'], s['query_count'])
+            for s in spans] == [('msearch', 'msearch', ['total', 'other'], 2)]
+
+    app.config['STATS_TRACING_SAMPLE_RATE'] = 0
+    ESTermsQuery(query_name='total', index='stats-file-download',
+                 doc_type='file-download-day-aggregation').run()
+    assert len(spans) == 1
+    app.config['STATS_TRACING_SINK'] = None
+    assert not isinstance(ESTermsQuery(
+        query_name='total', index='stats-file-download',
+        doc_type='file-download-day-aggregation').client, TracedClient)
@@ -8,9 +8,12 @@
 
 """Test utility functions."""
 
+from datetime import datetime
+
 from mock import patch
 
-from invenio_stats.utils import get_geoip, get_user, obj_or_import_string
+from invenio_stats.utils import get_geoip, get_time_based_indices, \
+    get_user, obj_or_import_string
 
 
 def myfunc():
@@ -42,3 +45,37 @@ def test_obj_or_import_string(app):
     """Test obj_or_import_string."""
     assert not obj_or_import_string(value=None)
     assert myfunc == obj_or_import_string(value=myfunc)
+
+
+def test_get_time_based_indices():
+    """Test listing the time-based indices of a date range."""
+    assert get_time_based_indices(
+        'stats-file-download', '%Y-%m',
+        datetime(2017, 11, 20), datetime(2018, 1, 3)) == [
+        'stats-file-download-2017-11',
+        'stats-file-download-2017-12',
+        'stats-file-download-2018-01',
+    ]
+    assert get_time_based_indices(
+        'events-stats-file-download', '%Y-%m-%d',
+        datetime(2018, 1, 1, 23), datetime(2018, 1, 2, 1)) == [
+        'events-stats-file-download-2018-01-01',
+        'events-stats-file-download-2018-01-02',
+    ]
+    assert get_time_based_indices(
+        'stats-file-download', '%Y',
+        datetime(2018, 1, 2), datetime(2018, 1, 1)) == []
+    assert get_time_based_indices(
+        'stats-file-download', '%Y',
+        datetime(2016, 6, 1), datetime(2018, 1, 1)) == [
+        'stats-file-download-2016',
+        'stats-file-download-2017',
+        'stats-file-download-2018',
+    ]
+    # Long ranges are not walked past the maximum number of indices
+    assert get_time_based_indices(
+        'events-stats-file-download', '%Y-%m-%dT%H',
+        datetime(1, 1, 1), datetime(9999, 12, 31), max_indices=100) is None
+    assert len(get_time_based_indices(
+        'stats-file-download', '%Y',
+        datetime(1, 1, 1), datetime(9999, 12, 31))) == 9999
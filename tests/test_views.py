@@ -8,8 +8,15 @@
 
 """Test view functions."""
 import json
+from collections import OrderedDict
 
 from flask import url_for
+from mock import patch
+
+from invenio_stats.proxies import current_stats
+from invenio_stats.queries import ESTermsQuery
+from invenio_stats.utils import AllowAllPermission, \
+    default_events_permission_factory
 
 
 def test_post_request(app, db, query_entrypoints,
@@ -62,3 +69,138 @@ def test_unauthorized_request(app, query_entrypoints,
     assert custom_permission_factory.query_name == 'test-query'
     assert custom_permission_factory.params == \
         sample_histogram_query_data['mystat']['params']
+
+
+def test_multiple_statistics_single_msearch(app, db, query_entrypoints,
+                                            users):
+    """Test that statistics are fetched with one multi-search request."""
+    histogram_response = {'aggregations': {'histogram': {'buckets': [
+        {'key': 1483228800000, 'key_as_string': '2017-01-01T00:00:00',
+         'value': {'value': 3.0},
+         'top_hit': {'hits': {'hits': []}}},
+    ]}}}
+    failed_response = {'error': {'type': 'search_phase_execution_exception'},
+                       'status': 500}
+    with app.test_client() as client, \
+            patch('elasticsearch.Elasticsearch.msearch',
+                  return_value={'responses': [histogram_response,
+                                              failed_response]}) as msearch:
+        headers = [('Content-Type', 'application/json'),
+                   ('Accept', 'application/json')]
+        data = OrderedDict([
+            ('histogram', {
+                'stat': 'bucket-file-download-histogram',
+                'params': {'start_date': '2017-1-1', 'end_date': '2017-1-2',
+                           'interval': 'day', 'bucket_id': 'B1',
+                           'file_key': 'test.pdf'}}),
+            ('total', {
+                'stat': 'bucket-file-download-total',
+                'params': {'bucket_id': 'B1'}}),
+            ('custom', {'stat': 'test-query'}),
+        ])
+        resp = client.post(
+            url_for('invenio_stats.stat_query',
+                    access_token=users['authorized'].allowed_token),
+            headers=headers,
+            data=json.dumps(data))
+        assert resp.status_code == 200
+        assert msearch.call_count == 1
+        # One header and one body per elasticsearch statistic
+        assert len(msearch.call_args[1]['body']) == 4
+
+        resp_json = json.loads(resp.data.decode('utf-8'))
+        assert resp_json['histogram']['buckets'][0]['value'] == 3
+        assert resp_json['total'] is None
+        assert resp_json['custom']['value'] == 100
+
+
+def test_overridden_run_not_batched(app, db, query_entrypoints, users):
+    """Test that queries overriding ``run`` are not batched."""
+    class OverridingQuery(ESTermsQuery):
+        def run(self, **kwargs):
+            return dict(value=5)
+
+    queries = current_stats.queries
+    queries['test-query'] = queries['test-query']._replace(
+        query_class=OverridingQuery)
+    with app.test_client() as client, \
+            patch('elasticsearch.Elasticsearch.msearch') as msearch:
+        resp = client.post(
+            url_for('invenio_stats.stat_query',
+                    access_token=users['authorized'].allowed_token),
+            headers=[('Content-Type', 'application/json'),
+                     ('Accept', 'application/json')],
+            data=json.dumps({'custom': {'stat': 'test-query'}}))
+        assert resp.status_code == 200
+        assert not msearch.called
+        assert json.loads(resp.data.decode('utf-8')) == \
+            {'custom': {'value': 5}}
+
+
+def test_server_timing(app, db, query_entrypoints, users):
+    """Test reporting the duration of the processing stages."""
+    response = {'aggregations': {'value': {'value': 3.0}}}
+    data = json.dumps({'total': {'stat': 'bucket-file-download-total',
+                                 'params': {'bucket_id': 'B1'}}})
+    with app.test_client() as client, \
+            patch('elasticsearch.Elasticsearch.msearch',
+                  return_value={'responses': [response]}):
+        def post():
+            return client.post(
+                url_for('invenio_stats.stat_query',
+                        access_token=users['authorized'].allowed_token),
+                headers=[('Content-Type', 'application/json'),
+                         ('Accept', 'application/json')],
+                data=data)
+
+        assert 'Server-Timing' not in post().headers
+        app.config['STATS_SERVER_TIMING'] = True
+        resp = post()
+        assert json.loads(resp.data.decode('utf-8'))['total']['value'] == 3
+        assert [timing.split(';dur=')[0] for timing in
+                resp.headers['Server-Timing'].split(', ')] == \
+            ['build', 'permission', 'process', 'search']
+
+
+def test_events_ingestion(app, event_queues):
+    """Test sending batches of events to the REST API."""
+    def send(event_type, data):
+        with app.test_client() as client:
+            return client.post(
+                url_for('invenio_stats.stat_events', event_type=event_type),
+                headers=[('Content-Type', 'application/x-ndjson'),
+                         ('Accept', 'application/json')],
+                data=data)
+
+    events = [dict(timestamp='2018-01-01T10:00:00', bucket_id='B1',
+                   file_id='F{}'.format(i)) for i in range(3)]
+    data = '\n'.join(
+        [json.dumps(e) for e in events[:2]] +
+        ['{invalid', '', json.dumps(dict(timestamp='2018-01-01T10:00:00')),
+         json.dumps(events[2]),
+         json.dumps(dict(events[2], timestamp='yesterday')),
+         json.dumps(dict(events[2], user_agent='Googlebot/2.1'))])
+
+    # Sending events is forbidden by default
+    assert not default_events_permission_factory('file-download').can()
+    app.config['STATS_EVENTS_PERMISSION_FACTORY'] = \
+        lambda event_type: AllowAllPermission
+    # Valid events dropped by the sampling are not accepted
+    app.config['STATS_SAMPLING_ROBOTS_RATE'] = 0
+    assert send('unknown-event', data).status_code == 404
+
+    resp = send('file-download', data)
+    assert resp.status_code == 200
+    assert json.loads(resp.data.decode('utf-8')) == dict(
+        accepted=3, rejected=3, sampled_out=1, errors=[
+            dict(line=3, message='Invalid JSON.'),
+            dict(line=5, message='Missing fields: bucket_id, file_id.'),
+            dict(line=7, message='Invalid timestamp.'),
+        ])
+    assert list(current_stats.consume('file-download')) == events
+
+    # Size limits
+    app.config['STATS_EVENTS_MAX_BATCH_SIZE'] = 2
+    assert send('file-download', data).status_code == 400
+    app.config['STATS_EVENTS_MAX_CONTENT_LENGTH'] = 10
+    assert send('file-download', data).status_code == 413